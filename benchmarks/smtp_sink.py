@@ -0,0 +1,65 @@
+"""Local SMTP server that accepts and discards every message
+
+Stands in for the real mail server while benchmarking, `connect_delay`
+simulates the cost of opening a connection (TCP and TLS handshakes).
+"""
+
+import socketserver
+import threading
+import time
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line: str):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        time.sleep(self.server.connect_delay)
+        self.server.record("connections")
+        self.reply("220 sink ready")
+        for line in self.rfile:
+            command = line.decode(errors="replace").strip()[:4].upper()
+            if command in ("EHLO", "HELO"):
+                self.reply("250-sink")
+                self.reply("250 8BITMIME")
+            elif command == "DATA":
+                self.reply("354 end data with <CR><LF>.<CR><LF>")
+                for data in self.rfile:
+                    if data == b".\r\n":
+                        break
+                self.server.record("messages")
+                self.reply("250 queued")
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 ok")
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """SMTP server counting connections and messages
+
+    Args:
+        connect_delay (float): seconds to wait before greeting a client
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, connect_delay: float = 0.0):
+        super().__init__(("127.0.0.1", 0), SMTPSinkHandler)
+        self.connect_delay = connect_delay
+        self.counts = {"connections": 0, "messages": 0}
+        self._lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def record(self, name: str):
+        with self._lock:
+            self.counts[name] += 1
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
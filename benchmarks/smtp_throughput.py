@@ -0,0 +1,81 @@
+"""Compare direct and batched delivery of verification emails
+
+Sends the same number of verification codes through both delivery modes to
+a local SMTP sink and prints the throughput of each. Needs the usual
+environment variables (see `.env.sample`) and a running Redis, e.g.
+
+    python benchmarks/smtp_throughput.py --messages 500 --connect-delay 0.05
+"""
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.test import override_settings  # noqa: E402
+
+from benchmarks.smtp_sink import SMTPSink  # noqa: E402
+from users import mail  # noqa: E402
+from users.tasks import send_verification_code  # noqa: E402
+
+
+def direct(count: int, batch_size: int):
+    for i in range(count):
+        send_verification_code(email=f"user{i}@example.com", code=f"{i:06}")
+
+
+def batched(count: int, batch_size: int):
+    for i in range(count):
+        mail.queue_verification_code(f"user{i}@example.com", f"{i:06}")
+    while mail.send_queued_emails(batch_size):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument(
+        "--connect-delay",
+        type=float,
+        default=0.05,
+        help="seconds the sink takes to accept a connection",
+    )
+    args = parser.parse_args()
+
+    # keep the benchmark away from the real queue
+    mail.MAIL_QUEUE_KEY = "verification:mail:benchmark"
+    mail.get_redis().delete(mail.MAIL_QUEUE_KEY)
+
+    for mode in (direct, batched):
+        sink = SMTPSink(connect_delay=args.connect_delay).start()
+        with override_settings(
+            EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend",
+            EMAIL_HOST="127.0.0.1",
+            EMAIL_PORT=sink.port,
+            EMAIL_HOST_USER="",
+            EMAIL_HOST_PASSWORD="",
+            EMAIL_USE_TLS=False,
+        ):
+            start = time.perf_counter()
+            mode(args.messages, args.batch_size)
+            elapsed = time.perf_counter() - start
+        sink.shutdown()
+        sink.server_close()
+        print(
+            f"{mode.__name__:>8}: {sink.counts['messages']} messages over "
+            f"{sink.counts['connections']} connections in {elapsed:.2f}s "
+            f"({sink.counts['messages'] / elapsed:.0f} messages/s)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""Compare the WSGI and the async ASGI serving of `PUT /api/vote/`
+
+Starts the API under gunicorn with sync workers (`wsgi`), with uvicorn
+workers running django in a thread per request (`asgi`) and with uvicorn
+workers and `ASYNC_API` on (`async`), then sends the same votes to each
+over many concurrent keep-alive connections and prints the throughput and
+the latency of each. Needs the usual environment variables (see
+`.env.sample`), a migrated database and a running Redis, e.g.
+
+    python benchmarks/vote_throughput.py --requests 5000 --concurrency 200
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from users.models import Emails  # noqa: E402
+from users.utils import (  # noqa: E402
+    add_to_email_filter,
+    cache_email_identities,
+    forget_email_identity,
+)
+from votes.models import Voters, Votes  # noqa: E402
+
+SERVERS = {
+    "wsgi": "gunicorn config.wsgi:application -w {workers} -b 127.0.0.1:{port}",
+    "asgi": (
+        "gunicorn config.asgi:application -w {workers} -b 127.0.0.1:{port} "
+        "-k uvicorn.workers.UvicornWorker"
+    ),
+    "async": (
+        "gunicorn config.asgi:application -w {workers} -b 127.0.0.1:{port} "
+        "-k uvicorn.workers.UvicornWorker"
+    ),
+}
+
+
+def start_server(mode: str, port: int, workers: int) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "ASYNC_API": str(mode == "async"),
+        # the benchmark sends every vote from the same address
+        "THROTTLE_VOTE_RATE": "1000000000/s",
+    }
+    server = subprocess.Popen(
+        SERVERS[mode].format(workers=workers, port=port).split(),
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"{mode} server did not start")
+
+
+async def send_votes(port: int, bodies: list, concurrency: int) -> list:
+    """Send every body over `concurrency` keep-alive connections
+
+    Returns:
+        list: `(status, seconds)` of every request
+    """
+    queue = asyncio.Queue()
+    for body in bodies:
+        queue.put_nowait(body)
+    results = []
+
+    async def client():
+        reader = writer = None
+        try:
+            while not queue.empty():
+                body = queue.get_nowait()
+                start = time.perf_counter()
+                if writer is None:
+                    reader, writer = await asyncio.open_connection(
+                        "127.0.0.1", port
+                    )
+                writer.write(
+                    b"PUT /api/vote/ HTTP/1.1\r\n"
+                    b"Host: localhost\r\n"
+                    b"Content-Type: application/json\r\n"
+                    b"Content-Length: %d\r\n\r\n%s" % (len(body), body)
+                )
+                status_line = await reader.readline()
+                length, close = 0, False
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b""):
+                        break
+                    name, _, value = line.decode().partition(":")
+                    if name.lower() == "content-length":
+                        length = int(value)
+                    elif name.lower() == "connection":
+                        close = value.strip().lower() == "close"
+                await reader.readexactly(length)
+                results.append(
+                    (int(status_line.split()[1]), time.perf_counter() - start)
+                )
+                if close:
+                    # gunicorn's sync workers do not keep connections alive
+                    writer.close()
+                    reader = writer = None
+        finally:
+            if writer is not None:
+                writer.close()
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--voters", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--modes", nargs="+", default=list(SERVERS), choices=list(SERVERS)
+    )
+    args = parser.parse_args()
+
+    vote = Votes.objects.create(
+        title="benchmark",
+        description="",
+        first_option="cats",
+        second_option="dogs",
+    )
+    emails = [f"benchmark{i}@example.com" for i in range(args.voters)]
+    Emails.objects.bulk_create(
+        [Emails(email=email, is_active=True) for email in emails],
+        ignore_conflicts=True,
+    )
+    # bulk_create skips `Emails.save`, which caches the emails
+    add_to_email_filter(*emails)
+    cache_email_identities(
+        Emails.objects.filter(email__in=emails).values_list(
+            "email", "id", "is_active"
+        )
+    )
+    bodies = [
+        json.dumps(
+            {
+                "email": random.choice(emails),
+                "user_choice": random.choice(vote.options),
+                "vote_id": vote.id,
+            }
+        ).encode()
+        for _ in range(args.requests)
+    ]
+
+    try:
+        for mode in args.modes:
+            server = start_server(mode, args.port, args.workers)
+            try:
+                # warm up the workers' caches and connections
+                asyncio.run(send_votes(args.port, bodies[:200], 20))
+                start = time.perf_counter()
+                results = asyncio.run(
+                    send_votes(args.port, bodies, args.concurrency)
+                )
+                elapsed = time.perf_counter() - start
+            finally:
+                server.terminate()
+                server.wait()
+
+            latencies = sorted(seconds for _, seconds in results)
+            failed = sum(status != 200 for status, _ in results)
+            p99 = latencies[int(len(latencies) * 0.99) - 1]
+            print(
+                f"{mode:>6}: {len(results) / elapsed:.0f} requests/s, "
+                f"p50 {statistics.median(latencies) * 1000:.1f}ms, "
+                f"p99 {p99 * 1000:.1f}ms, {failed} failed"
+            )
+    finally:
+        Voters.objects.filter(vote=vote).delete()
+        vote.delete()
+        Emails.objects.filter(email__in=emails).delete()
+        for email in emails:
+            forget_email_identity(email)
+
+
+if __name__ == "__main__":
+    main()
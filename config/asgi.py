@@ -3,6 +3,14 @@ ASGI config for config project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Live vote results (`/api/vote/<vote_id>/live/`) are streamed by
+`votes.live.live_results_app`. With `ASYNC_API` on, votes and email
+verification are handled on the event loop by the views in `ASYNC_VIEWS`
+(see `users.aio`). Both get the CORS headers of `config.cors`. Everything
+else is handled by django.
+Serve it with an ASGI worker, e.g.
+`gunicorn config.asgi:application -k uvicorn.workers.UvicornWorker`.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 """
@@ -13,4 +21,49 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from config.cors import with_cors_headers  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.urls import reverse  # noqa: E402
+from users.aio import (  # noqa: E402
+    CheckVerificationCodeAsyncView,
+    EmailAsyncView,
+    close_connections,
+)
+from votes.aio import VotesAsyncView  # noqa: E402
+from votes.live import LIVE_RESULTS_PATH, live_results_app  # noqa: E402
+
+ASYNC_VIEWS = {
+    reverse("vote"): VotesAsyncView(),
+    reverse("send-verification-code"): EmailAsyncView(),
+    reverse("check-verification-code"): CheckVerificationCodeAsyncView(),
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_connections()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] == "http":
+        match = LIVE_RESULTS_PATH.match(scope["path"])
+        if match:
+            vote_id = int(match.group("vote_id"))
+            return await live_results_app(
+                scope, receive, with_cors_headers(scope, send), vote_id
+            )
+
+        view = ASYNC_VIEWS.get(scope["path"])
+        if settings.ASYNC_API and view is not None and view.handles(scope):
+            return await view(scope, receive, with_cors_headers(scope, send))
+    return await django_application(scope, receive, send)
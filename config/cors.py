@@ -0,0 +1,91 @@
+"""CORS headers of the responses `config.asgi` sends without django
+
+`corsheaders.middleware.CorsMiddleware` only sees the requests django
+handles. The native async views and the live results streams are wrapped
+with `with_cors_headers`, which adds the headers the middleware would,
+from the same `CORS_*` settings. Preflight requests are always handled by
+django.
+"""
+
+import re
+from typing import List, Tuple
+from urllib.parse import urlparse
+
+from corsheaders.conf import conf
+from corsheaders.middleware import CorsMiddleware
+
+# only its matching of origins against the settings is used
+_cors_middleware = CorsMiddleware(lambda request: None)
+
+
+def _header(scope: dict, name: bytes) -> str:
+    for header, value in scope.get("headers", []):
+        if header == name:
+            return value.decode("latin1")
+    return ""
+
+
+def cors_headers(scope: dict) -> List[Tuple[bytes, bytes]]:
+    """Headers `CorsMiddleware` adds to the response of a request
+
+    Args:
+        scope (dict): ASGI connection scope
+
+    Returns:
+        List[Tuple[bytes, bytes]]: ASGI response headers
+    """
+    if not re.match(conf.CORS_URLS_REGEX, scope["path"]):
+        return []
+    headers = [(b"vary", b"Origin")]
+    origin = _header(scope, b"origin")
+    if not origin:
+        return headers
+    try:
+        url = urlparse(origin)
+    except ValueError:
+        return headers
+
+    if conf.CORS_ALLOW_CREDENTIALS:
+        headers.append((b"access-control-allow-credentials", b"true"))
+    if not conf.CORS_ALLOW_ALL_ORIGINS and not (
+        _cors_middleware.origin_found_in_white_lists(origin, url)
+    ):
+        return headers
+
+    if conf.CORS_ALLOW_ALL_ORIGINS and not conf.CORS_ALLOW_CREDENTIALS:
+        headers.append((b"access-control-allow-origin", b"*"))
+    else:
+        headers.append((b"access-control-allow-origin", origin.encode()))
+    if conf.CORS_EXPOSE_HEADERS:
+        headers.append(
+            (
+                b"access-control-expose-headers",
+                ", ".join(conf.CORS_EXPOSE_HEADERS).encode(),
+            )
+        )
+    return headers
+
+
+def with_cors_headers(scope: dict, send):
+    """ASGI send channel adding `cors_headers` to the response
+
+    Args:
+        scope (dict): ASGI connection scope
+        send (Callable): ASGI send channel
+
+    Returns:
+        Callable: ASGI send channel
+    """
+    headers = cors_headers(scope)
+    if not headers:
+        return send
+
+    async def send_with_cors(message):
+        if message["type"] == "http.response.start":
+            message = {
+                **message,
+                "headers": [*message.get("headers", []), *headers],
+            }
+        await send(message)
+
+    return send_with_cors
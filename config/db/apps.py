@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class DbConfig(AppConfig):
+    """The database backend, installed as an app for its management
+    commands"""
+
+    name = "config.db"
+    label = "db"
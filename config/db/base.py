@@ -0,0 +1,150 @@
+"""PostgreSQL backend taking its connections from a per-process pool
+
+Used as `"ENGINE": "config.db"` and configured by the `POOL` entry of the
+database settings::
+
+    "POOL": {
+        "MIN_SIZE": 1,          # idle connections kept open
+        "MAX_SIZE": 10,         # connections per process, 0 disables pooling
+        "TIMEOUT": 5,           # seconds to wait for a connection when full
+        "PRE_PING": True,       # check idle connections before reuse
+        "MAX_LIFETIME": 1800,   # seconds before a connection is replaced
+        "MAX_IDLE": 300,        # seconds before an extra idle one is closed
+    }
+
+Django closes its connection at the end of every request (`CONN_MAX_AGE`
+0), which returns it to the pool, so a process never holds more than
+`MAX_SIZE` connections whatever its number of threads.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.db.backends.base.base import NO_DB_ALIAS
+from django.db.backends.postgresql import base, creation
+from redis import RedisError
+
+from .pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+POOL_STATS_KEY = "db:pool:stats"
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pools() -> Dict[str, ConnectionPool]:
+    """Pools of this process by database alias"""
+    pid = os.getpid()
+    with _pools_lock:
+        return {
+            alias: pool
+            for (pool_pid, alias, _), pool in _pools.items()
+            if pool_pid == pid
+        }
+
+
+def close_pools(alias: Optional[str] = None):
+    """Close the idle connections of the pools of `alias`, or of every pool
+    of this process, and forget the pools, e.g. before dropping a database"""
+    pid = os.getpid()
+    with _pools_lock:
+        keys = [
+            key for key in _pools if key[0] == pid and alias in (None, key[1])
+        ]
+        pools = [_pools.pop(key) for key in keys]
+    for pool in pools:
+        pool.close()
+
+
+def publish_pool_stats(alias: str, pool: ConnectionPool):
+    """Record the stats of `pool` in Redis for `manage.py db_pool_stats`,
+    at most once every `DB_POOL_STATS_INTERVAL` seconds"""
+    now = time.monotonic()
+    if now - getattr(pool, "published_at", -1e9) < (
+        settings.DB_POOL_STATS_INTERVAL
+    ):
+        return
+    pool.published_at = now
+
+    # the users app is not loaded yet when the backend is imported
+    from users.utils import get_redis
+
+    process = f"{socket.gethostname()}:{os.getpid()}:{alias}"
+    try:
+        get_redis().hset(
+            POOL_STATS_KEY,
+            process,
+            json.dumps({**pool.stats(), "at": time.time()}),
+        )
+    except RedisError:
+        logger.warning("Could not publish the stats of the %s pool", alias)
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # the pooled connections, including those of the aliases mirroring
+        # this one, would keep the database in use
+        close_pools()
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    _pool = None
+
+    def get_pool(self, conn_params: dict) -> Optional[ConnectionPool]:
+        """Pool of this process for `conn_params`, None if pooling is off"""
+        options = self.settings_dict.get("POOL") or {}
+        if self.alias == NO_DB_ALIAS or not options.get("MAX_SIZE"):
+            return None
+
+        # the test runner switches NAME to the test database
+        key = (os.getpid(), self.alias, repr(sorted(conn_params.items())))
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(
+                    lambda: super(DatabaseWrapper, self).get_new_connection(
+                        conn_params
+                    ),
+                    min_size=options.get("MIN_SIZE", 0),
+                    max_size=options["MAX_SIZE"],
+                    timeout=options.get("TIMEOUT", 5),
+                    pre_ping=options.get("PRE_PING", True),
+                    max_lifetime=options.get("MAX_LIFETIME"),
+                    max_idle=options.get("MAX_IDLE"),
+                )
+        return pool
+
+    def get_new_connection(self, conn_params):
+        pool = self.get_pool(conn_params)
+        if pool is None:
+            return super().get_new_connection(conn_params)
+
+        connection = pool.getconn()
+        # set by the parent for whichever wrapper opened the connection
+        self.isolation_level = self.settings_dict["OPTIONS"].get(
+            "isolation_level", connection.isolation_level
+        )
+        self._pool = pool
+        return connection
+
+    def _close(self):
+        pool, self._pool = self._pool, None
+        if pool is None:
+            return super()._close()
+
+        with self.wrap_database_errors:
+            # django keeps the connection of a transaction it closes,
+            # it must not be handed out again
+            pool.putconn(self.connection, close=self.in_atomic_block)
+        publish_pool_stats(self.alias, pool)
@@ -0,0 +1,63 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from config.db.base import POOL_STATS_KEY
+from users.utils import get_redis
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the database connection pool of every gunicorn and celery "
+        "process, as last recorded in Redis"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max-age",
+            type=float,
+            default=max(settings.DB_POOL_STATS_INTERVAL * 3, 60),
+            help="seconds after which a process that recorded nothing is "
+            "considered gone and removed (default: 3 DB_POOL_STATS_INTERVAL "
+            "or a minute)",
+        )
+
+    def handle(self, *args, **options):
+        client = get_redis()
+        now = time.time()
+        processes = {}
+        for process, stats in sorted(client.hgetall(POOL_STATS_KEY).items()):
+            stats = json.loads(stats)
+            if now - stats["at"] > options["max_age"]:
+                client.hdel(POOL_STATS_KEY, process)
+            else:
+                processes[process.decode()] = stats
+
+        if not processes:
+            self.stdout.write("No pool stats recorded.")
+            return
+
+        for process, stats in processes.items():
+            self.stdout.write(
+                f"{process}: {stats['in_use']}/{stats['max_size']} in use, "
+                f"{stats['idle']} idle, {stats['waiting']} waiting, "
+                f"{stats['checkouts']} checkouts, {stats['waits']} waits "
+                f"({stats['wait_seconds']:.3f}s), {stats['timeouts']} "
+                f"timeouts, {stats['connects']} connects, "
+                f"{stats['discards']} discards"
+            )
+
+        in_use = sum(stats["in_use"] for stats in processes.values())
+        max_size = sum(stats["max_size"] for stats in processes.values())
+        checkouts = sum(stats["checkouts"] for stats in processes.values())
+        waits = sum(stats["waits"] for stats in processes.values())
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{len(processes)} processes, {in_use}/{max_size} connections "
+                f"in use ({in_use / max_size:.0%}), "
+                f"{waits / checkouts if checkouts else 0:.1%} of checkouts "
+                "waited for a connection."
+            )
+        )
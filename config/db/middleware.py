@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.http import HttpResponse
+
+from .routers import use_replicas
+
+PRIMARY_COOKIE = "read_primary"
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class ReplicaMiddleware:
+    """Read from the replicas during safe requests
+
+    A client that wrote gets the `read_primary` cookie for
+    `DB_REPLICA_STICKY_SECONDS`, its reads go to the primary meanwhile so
+    it sees its own writes whatever the replication lag. A browser app on
+    another origin has to send its requests with credentials, e.g.
+    `fetch(url, {credentials: "include"})` (see `CORS_ALLOW_CREDENTIALS`).
+    The cookie is `SameSite=Lax`, so the app also has to be on the same
+    site as the API, e.g. on a subdomain.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        allowed = (
+            request.method in SAFE_METHODS
+            and PRIMARY_COOKIE not in request.COOKIES
+        )
+        with use_replicas(allowed):
+            response = self.get_response(request)
+
+        if (
+            request.method not in SAFE_METHODS
+            and response.status_code < 400
+            and settings.DATABASE_REPLICAS
+        ):
+            set_primary_cookie(response)
+        return response
+
+
+def set_primary_cookie(response):
+    response.set_cookie(
+        PRIMARY_COOKIE,
+        "1",
+        max_age=settings.DB_REPLICA_STICKY_SECONDS,
+        httponly=True,
+        samesite="Lax",
+    )
+
+
+def primary_cookie_header() -> str:
+    """`Set-Cookie` header of the cookie, for responses built without django"""
+    response = HttpResponse()
+    set_primary_cookie(response)
+    return response.cookies[PRIMARY_COOKIE].OutputString()
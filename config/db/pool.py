@@ -0,0 +1,252 @@
+import collections
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    """No connection was returned to a full pool in time"""
+
+
+Idle = collections.namedtuple("Idle", ("connection", "created", "returned"))
+
+
+class ConnectionPool:
+    """Thread-safe pool of at most `max_size` connections made by `connect`
+
+    Connections are opened on demand, a caller finding the pool full waits
+    up to `timeout` seconds for one to be returned. Idle connections beyond
+    `min_size` are closed after `max_idle` seconds, any connection is
+    replaced after `max_lifetime` seconds, and with `pre_ping` an idle
+    connection is checked with `SELECT 1` before it is handed out.
+
+    A pool belongs to the process that created it. A forked child (e.g. a
+    gunicorn or celery worker) must not use the connections it inherited,
+    they share their socket with the parent, so the pool keeps them
+    untouched and the child creates a pool of its own.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], "psycopg2.extensions.connection"],
+        min_size: int = 0,
+        max_size: int = 10,
+        timeout: float = 5,
+        pre_ping: bool = True,
+        max_lifetime: Optional[float] = None,
+        max_idle: Optional[float] = None,
+    ):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.pre_ping = pre_ping
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.pid = os.getpid()
+
+        self._cond = threading.Condition()
+        # most recently returned last, handed out first so the extra
+        # connections of a burst go idle and get closed
+        self._idle = collections.deque()
+        self._created = {}
+        self._orphans = []
+        self._size = 0
+        self._waiting = 0
+        self._closed = False
+        self._counters = collections.Counter()
+
+    def getconn(self) -> "psycopg2.extensions.connection":
+        """Check out a connection
+
+        Raises:
+            PoolTimeout: the pool stayed full for `timeout` seconds
+            psycopg2.Error: a new connection could not be opened
+
+        Returns:
+            psycopg2.extensions.connection: connection
+        """
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if self._closed or remaining <= 0:
+                        self._counters["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"no connection available within {self.timeout}s "
+                            f"({self.max_size} in use)"
+                        )
+                    if not waited:
+                        waited = True
+                        self._counters["waits"] += 1
+                    self._waiting += 1
+                    start = time.monotonic()
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+                        self._counters["wait_seconds"] += (
+                            time.monotonic() - start
+                        )
+
+                if self._idle:
+                    idle = self._idle.pop()
+                else:
+                    idle = None
+                    self._size += 1
+
+            if idle is None:
+                connection = self._open()
+            elif self._is_usable(idle):
+                connection = idle.connection
+            else:
+                self._discard(idle.connection)
+                continue
+            with self._cond:
+                self._counters["checkouts"] += 1
+            return connection
+
+    def putconn(
+        self, connection: "psycopg2.extensions.connection", close: bool = False
+    ):
+        """Return a connection checked out with `getconn`
+
+        Args:
+            connection (psycopg2.extensions.connection): connection
+            close (bool): close it instead of keeping it for reuse
+        """
+        if os.getpid() != self.pid:
+            # inherited from the parent process, see the class docstring
+            self._orphans.append(connection)
+            return
+
+        now = time.monotonic()
+        if not close:
+            close = self._closed or self._is_expired(connection, now)
+        if not close:
+            try:
+                if connection.info.transaction_status != (
+                    TRANSACTION_STATUS_IDLE
+                ):
+                    connection.rollback()
+                if not connection.autocommit:
+                    connection.autocommit = True
+            except psycopg2.Error:
+                close = True
+        if close:
+            self._discard(connection)
+            return
+
+        with self._cond:
+            self._idle.append(Idle(connection, self._created[connection], now))
+            stale = self._pop_stale(now)
+            self._cond.notify()
+        for connection in stale:
+            self._discard(connection)
+
+    def close(self):
+        """Close the idle connections, the connections in use are closed
+        when they are returned"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, collections.deque()
+            self._cond.notify_all()
+        if os.getpid() != self.pid:
+            self._orphans.extend(connection for connection, *_ in idle)
+            return
+        for connection, *_ in idle:
+            self._discard(connection)
+
+    def stats(self) -> Dict[str, float]:
+        """Size of the pool and totals since it was created
+
+        Returns:
+            dict: `size` open connections of `max_size`, `in_use`, `idle`,
+            `waiting` callers, and the totals of `checkouts`, `waits` for a
+            full pool, `wait_seconds`, `timeouts`, `connects` and
+            `discards` of broken, expired or long idle connections
+        """
+        with self._cond:
+            return {
+                "max_size": self.max_size,
+                "size": self._size,
+                "in_use": self._size - len(self._idle),
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                **{
+                    name: self._counters[name]
+                    for name in (
+                        "checkouts",
+                        "waits",
+                        "wait_seconds",
+                        "timeouts",
+                        "connects",
+                        "discards",
+                    )
+                },
+            }
+
+    def _open(self) -> "psycopg2.extensions.connection":
+        try:
+            connection = self.connect()
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created[connection] = time.monotonic()
+            self._counters["connects"] += 1
+        return connection
+
+    def _is_usable(self, idle: Idle) -> bool:
+        if idle.connection.closed or self._is_expired(
+            idle.connection, time.monotonic()
+        ):
+            return False
+        if not self.pre_ping:
+            return True
+        try:
+            with idle.connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _is_expired(
+        self, connection: "psycopg2.extensions.connection", now: float
+    ) -> bool:
+        return (
+            self.max_lifetime is not None
+            and now - self._created[connection] >= self.max_lifetime
+        )
+
+    def _pop_stale(self, now: float) -> list:
+        """Idle connections beyond `min_size` unused for `max_idle`"""
+        stale = []
+        if self.max_idle is None:
+            return stale
+        while (
+            self._idle
+            and self._size - len(stale) > self.min_size
+            and now - self._idle[0].returned >= self.max_idle
+        ):
+            stale.append(self._idle.popleft().connection)
+        return stale
+
+    def _discard(self, connection: "psycopg2.extensions.connection"):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._created.pop(connection, None)
+            self._size -= 1
+            self._counters["discards"] += 1
+            self._cond.notify()
@@ -0,0 +1,125 @@
+"""Send reads to the replicas of `DATABASE_REPLICAS`
+
+Reads only go to a replica inside `use_replicas()`, which
+`config.db.middleware.ReplicaMiddleware` enters for the safe requests of
+clients that did not write recently. Everything else (writes, celery
+tasks, management commands) uses the primary, `default`. A replica
+lagging more than `DB_REPLICA_MAX_LAG` seconds behind, or unreachable, is
+left out until its next check.
+"""
+
+import contextlib
+import contextvars
+import logging
+import random
+import threading
+import time
+from typing import List
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+# seconds the replica is behind, 0 when it replayed everything it received,
+# NULL when it is not streaming from the primary: it then receives nothing
+# and would look up to date however far behind it falls
+REPLICA_LAG_SQL = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN NOT EXISTS (
+        SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming'
+    ) THEN NULL
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+"""
+
+_replicas_allowed = contextvars.ContextVar("replicas_allowed", default=False)
+
+
+@contextlib.contextmanager
+def use_replicas(allowed: bool = True):
+    """Let the reads of the block go to a replica, or force them to the
+    primary with `allowed=False`, e.g. to fill a shared cache"""
+    token = _replicas_allowed.set(allowed)
+    try:
+        yield
+    finally:
+        _replicas_allowed.reset(token)
+
+
+class ReplicaHealth:
+    """Replicas of this process that are not lagging, each checked at most
+    once every `DB_REPLICA_CHECK_INTERVAL` seconds"""
+
+    def __init__(self):
+        self._healthy = {}
+        self._checked_at = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        self._healthy.clear()
+        self._checked_at.clear()
+
+    def healthy(self) -> List[str]:
+        """Aliases of the usable replicas"""
+        now = time.monotonic()
+        healthy = []
+        for alias in settings.DATABASE_REPLICAS:
+            checked_at = self._checked_at.get(alias)
+            if (
+                checked_at is None
+                or now - checked_at >= settings.DB_REPLICA_CHECK_INTERVAL
+            ) and self._lock.acquire(blocking=False):
+                # other threads keep the last result meanwhile
+                try:
+                    self._healthy[alias] = self.check(alias)
+                    self._checked_at[alias] = now
+                finally:
+                    self._lock.release()
+            if self._healthy.get(alias):
+                healthy.append(alias)
+        return healthy
+
+    def check(self, alias: str) -> bool:
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(REPLICA_LAG_SQL)
+                lag = cursor.fetchone()[0]
+        except DatabaseError:
+            logger.warning("Replica %s is unavailable", alias, exc_info=True)
+            return False
+        if lag is None:
+            logger.warning(
+                "Replica %s is not streaming from the primary", alias
+            )
+            return False
+        if lag > settings.DB_REPLICA_MAX_LAG:
+            logger.warning("Replica %s is %.1fs behind", alias, lag)
+            return False
+        return True
+
+
+replica_health = ReplicaHealth()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not _replicas_allowed.get() or (
+            connections[DEFAULT_DB_ALIAS].in_atomic_block
+        ):
+            return DEFAULT_DB_ALIAS
+        replicas = replica_health.healthy()
+        return random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # whatever the request reads next has to see this write
+        _replicas_allowed.set(False)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
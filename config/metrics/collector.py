@@ -0,0 +1,210 @@
+"""Per-view histograms of `RequestMetrics`, aggregated across processes
+
+Every process adds its requests to histograms of its own and, at most once
+every `METRICS_FLUSH_INTERVAL` seconds, adds them to the totals in Redis
+with `HINCRBY`/`HINCRBYFLOAT`, so the totals of all the gunicorn workers
+add up without any coordination between them. `render()` reads the totals
+in the Prometheus text format, along with the connection pool stats
+recorded by `config.db.base.publish_pool_stats`.
+"""
+
+import bisect
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from config.db.base import POOL_STATS_KEY
+from django.conf import settings
+from redis import RedisError
+
+from .instruments import RequestMetrics
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY = "metrics:requests"
+
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNTS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# name, help, attribute of `RequestMetrics`, bucket upper bounds
+HISTOGRAMS = (
+    (
+        "request_duration_seconds",
+        "Time to handle a request.",
+        "duration",
+        SECONDS,
+    ),
+    (
+        "request_db_queries",
+        "Database queries per request.",
+        "db_queries",
+        COUNTS,
+    ),
+    (
+        "request_db_seconds",
+        "Time spent in database queries per request.",
+        "db_seconds",
+        SECONDS,
+    ),
+    (
+        "request_redis_round_trips",
+        "Redis round trips per request.",
+        "redis_round_trips",
+        COUNTS,
+    ),
+    (
+        "request_redis_seconds",
+        "Time spent waiting for Redis per request.",
+        "redis_seconds",
+        SECONDS,
+    ),
+    (
+        "request_celery_publish_seconds",
+        "Time spent publishing Celery tasks per request that published one.",
+        "celery_seconds",
+        SECONDS,
+    ),
+)
+
+# field of a pool stat, name, type, help
+POOL_METRICS = (
+    ("max_size", "db_pool_max_size", "gauge", "Connections allowed."),
+    ("in_use", "db_pool_in_use", "gauge", "Connections checked out."),
+    ("idle", "db_pool_idle", "gauge", "Connections open and not in use."),
+    ("waiting", "db_pool_waiting", "gauge", "Callers waiting for one."),
+    ("checkouts", "db_pool_checkouts_total", "counter", "Checkouts."),
+    ("waits", "db_pool_waits_total", "counter", "Checkouts that waited."),
+    (
+        "wait_seconds",
+        "db_pool_wait_seconds_total",
+        "counter",
+        "Time spent waiting for a connection.",
+    ),
+    ("timeouts", "db_pool_timeouts_total", "counter", "Checkouts timed out."),
+)
+
+
+def _field(name: str, view: str, method: str, bucket: str) -> str:
+    return "\t".join((name, view, method, bucket))
+
+
+def _labels(**labels) -> str:
+    return ",".join(
+        '{}="{}"'.format(
+            name,
+            value.replace("\\", "\\\\")
+            .replace('"', '\\"')
+            .replace("\n", "\\n"),
+        )
+        for name, value in labels.items()
+    )
+
+
+class Collector:
+    """Histograms of the requests of this process not yet added to Redis"""
+
+    def __init__(self):
+        self._pending = defaultdict(int)
+        self._lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    def observe(self, view: str, method: str, metrics: RequestMetrics):
+        """Count a request
+
+        Args:
+            view (str): dotted path of the view
+            method (str): HTTP method
+            metrics (RequestMetrics): what the request spent
+        """
+        with self._lock:
+            for name, _, attribute, buckets in HISTOGRAMS:
+                if attribute == "celery_seconds" and not (
+                    metrics.celery_publishes
+                ):
+                    continue
+                value = getattr(metrics, attribute)
+                index = bisect.bisect_left(buckets, value)
+                bucket = str(buckets[index]) if index < len(buckets) else "+Inf"
+                self._pending[_field(name, view, method, bucket)] += 1
+                self._pending[_field(name, view, method, "sum")] += float(value)
+
+    def flush_due(self) -> bool:
+        return (
+            time.monotonic() - self._flushed_at
+            >= settings.METRICS_FLUSH_INTERVAL
+        )
+
+    def flush(self, force: bool = False):
+        """Add the requests counted since the last flush to the totals in
+        Redis, if `METRICS_FLUSH_INTERVAL` seconds have passed or `force`"""
+        with self._lock:
+            if not force and not self.flush_due():
+                return
+            pending, self._pending = self._pending, defaultdict(int)
+            self._flushed_at = time.monotonic()
+        if not pending:
+            return
+
+        # the users app is not loaded yet when the middleware is imported
+        from users.utils import get_redis
+
+        pipe = get_redis().pipeline(transaction=False)
+        for field, value in pending.items():
+            if isinstance(value, float):
+                pipe.hincrbyfloat(METRICS_KEY, field, value)
+            else:
+                pipe.hincrby(METRICS_KEY, field, value)
+        try:
+            pipe.execute()
+        except RedisError:
+            logger.warning("Could not record the request metrics")
+
+
+collector = Collector()
+
+
+def render() -> str:
+    """Totals of every process in the Prometheus text format, including
+    the requests of this process not flushed yet
+
+    Raises:
+        RedisError: Redis is unavailable
+    """
+    from users.utils import get_redis
+
+    collector.flush(force=True)
+    client = get_redis()
+    totals = defaultdict(dict)
+    for field, value in client.hgetall(METRICS_KEY).items():
+        name, view, method, bucket = field.decode().split("\t")
+        totals[name, view, method][bucket] = float(value)
+
+    lines = []
+    for name, help_text, _, buckets in HISTOGRAMS:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for (series, view, method), values in sorted(totals.items()):
+            if series != name:
+                continue
+            labels = _labels(view=view, method=method)
+            count = 0
+            for bucket in [*map(str, buckets), "+Inf"]:
+                count += int(values.get(bucket, 0))
+                lines.append(f'{name}_bucket{{{labels},le="{bucket}"}} {count}')
+            lines.append(f"{name}_sum{{{labels}}} {values.get('sum', 0)}")
+            lines.append(f"{name}_count{{{labels}}} {count}")
+
+    # processes that did not record their pool lately are gone
+    max_age = max(settings.DB_POOL_STATS_INTERVAL * 3, 60)
+    now = time.time()
+    pools = {}
+    for process, stats in sorted(client.hgetall(POOL_STATS_KEY).items()):
+        stats = json.loads(stats)
+        if now - stats["at"] <= max_age:
+            pools[process.decode()] = stats
+    for field, name, kind, help_text in POOL_METRICS:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for process, stats in pools.items():
+            lines.append(f"{name}{{{_labels(process=process)}}} {stats[field]}")
+    return "\n".join(lines) + "\n"
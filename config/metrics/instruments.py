@@ -0,0 +1,192 @@
+"""Count what a request spends in Postgres, Redis and Celery
+
+`measure()` is entered around every request, by
+`config.metrics.middleware.MetricsMiddleware` and `users.aio.AsyncAPIView`.
+Inside it, the hooks below add to the `RequestMetrics` of the request:
+
+- queries made through django, by an execute wrapper installed on every
+  database connection, and through asyncpg, by `AsyncpgConnection`
+- Redis round trips, by the connection classes of the Redis pools, a
+  pipeline or a script counting once
+- Celery publishes, by the `before_task_publish` and `after_task_publish`
+  signals
+
+Outside of a request the hooks only look up a context variable.
+"""
+
+import contextlib
+import contextvars
+import time
+
+import asyncpg
+import redis
+import redis.asyncio.connection
+from celery.signals import after_task_publish, before_task_publish
+from django.db.backends.signals import connection_created
+
+_current = contextvars.ContextVar("request_metrics", default=None)
+
+
+class RequestMetrics:
+    """Totals of a request, `duration` is set when `measure()` exits"""
+
+    __slots__ = (
+        "duration",
+        "db_queries",
+        "db_seconds",
+        "redis_round_trips",
+        "redis_seconds",
+        "celery_publishes",
+        "celery_seconds",
+        "publish_started",
+    )
+
+    def __init__(self):
+        self.duration = 0.0
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.redis_round_trips = 0
+        self.redis_seconds = 0.0
+        self.celery_publishes = 0
+        self.celery_seconds = 0.0
+        self.publish_started = None
+
+
+@contextlib.contextmanager
+def measure():
+    """Record the work of the block, in this thread or task and in those
+    it hands work to, e.g. with `sync_to_async`"""
+    metrics = RequestMetrics()
+    token = _current.set(metrics)
+    started = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        metrics.duration = time.perf_counter() - started
+        _current.reset(token)
+
+
+def _add_query(started: float):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.db_queries += 1
+        metrics.db_seconds += time.perf_counter() - started
+
+
+def _add_redis(started: float, round_trips: int):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.redis_round_trips += round_trips
+        metrics.redis_seconds += time.perf_counter() - started
+
+
+def record_query(execute, sql, params, many, context):
+    """Execute wrapper of the django connections"""
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        _add_query(started)
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+connection_created.connect(install_query_recorder)
+
+
+class AsyncpgConnection(asyncpg.Connection):
+    """asyncpg connection counting its queries, see `users.aio.get_db_pool`"""
+
+    async def execute(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().execute(*args, **kwargs)
+        finally:
+            _add_query(started)
+
+    async def executemany(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().executemany(*args, **kwargs)
+        finally:
+            _add_query(started)
+
+    async def fetch(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().fetch(*args, **kwargs)
+        finally:
+            _add_query(started)
+
+    async def fetchval(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().fetchval(*args, **kwargs)
+        finally:
+            _add_query(started)
+
+    async def fetchrow(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().fetchrow(*args, **kwargs)
+        finally:
+            _add_query(started)
+
+
+# every command, pipeline or script is sent at once and its replies read
+# after, a send is a round trip and the time waiting for replies is counted
+
+
+class RedisConnection(redis.Connection):
+    """Connection of `users.utils.get_redis`"""
+
+    def send_packed_command(self, command, check_health=True):
+        started = time.perf_counter()
+        try:
+            return super().send_packed_command(command, check_health)
+        finally:
+            _add_redis(started, 1)
+
+    def read_response(self, disable_decoding=False):
+        started = time.perf_counter()
+        try:
+            return super().read_response(disable_decoding)
+        finally:
+            _add_redis(started, 0)
+
+
+class AsyncRedisConnection(redis.asyncio.connection.Connection):
+    """Connection of `users.aio.get_async_redis`"""
+
+    async def send_packed_command(self, command, check_health=True):
+        started = time.perf_counter()
+        try:
+            return await super().send_packed_command(command, check_health)
+        finally:
+            _add_redis(started, 1)
+
+    async def read_response(self, disable_decoding=False):
+        started = time.perf_counter()
+        try:
+            return await super().read_response(disable_decoding)
+        finally:
+            _add_redis(started, 0)
+
+
+@before_task_publish.connect
+def _publish_started(**kwargs):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.publish_started = time.perf_counter()
+
+
+@after_task_publish.connect
+def _publish_finished(**kwargs):
+    metrics = _current.get()
+    if metrics is not None and metrics.publish_started is not None:
+        metrics.celery_publishes += 1
+        metrics.celery_seconds += time.perf_counter() - metrics.publish_started
+        metrics.publish_started = None
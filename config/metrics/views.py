@@ -0,0 +1,38 @@
+import ipaddress
+
+from django.conf import settings
+from django.http import HttpResponse
+from redis import RedisError
+
+from .collector import render
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def is_internal(address: str) -> bool:
+    """Whether `address` is in one of the `METRICS_ALLOWED_NETWORKS`"""
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(
+        address in ipaddress.ip_network(network, strict=False)
+        for network in settings.METRICS_ALLOWED_NETWORKS
+    )
+
+
+def metrics_view(request):
+    """Request and connection pool metrics of every process for Prometheus
+
+    Only served to clients in `METRICS_ALLOWED_NETWORKS`, as seen by the
+    worker: a client behind a proxy is the proxy.
+    """
+    if not is_internal(request.META.get("REMOTE_ADDR", "")):
+        return HttpResponse(status=403)
+    try:
+        content = render()
+    except RedisError:
+        return HttpResponse(
+            "metrics unavailable\n", status=503, content_type=CONTENT_TYPE
+        )
+    return HttpResponse(content, content_type=CONTENT_TYPE)
@@ -28,6 +28,7 @@ INSTALLED_APPS = [
     "django.contrib.messages",
     "django.contrib.staticfiles",
     # locals
+    "config.db",
     "users",
     "votes",
     # 3rd party
@@ -36,7 +37,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "config.metrics.middleware.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    "config.db.middleware.ReplicaMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -70,16 +73,58 @@ WSGI_APPLICATION = "config.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
+# every process keeps at most DB_POOL_MAX_SIZE connections and reuses them
+# across requests, see `config.db.base`
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.postgresql",
+        "ENGINE": "config.db",
         "NAME": config("DB_NAME"),
         "USER": config("DB_USER"),
         "PASSWORD": config("DB_PASSWORD"),
         "HOST": config("DB_HOST"),
         "PORT": config("DB_PORT"),
+        "POOL": {
+            "MIN_SIZE": config("DB_POOL_MIN_SIZE", default=1, cast=int),
+            "MAX_SIZE": config("DB_POOL_MAX_SIZE", default=10, cast=int),
+            "TIMEOUT": config("DB_POOL_TIMEOUT", default=5, cast=float),
+            "PRE_PING": config("DB_POOL_PRE_PING", default=True, cast=bool),
+            "MAX_LIFETIME": config(
+                "DB_POOL_MAX_LIFETIME", default=30 * 60, cast=float
+            ),
+            "MAX_IDLE": config("DB_POOL_MAX_IDLE", default=5 * 60, cast=float),
+        },
     }
 }
+# seconds between two records of a process' pool stats in Redis
+DB_POOL_STATS_INTERVAL = config(
+    "DB_POOL_STATS_INTERVAL", default=10, cast=float
+)
+
+# read-only requests go to the replicas at DB_REPLICA_HOSTS (`host[:port]`,
+# same credentials as the primary), see `config.db.routers`
+DATABASE_REPLICAS = []
+for index, replica in enumerate(
+    config("DB_REPLICA_HOSTS", default="", cast=Csv())
+):
+    host, _, port = replica.partition(":")
+    DATABASES[f"replica{index}"] = {
+        **DATABASES["default"],
+        "HOST": host,
+        "PORT": port or DATABASES["default"]["PORT"],
+        "TEST": {"MIRROR": "default"},
+    }
+    DATABASE_REPLICAS.append(f"replica{index}")
+DATABASE_ROUTERS = ["config.db.routers.ReplicaRouter"]
+# a replica further behind than DB_REPLICA_MAX_LAG seconds is not read from,
+# a client reads from the primary for DB_REPLICA_STICKY_SECONDS after it
+# wrote, which should be more than the lag allowed plus the check interval
+DB_REPLICA_MAX_LAG = config("DB_REPLICA_MAX_LAG", default=2, cast=float)
+DB_REPLICA_CHECK_INTERVAL = config(
+    "DB_REPLICA_CHECK_INTERVAL", default=1, cast=float
+)
+DB_REPLICA_STICKY_SECONDS = config(
+    "DB_REPLICA_STICKY_SECONDS", default=5, cast=int
+)
 
 
 # Password validation
@@ -130,19 +175,144 @@ EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
 
 REST_FRAMEWORK = {
     "DEFAULT_THROTTLE_CLASSES": [
-        "rest_framework.throttling.ScopedRateThrottle",
+        "users.throttling.RedisScopedRateThrottle",
     ],
     "DEFAULT_THROTTLE_RATES": {
-        "email": "20/min",
+        "email": config("THROTTLE_EMAIL_RATE", default="20/min"),
+        "vote": config("THROTTLE_VOTE_RATE", default="60/min"),
     },
 }
 
+VOTES_PAGE_SIZE = config("VOTES_PAGE_SIZE", default=50, cast=int)
+VOTES_MAX_PAGE_SIZE = config("VOTES_MAX_PAGE_SIZE", default=200, cast=int)
+VOTES_BATCH_MAX_SIZE = config("VOTES_BATCH_MAX_SIZE", default=50, cast=int)
+VOTE_OPTIONS_CACHE_SIZE = config(
+    "VOTE_OPTIONS_CACHE_SIZE", default=10_000, cast=int
+)
+VOTE_OPTIONS_CACHE_TTL = config(
+    "VOTE_OPTIONS_CACHE_TTL", default=60, cast=float
+)
+VOTES_CATALOG_CACHE_TTL = config(
+    "VOTES_CATALOG_CACHE_TTL", default=60 * 60, cast=int
+)
+# seconds between keep-alive comments on idle live results streams
+VOTE_LIVE_KEEPALIVE = config("VOTE_LIVE_KEEPALIVE", default=15, cast=float)
+# "row" publishes one notification per written vote, "statement" one per vote
+# changed by a statement, applied by `manage.py set_vote_notify_mode`
+VOTE_NOTIFY_TRIGGER_MODE = config("VOTE_NOTIFY_TRIGGER_MODE", default="row")
+# live results are pushed at most once per window, whatever the write rate
+VOTE_LIVE_COALESCE_WINDOW_MS = config(
+    "VOTE_LIVE_COALESCE_WINDOW_MS", default=100, cast=int
+)
+
 REDIS_HOST = config("REDIS_HOST")
 REDIS_PORT = config("REDIS_PORT")
-VERIFICATION_CODE_EXPIRY = config("VERIFICATION_CODE_EXPIRY")
+REDIS_MAX_CONNECTIONS = config("REDIS_MAX_CONNECTIONS", default=50, cast=int)
+REDIS_POOL_TIMEOUT = config("REDIS_POOL_TIMEOUT", default=5, cast=float)
+
+# serve votes and email verification on the event loop under ASGI, with an
+# asyncpg pool of at most ASYNC_DB_POOL_SIZE connections per worker
+ASYNC_API = config("ASYNC_API", default=False, cast=bool)
+ASYNC_DB_POOL_SIZE = config("ASYNC_DB_POOL_SIZE", default=20, cast=int)
+VERIFICATION_CODE_EXPIRY = config("VERIFICATION_CODE_EXPIRY", cast=int)
+
+# lifetime of the token returned once an email is verified, tokens of an
+# email are revoked when it is deactivated or deleted
+VOTER_TOKEN_MAX_AGE = config("VOTER_TOKEN_MAX_AGE", default=60 * 60, cast=int)
+# seconds a voter token check trusts the revocation state of an email
+# cached in Redis, `Emails.tokens_revoked_at` is read again after that
+VOTER_TOKEN_REVOCATION_CACHE_TTL = config(
+    "VOTER_TOKEN_REVOCATION_CACHE_TTL", default=60, cast=int
+)
+EMAIL_IDENTITY_CACHE_TTL = config(
+    "EMAIL_IDENTITY_CACHE_TTL", default=7 * 24 * 60 * 60, cast=int
+)
+EMAIL_FILTER_CAPACITY = config(
+    "EMAIL_FILTER_CAPACITY", default=1_000_000, cast=int
+)
+EMAIL_FILTER_ERROR_RATE = config(
+    "EMAIL_FILTER_ERROR_RATE", default=0.01, cast=float
+)
 
 CELERY_BROKER_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}/0"
 
+# "direct" writes votes to the database in the request, "buffered" appends
+# them to a Redis stream that `votes.tasks.drain_vote_buffer` writes in batches
+VOTES_INGESTION_MODE = config("VOTES_INGESTION_MODE", default="direct")
+VOTES_INGEST_BATCH_SIZE = config(
+    "VOTES_INGEST_BATCH_SIZE", default=500, cast=int
+)
+VOTES_INGEST_FLUSH_INTERVAL = config(
+    "VOTES_INGEST_FLUSH_INTERVAL", default=1.0, cast=float
+)
+
+# "direct" sends every verification code over its own SMTP connection,
+# "batched" queues them and sends up to VERIFICATION_EMAIL_BATCH_SIZE codes
+# over one connection at least every VERIFICATION_EMAIL_MAX_LATENCY seconds,
+# "outbox" records them in Redis with the code and leaves publishing the
+# tasks to the `dispatch_verification_codes` command, which `run_celery.sh`
+# starts next to the worker
+VERIFICATION_EMAIL_DELIVERY = config(
+    "VERIFICATION_EMAIL_DELIVERY", default="direct"
+)
+VERIFICATION_EMAIL_BATCH_SIZE = config(
+    "VERIFICATION_EMAIL_BATCH_SIZE", default=100, cast=int
+)
+VERIFICATION_EMAIL_MAX_LATENCY = config(
+    "VERIFICATION_EMAIL_MAX_LATENCY", default=1.0, cast=float
+)
+# a queued code that failed to send this many times is moved out of the way,
+# to the `verification:mail:dead` list
+VERIFICATION_EMAIL_MAX_ATTEMPTS = config(
+    "VERIFICATION_EMAIL_MAX_ATTEMPTS", default=5, cast=int
+)
+
+VOTE_EVENTS_BATCH_SIZE = config(
+    "VOTE_EVENTS_BATCH_SIZE", default=1000, cast=int
+)
+VOTE_EVENTS_RETENTION_DAYS = config(
+    "VOTE_EVENTS_RETENTION_DAYS", default=7, cast=int
+)
+
+# the ballots of every vote have a partition of `votes_voters` of their own,
+# split by voter in VOTERS_HASH_PARTITIONS tables when more than 1, see
+# `votes.partitions`
+VOTERS_HASH_PARTITIONS = config("VOTERS_HASH_PARTITIONS", default=0, cast=int)
+# seconds attaching or detaching a partition waits for its locks before
+# trying again, at most VOTERS_PARTITION_LOCK_ATTEMPTS times
+VOTERS_PARTITION_LOCK_TIMEOUT = config(
+    "VOTERS_PARTITION_LOCK_TIMEOUT", default=2.0, cast=float
+)
+VOTERS_PARTITION_LOCK_ATTEMPTS = config(
+    "VOTERS_PARTITION_LOCK_ATTEMPTS", default=5, cast=int
+)
+
+# per-view latency, database, Redis and Celery histograms, added up across
+# processes in Redis every METRICS_FLUSH_INTERVAL seconds and served to
+# METRICS_ALLOWED_NETWORKS on /metrics, see `config.metrics`
+METRICS_ENABLED = config("METRICS_ENABLED", default=True, cast=bool)
+METRICS_FLUSH_INTERVAL = config(
+    "METRICS_FLUSH_INTERVAL", default=10, cast=float
+)
+METRICS_ALLOWED_NETWORKS = config(
+    "METRICS_ALLOWED_NETWORKS", default="127.0.0.1,::1", cast=Csv()
+)
+
+CELERY_BEAT_SCHEDULE = {
+    "drain-vote-buffer": {
+        "task": "votes.tasks.drain_vote_buffer",
+        "schedule": VOTES_INGEST_FLUSH_INTERVAL,
+    },
+    "prune-vote-events": {
+        "task": "votes.tasks.prune_vote_events",
+        "schedule": 60 * 60,
+    },
+    "send-queued-verification-codes": {
+        "task": "users.tasks.send_queued_verification_codes",
+        "schedule": VERIFICATION_EMAIL_MAX_LATENCY,
+    },
+}
+
 DEFAULT_FROM_EMAIL = "Vote App <vote@no-reply.com>"
 EMAIL_HOST = config("EMAIL_HOST")
 EMAIL_PORT = config("EMAIL_PORT")
@@ -153,3 +323,7 @@ EMAIL_USE_TLS = True
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
 ]
+# browsers only store and send back the `read_primary` cookie of
+# `config.db.middleware.ReplicaMiddleware` across origins when the request is
+# made with credentials, e.g. `fetch(url, {credentials: "include"})`
+CORS_ALLOW_CREDENTIALS = True
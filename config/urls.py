@@ -1,3 +1,4 @@
+from config.metrics.views import metrics_view
 from django.contrib import admin
 from django.urls import include, path
 from drf_yasg import openapi
@@ -20,6 +21,7 @@ urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/", include("users.urls")),
     path("api/", include("votes.urls")),
+    path("metrics", metrics_view, name="metrics"),
     # docs
     path(
         "swagger/",
@@ -4,7 +4,7 @@ if [ $USE_ENTRYPOINT ] && [ $USE_ENTRYPOINT == "True" ]
 then
 	python manage.py flush --no-input
     python manage.py migrate 
-    python add_trigger_function_sql.py
+    python manage.py set_vote_notify_mode
     python manage.py createsuperuser --email admin@local.com --username admin --no-input
     pytest
     python manage.py collectstatic --no-input
@@ -13,4 +13,7 @@ fi
 # check redis connection
 python -c "import redis; print('Checking Redis connection...', redis.Redis('$(echo $REDIS_HOST)').ping())"
 
+# restore the email cache and filter if Redis lost them
+python manage.py warm_email_cache
+
 exec "$@"
\ No newline at end of file
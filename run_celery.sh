@@ -1 +1,8 @@
-celery -A config worker -l INFO
\ No newline at end of file
+# with VERIFICATION_EMAIL_DELIVERY=outbox the verification emails recorded
+# in Redis are published to the broker by the dispatcher, next to the worker
+if [ "$(python -c "from decouple import config; print(config('VERIFICATION_EMAIL_DELIVERY', default='direct'))")" = "outbox" ]
+then
+    python manage.py dispatch_verification_codes &
+fi
+
+celery -A config worker -B -l INFO
@@ -0,0 +1,530 @@
+"""Native async request path, served by `config.asgi` when `ASYNC_API` is on
+
+The hot endpoints are handled on the event loop instead of a thread per
+request: Postgres is reached through an asyncpg pool and Redis through
+`redis.asyncio`, one of each per event loop. Keys, Lua scripts and
+response bodies are the same as the DRF views', so sync and async workers
+can serve the same deployment.
+
+`AsyncAPIView` is a small counterpart of a DRF `APIView` for JSON and form
+requests. The verification endpoints are defined here, the vote endpoint in
+`votes.aio`.
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import uuid
+import weakref
+from typing import Optional, Tuple
+from urllib.parse import parse_qsl
+
+import asyncpg
+import redis.asyncio
+from asgiref.sync import sync_to_async
+from config.db.middleware import primary_cookie_header
+from config.metrics.collector import collector
+from config.metrics.instruments import (
+    AsyncpgConnection,
+    AsyncRedisConnection,
+    measure,
+)
+from django.conf import settings
+from django.db import connections
+from rest_framework import status
+from rest_framework.exceptions import (
+    APIException,
+    AuthenticationFailed,
+    ParseError,
+    Throttled,
+)
+
+from .authentication import Voter, VoterTokenAuthentication
+from .mail import OUTBOX_CODE_SCRIPT, OUTBOX_KEY, is_outbox
+from .models import Emails
+from .serializer import CheckVerificationCodeSerializer, EmailSerializer
+from .tasks import deliver_verification_code
+from .throttling import SLIDING_WINDOW_SCRIPT, RedisScopedRateThrottle
+from .utils import (
+    ADD_TO_FILTER_SCRIPT,
+    EMAIL_IDENTITY_KEY,
+    USE_CODE_SCRIPT,
+    VERIFICATION_CODE_KEY,
+    VOTER_TOKEN_REVOKED_KEY,
+    EmailIdentity,
+    email_filter_key,
+    email_filter_offsets,
+    generate_verification_code,
+    issue_voter_token,
+    load_voter_token,
+    tokens_revoked_at,
+)
+
+logger = logging.getLogger(__name__)
+
+PARSED_CONTENT_TYPES = ("application/json", "application/x-www-form-urlencoded")
+
+_redis_clients = weakref.WeakKeyDictionary()
+_db_pools = weakref.WeakKeyDictionary()
+
+
+def get_async_redis() -> redis.asyncio.Redis:
+    """Redis client of the running event loop, with at most
+    `REDIS_MAX_CONNECTIONS` connections
+
+    Returns:
+        redis.asyncio.Redis: client
+    """
+    loop = asyncio.get_running_loop()
+    client = _redis_clients.get(loop)
+    if client is None:
+        pool = redis.asyncio.BlockingConnectionPool(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            db=0,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            connection_class=AsyncRedisConnection,
+        )
+        client = _redis_clients[loop] = redis.asyncio.Redis(
+            connection_pool=pool
+        )
+    return client
+
+
+@functools.lru_cache(maxsize=64)
+def _register_script(client: redis.asyncio.Redis, source: str):
+    return client.register_script(source)
+
+
+def get_async_script(source: str):
+    """Lua script bound to `get_async_redis()`"""
+    return _register_script(get_async_redis(), source)
+
+
+async def get_db_pool() -> asyncpg.Pool:
+    """asyncpg pool of the running event loop, connected to the `default`
+    database with at most `ASYNC_DB_POOL_SIZE` connections
+
+    Returns:
+        asyncpg.Pool: pool
+    """
+    loop = asyncio.get_running_loop()
+    pool = _db_pools.get(loop)
+    if pool is None:
+        params = connections["default"].get_connection_params()
+        pool = _db_pools[loop] = asyncio.ensure_future(
+            asyncpg.create_pool(
+                database=params.get("database"),
+                user=params.get("user"),
+                password=params.get("password") or None,
+                host=params.get("host") or None,
+                port=int(params["port"]) if params.get("port") else None,
+                min_size=1,
+                max_size=settings.ASYNC_DB_POOL_SIZE,
+                connection_class=AsyncpgConnection,
+            )
+        )
+    try:
+        return await pool
+    except Exception:
+        # try again on the next request
+        _db_pools.pop(loop, None)
+        raise
+
+
+async def close_connections():
+    """Close the Redis client and the database pool of the running event
+    loop, e.g. when the worker shuts down"""
+    loop = asyncio.get_running_loop()
+    client = _redis_clients.pop(loop, None)
+    if client is not None:
+        await client.close()
+        await client.connection_pool.disconnect()
+    pool = _db_pools.pop(loop, None)
+    if pool is not None and not pool.cancelled() and pool.done():
+        if pool.exception() is None:
+            await pool.result().close()
+
+
+class AsyncRequest:
+    """Parsed request handed to the handlers of an `AsyncAPIView`
+
+    Args:
+        scope (dict): ASGI connection scope
+        data (dict): parsed body
+    """
+
+    def __init__(self, scope: dict, data: dict):
+        self.scope = scope
+        self.method = scope["method"]
+        self.headers = {
+            name.decode("latin1"): value.decode("latin1")
+            for name, value in scope.get("headers", [])
+        }
+        self.data = data
+        self.user = None
+        self.auth = None
+
+    def get_ident(self) -> str:
+        # same as `rest_framework.throttling.BaseThrottle.get_ident`
+        xff = self.headers.get("x-forwarded-for")
+        if xff:
+            return "".join(xff.split())
+        client = self.scope.get("client")
+        return client[0] if client else ""
+
+
+def content_type(scope: dict) -> str:
+    for name, value in scope.get("headers", []):
+        if name == b"content-type":
+            return value.decode("latin1").split(";")[0].strip().lower()
+    return ""
+
+
+async def read_body(receive) -> Optional[bytes]:
+    """Read the request body, None if the client disconnected"""
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def send_json(send, status_code: int, data, headers: dict = None):
+    body = json.dumps(data).encode()
+    raw_headers = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode()),
+    ]
+    for name, value in (headers or {}).items():
+        raw_headers.append((name.lower().encode(), str(value).encode()))
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": raw_headers,
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def sliding_window_wait(scope: str, ident: str) -> Optional[float]:
+    """Count a request against the rate of a throttle scope, see
+    `users.throttling.RedisScopedRateThrottle`
+
+    Args:
+        scope (str): throttle scope
+        ident (str): id of the client
+
+    Returns:
+        Optional[float]: seconds to wait, None if the request is allowed
+    """
+    throttle = RedisScopedRateThrottle()
+    rate = throttle.THROTTLE_RATES.get(scope)
+    if rate is None:
+        return None
+    num_requests, duration = throttle.parse_rate(rate)
+    wait = await get_async_script(SLIDING_WINDOW_SCRIPT)(
+        keys=[throttle.cache_format % {"scope": scope, "ident": ident}],
+        args=[duration * 1000, num_requests, uuid.uuid4().hex],
+    )
+    return wait / 1000 if wait else None
+
+
+async def authenticate_voter(request: AsyncRequest) -> Optional[Voter]:
+    """Async `users.authentication.VoterTokenAuthentication.authenticate`
+
+    Raises:
+        AuthenticationFailed: the token is malformed, expired or revoked
+
+    Returns:
+        Optional[Voter]: voter or None if the request has no token
+    """
+    auth = request.headers.get("authorization", "").split()
+    keyword = VoterTokenAuthentication.keyword
+    if not auth or auth[0].lower() != keyword.lower():
+        return None
+    if len(auth) != 2:
+        raise AuthenticationFailed("invalid token header")
+
+    token = load_voter_token(auth[1])
+    if token is None:
+        raise AuthenticationFailed("invalid or expired token")
+
+    email_id, issued_at = token
+    client = get_async_redis()
+    key = VOTER_TOKEN_REVOKED_KEY.format(email_id=email_id)
+    try:
+        revoked_at = await client.get(key)
+    except redis.RedisError:
+        revoked_at = None
+    if revoked_at is None:
+        # see `users.models.EmailsManager.tokens_revoked_at`
+        async with (await get_db_pool()).acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT is_active, tokens_revoked_at "
+                f"FROM {Emails._meta.db_table} WHERE id = $1",
+                email_id,
+            )
+        revoked_at = tokens_revoked_at(*(row or (None, None)))
+        try:
+            await client.set(
+                key,
+                revoked_at,
+                ex=settings.VOTER_TOKEN_REVOCATION_CACHE_TTL,
+            )
+        except redis.RedisError:
+            pass
+    if issued_at <= int(revoked_at):
+        raise AuthenticationFailed("token revoked")
+    return Voter(email_id, True)
+
+
+class AsyncAPIView:
+    """Async counterpart of a DRF `APIView` for JSON and form requests
+
+    Subclasses define a coroutine per handled method (e.g. `post`) that
+    returns the status code and the body of the response. Errors are
+    reported the way DRF reports them.
+
+    Attributes:
+        throttle_scope (str): scope of `DEFAULT_THROTTLE_RATES`, the
+        request is counted in the same Redis key as the DRF views'
+        accept_voter_token (bool): authenticate requests sending a voter
+        token, see `users.authentication.VoterTokenAuthentication`
+    """
+
+    throttle_scope: Optional[str] = None
+    accept_voter_token = False
+
+    def handles(self, scope: dict) -> bool:
+        """Whether the request is served by this view rather than django"""
+        return hasattr(self, scope["method"].lower()) and (
+            content_type(scope) in PARSED_CONTENT_TYPES
+        )
+
+    async def __call__(self, scope, receive, send):
+        if not settings.METRICS_ENABLED:
+            return await self.respond(scope, receive, send)
+        with measure() as metrics:
+            await self.respond(scope, receive, send)
+        # see `config.metrics.middleware.MetricsMiddleware`
+        view = f"{type(self).__module__}.{type(self).__qualname__}"
+        collector.observe(view, scope["method"], metrics)
+        if collector.flush_due():
+            await sync_to_async(collector.flush, thread_sensitive=False)()
+
+    async def respond(self, scope, receive, send):
+        handler = getattr(self, scope["method"].lower())
+        body = await read_body(receive)
+        if body is None:
+            return
+
+        headers = {}
+        try:
+            request = await self.initial(scope, body)
+            status_code, data = await handler(request)
+        except APIException as exc:
+            status_code = exc.status_code
+            data = exc.detail
+            if not isinstance(data, (list, dict)):
+                data = {"detail": data}
+            if isinstance(exc, AuthenticationFailed):
+                headers["WWW-Authenticate"] = VoterTokenAuthentication.keyword
+            if getattr(exc, "wait", None):
+                headers["Retry-After"] = int(exc.wait)
+        except Exception:
+            # answered like the DRF views' errors, with the CORS headers the
+            # ASGI server would not add to its own 500
+            logger.exception("Internal Server Error: %s", scope["path"])
+            status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+            data = {"detail": str(APIException.default_detail)}
+        if status_code < 400 and settings.DATABASE_REPLICAS:
+            # see `config.db.middleware.ReplicaMiddleware`
+            headers["Set-Cookie"] = primary_cookie_header()
+        await send_json(send, status_code, data, headers)
+
+    async def initial(self, scope: dict, body: bytes) -> AsyncRequest:
+        try:
+            if content_type(scope) == "application/json":
+                data = json.loads(body or b"{}")
+            else:
+                data = dict(parse_qsl(body.decode()))
+        except ValueError as e:
+            raise ParseError(f"JSON parse error - {e}")
+        request = AsyncRequest(scope, data)
+
+        if self.accept_voter_token:
+            request.user = request.auth = await authenticate_voter(request)
+
+        if self.throttle_scope:
+            ident = request.user.pk if request.user else request.get_ident()
+            try:
+                wait = await sliding_window_wait(self.throttle_scope, ident)
+            except redis.RedisError:
+                wait = None
+            if wait is not None:
+                raise Throttled(wait)
+        return request
+
+
+class EmailAsyncView(AsyncAPIView):
+    """`users.api.EmailView`"""
+
+    throttle_scope = "email"
+
+    async def post(self, request: AsyncRequest) -> Tuple[int, dict]:
+        serializer = EmailSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user_email = serializer.data.get("email")
+
+        code = generate_verification_code()
+        if is_outbox():
+            issued = await get_async_script(OUTBOX_CODE_SCRIPT)(
+                keys=[
+                    VERIFICATION_CODE_KEY.format(email=user_email),
+                    OUTBOX_KEY,
+                ],
+                args=[
+                    code,
+                    settings.VERIFICATION_CODE_EXPIRY,
+                    json.dumps({"email": user_email, "code": code}),
+                ],
+            )
+        else:
+            issued = await get_async_redis().set(
+                VERIFICATION_CODE_KEY.format(email=user_email),
+                code,
+                ex=settings.VERIFICATION_CODE_EXPIRY,
+                nx=True,
+            )
+            if issued:
+                # publishing to the Celery broker blocks, only the outbox
+                # mode stays on the event loop
+                await sync_to_async(
+                    deliver_verification_code, thread_sensitive=False
+                )(user_email, code)
+        if not issued:
+            return status.HTTP_202_ACCEPTED, {
+                "detail": "please wait 120 seconds"
+            }
+
+        return status.HTTP_200_OK, {
+            "detail": f"please check your inbox at {user_email!r}"
+        }
+
+
+class CheckVerificationCodeAsyncView(AsyncAPIView):
+    """`users.api.CheckVerificationCodeView`"""
+
+    throttle_scope = "email"
+
+    async def post(self, request: AsyncRequest) -> Tuple[int, dict]:
+        serializer = CheckVerificationCodeSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        email = serializer.data.get("email")
+
+        used = await get_async_script(USE_CODE_SCRIPT)(
+            keys=[VERIFICATION_CODE_KEY.format(email=email)],
+            args=[str(serializer.data.get("code"))],
+        )
+        if not used:
+            return status.HTTP_401_UNAUTHORIZED, {
+                "detail": "Code is not correct"
+            }
+
+        identity = await activate_email(email)
+        return status.HTTP_200_OK, {
+            "detail": "successful",
+            "token": issue_voter_token(identity.id),
+            "expires_in": settings.VOTER_TOKEN_MAX_AGE,
+        }
+
+
+async def activate_email(email: str) -> EmailIdentity:
+    """Async `users.models.EmailsManager.activate`"""
+    table = Emails._meta.db_table
+    async with (await get_db_pool()).acquire() as conn:
+        email_id = await conn.fetchval(
+            f"INSERT INTO {table} (email, is_active, verified_at) "
+            "VALUES ($1, true, now()) "
+            "ON CONFLICT (email) "
+            "DO UPDATE SET is_active = true, verified_at = now() "
+            "RETURNING id",
+            email,
+        )
+
+    # the email is active whatever Redis does, see
+    # `users.models.remember_email`
+    client = get_async_redis()
+    try:
+        await client.set(
+            EMAIL_IDENTITY_KEY.format(email=email),
+            f"{email_id}:1",
+            ex=settings.EMAIL_IDENTITY_CACHE_TTL,
+        )
+    except redis.RedisError:
+        logger.warning(
+            "Could not cache the identity of an email", exc_info=True
+        )
+    key = email_filter_key()
+    try:
+        await get_async_script(ADD_TO_FILTER_SCRIPT)(
+            keys=[key], args=email_filter_offsets(email)
+        )
+    except redis.RedisError:
+        logger.warning("Could not add an email to the filter", exc_info=True)
+        # a filter missing the email would answer it does not exist, without
+        # one lookups read the database until it is rebuilt
+        try:
+            await client.delete(key)
+        except redis.RedisError:
+            logger.error(
+                "The email filter may miss emails until "
+                "`manage.py rebuild_email_filter` runs"
+            )
+    return EmailIdentity(email_id, True)
+
+
+async def lookup_email(email: str) -> Optional[EmailIdentity]:
+    """Async `users.models.EmailsManager.lookup`"""
+    key = email_filter_key()
+    try:
+        pipe = get_async_redis().pipeline(transaction=False)
+        pipe.get(EMAIL_IDENTITY_KEY.format(email=email))
+        pipe.exists(key)
+        for offset in email_filter_offsets(email):
+            pipe.getbit(key, offset)
+        cached, filter_exists, *filter_bits = await pipe.execute()
+    except redis.RedisError:
+        cached, filter_exists, filter_bits = None, False, []
+
+    if cached is not None:
+        email_id, is_active = cached.decode().split(":")
+        return EmailIdentity(int(email_id), is_active == "1")
+    if filter_exists and not all(filter_bits):
+        return None
+
+    async with (await get_db_pool()).acquire() as conn:
+        row = await conn.fetchrow(
+            f"SELECT id, is_active FROM {Emails._meta.db_table} "
+            "WHERE email = $1",
+            email,
+        )
+    if row is None:
+        return None
+    identity = EmailIdentity(row["id"], row["is_active"])
+    try:
+        await get_async_redis().set(
+            EMAIL_IDENTITY_KEY.format(email=email),
+            f"{identity.id}:{int(identity.is_active)}",
+            ex=settings.EMAIL_IDENTITY_CACHE_TTL,
+        )
+    except redis.RedisError:
+        pass
+    return identity
@@ -0,0 +1,64 @@
+from redis import RedisError
+from rest_framework.authentication import (
+    BaseAuthentication,
+    get_authorization_header,
+)
+from rest_framework.exceptions import AuthenticationFailed
+
+from .models import Emails
+from .utils import EmailIdentity, is_voter_token_revoked, load_voter_token
+
+
+class Voter(EmailIdentity):
+    """Identity of an email authenticated by a voter token, used as
+    `request.user`"""
+
+    __slots__ = ()
+
+    is_authenticated = True
+
+    @property
+    def pk(self) -> int:
+        return self.id
+
+
+class VoterTokenAuthentication(BaseAuthentication):
+    """Authenticate with the token returned by `check-verification-code`,
+    sent as `Authorization: Bearer <token>`
+
+    Revocations are recorded in `Emails.tokens_revoked_at` and cached in
+    Redis, the database is only read when the cache misses or Redis is
+    unavailable. Requests without a token are left to identify the email
+    in their body.
+    """
+
+    keyword = "Bearer"
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise AuthenticationFailed("invalid token header")
+
+        try:
+            token = load_voter_token(auth[1].decode())
+        except UnicodeError:
+            token = None
+        if token is None:
+            raise AuthenticationFailed("invalid or expired token")
+
+        email_id, issued_at = token
+        try:
+            revoked = is_voter_token_revoked(email_id, issued_at)
+        except RedisError:
+            revoked = None
+        if revoked is None:
+            revoked = issued_at <= Emails.objects.tokens_revoked_at(email_id)
+        if revoked:
+            raise AuthenticationFailed("token revoked")
+
+        return Voter(email_id, True), token
+
+    def authenticate_header(self, request) -> str:
+        return self.keyword
@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import smtplib
+import threading
+from typing import Optional
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template.loader import get_template, render_to_string
+from django.utils.html import escape
+
+from .utils import VERIFICATION_CODE_KEY, get_redis, get_script
+
+logger = logging.getLogger(__name__)
+
+MAIL_QUEUE_KEY = "verification:mail:queue"
+MAIL_ATTEMPTS_KEY = "verification:mail:attempts"
+MAIL_DEAD_LETTER_KEY = "verification:mail:dead"
+OUTBOX_KEY = "verification:mail:outbox"
+
+# the code and its pending email are written together or not at all
+OUTBOX_CODE_SCRIPT = """
+    if redis.call("SET", KEYS[1], ARGV[1], "EX", ARGV[2], "NX") then
+        redis.call("RPUSH", KEYS[2], ARGV[3])
+        return 1
+    end
+    return 0
+    """
+
+
+class PrerenderedTemplate:
+    """Template rendered once per process with a placeholder for one
+    variable, rendering it again only joins the value into the cached parts
+
+    Substitution is only used when the template prints the variable as is,
+    a template that filters it or branches on it is rendered every time.
+    With `DEBUG` on, the template is rendered again after its file changed.
+
+    Args:
+        template_name (str): name of the template
+        variable (str): name of the variable that changes between renders
+    """
+
+    PLACEHOLDERS = ("PRERENDEREDVALUEONE", "PRERENDEREDVALUETWO")
+
+    def __init__(self, template_name: str, variable: str):
+        self.template_name = template_name
+        self.variable = variable
+        self._parts = None
+        self._origin = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._parts = None
+            self._mtime = None
+
+    def render(self, value: str) -> str:
+        if self._parts is None or (settings.DEBUG and self._changed()):
+            self._compile()
+        if not self._parts:
+            return render_to_string(self.template_name, {self.variable: value})
+        return escape(value).join(self._parts)
+
+    def _changed(self) -> bool:
+        return self._modified_at() != self._mtime
+
+    def _modified_at(self) -> Optional[float]:
+        try:
+            return os.path.getmtime(self._origin)
+        except (OSError, TypeError):
+            return None
+
+    def _compile(self):
+        with self._lock:
+            template = get_template(self.template_name)
+            self._origin = template.origin.name
+            self._mtime = self._modified_at()
+            first, second = (
+                template.render({self.variable: placeholder})
+                for placeholder in self.PLACEHOLDERS
+            )
+            parts = first.split(self.PLACEHOLDERS[0])
+            if len(parts) < 2 or self.PLACEHOLDERS[1].join(parts) != second:
+                # the value is not printed as is, `render` falls back to
+                # rendering the template
+                parts = []
+            self._parts = parts
+
+
+verification_email_template = PrerenderedTemplate("email.html", "code")
+
+
+def is_batched() -> bool:
+    return settings.VERIFICATION_EMAIL_DELIVERY == "batched"
+
+
+def is_outbox() -> bool:
+    return settings.VERIFICATION_EMAIL_DELIVERY == "outbox"
+
+
+def verification_email(email: str, code: str) -> EmailMultiAlternatives:
+    """Build the email containing a verification code
+
+    Args:
+        email (str): destination email address
+        code (str): verification code
+
+    Returns:
+        EmailMultiAlternatives: message with a text and an html body
+    """
+    message = EmailMultiAlternatives(
+        subject="Verification Code",
+        body=f"Your verification code is {code}",
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[email],
+    )
+    message.attach_alternative(
+        verification_email_template.render(code), "text/html"
+    )
+    return message
+
+
+def queue_verification_code(email: str, code: str) -> int:
+    """Queue a verification code to be sent by `send_queued_emails`
+
+    Args:
+        email (str): destination email address
+        code (str): verification code
+
+    Returns:
+        int: number of queued emails
+    """
+    return get_redis().rpush(
+        MAIL_QUEUE_KEY, json.dumps({"email": email, "code": code})
+    )
+
+
+def outbox_verification_code(email: str, code: str) -> bool:
+    """Store a code for an email unless it already has one and record the
+    email to send in the outbox, in one atomic step
+
+    Nothing is sent to the Celery broker, `users.tasks.dispatch_outbox`
+    moves the outbox to it.
+
+    Args:
+        email (str): destination email address
+        code (str): A random 6-digit string
+
+    Returns:
+        bool: False if the email still has a code that did not expire
+    """
+    script = get_script(OUTBOX_CODE_SCRIPT)
+    return bool(
+        script(
+            keys=[VERIFICATION_CODE_KEY.format(email=email), OUTBOX_KEY],
+            args=[
+                code,
+                settings.VERIFICATION_CODE_EXPIRY,
+                json.dumps({"email": email, "code": code}),
+            ],
+        )
+    )
+
+
+def send_queued_emails(batch_size: int = None) -> int:
+    """Send one batch of queued verification codes over a single SMTP
+    connection
+
+    Emails are removed from the queue once they are handed to the SMTP
+    server, if sending one fails the rest of the batch stays queued for the
+    next call. An email that failed `VERIFICATION_EMAIL_MAX_ATTEMPTS` times
+    is moved to `MAIL_DEAD_LETTER_KEY` so it does not hold up the queue.
+    Only one sender should run at a time, see
+    `users.tasks.send_queued_verification_codes`.
+
+    Args:
+        batch_size (int, optional): maximum number of emails to send.
+        Defaults to `VERIFICATION_EMAIL_BATCH_SIZE`.
+
+    Returns:
+        int: number of emails taken off the queue
+    """
+    client = get_redis()
+    batch_size = batch_size or settings.VERIFICATION_EMAIL_BATCH_SIZE
+    entries = client.lrange(MAIL_QUEUE_KEY, 0, batch_size - 1)
+    if not entries:
+        return 0
+
+    processed = 0
+    try:
+        with get_connection() as connection:
+            for entry in entries:
+                try:
+                    connection.send_messages(
+                        [verification_email(**json.loads(entry))]
+                    )
+                except smtplib.SMTPRecipientsRefused:
+                    # retrying a rejected address would block the queue
+                    pass
+                except (smtplib.SMTPException, OSError):
+                    attempts = client.hincrby(MAIL_ATTEMPTS_KEY, entry, 1)
+                    if attempts < settings.VERIFICATION_EMAIL_MAX_ATTEMPTS:
+                        raise
+                    logger.exception(
+                        "Giving up on a verification email after %d attempts",
+                        attempts,
+                    )
+                    client.rpush(MAIL_DEAD_LETTER_KEY, entry)
+                    processed += 1
+                    # the connection may be broken, the next call opens one
+                    break
+                processed += 1
+    finally:
+        # emails are only ever appended, so the sent ones are at the head
+        pipe = client.pipeline(transaction=False)
+        pipe.ltrim(MAIL_QUEUE_KEY, processed, -1)
+        if processed:
+            pipe.hdel(MAIL_ATTEMPTS_KEY, *entries[:processed])
+        pipe.execute()
+    return processed
@@ -0,0 +1,48 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from kombu.exceptions import OperationalError
+from redis import RedisError
+
+from users.tasks import dispatch_outbox
+
+
+class Command(BaseCommand):
+    help = (
+        "Move verification emails recorded in the outbox to the Celery "
+        "broker, needed when VERIFICATION_EMAIL_DELIVERY is outbox"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="empty the outbox once instead of running until stopped",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=settings.VERIFICATION_EMAIL_MAX_LATENCY,
+            help="seconds between checks of an empty outbox "
+            "(default: VERIFICATION_EMAIL_MAX_LATENCY)",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = settings.VERIFICATION_EMAIL_BATCH_SIZE
+        total = 0
+        while True:
+            try:
+                dispatched = dispatch_outbox(batch_size)
+            except (OperationalError, RedisError) as e:
+                # the emails stay in the outbox until the broker is back
+                self.stderr.write(f"Could not dispatch emails: {e}")
+                dispatched = 0
+            total += dispatched
+
+            if dispatched < batch_size:
+                if options["once"]:
+                    break
+                time.sleep(options["interval"])
+
+        self.stdout.write(self.style.SUCCESS(f"Dispatched {total} emails."))
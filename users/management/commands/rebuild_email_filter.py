@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from users.models import Emails
+
+
+class Command(BaseCommand):
+    help = "Rebuild the Bloom filter of known emails from the Emails table"
+
+    def handle(self, *args, **options):
+        count = Emails.objects.rebuild_filter()
+        self.stdout.write(
+            self.style.SUCCESS(f"Email filter rebuilt with {count} emails.")
+        )
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from users.models import Emails
+from users.utils import email_filter_key, get_redis
+
+
+class Command(BaseCommand):
+    help = (
+        "Cache every active email in Redis and build the Bloom filter of "
+        "known emails if it is missing, e.g. after Redis lost its data"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rebuild-filter",
+            action="store_true",
+            help="rebuild the email filter even if it exists",
+        )
+
+    def handle(self, *args, **options):
+        filter_exists = get_redis().exists(email_filter_key())
+        if options["rebuild_filter"] or not filter_exists:
+            count = Emails.objects.rebuild_filter()
+            self.stdout.write(f"Email filter rebuilt with {count} emails.")
+
+        count = Emails.objects.warm_cache()
+        self.stdout.write(self.style.SUCCESS(f"Cached {count} active emails."))
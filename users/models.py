@@ -1,10 +1,291 @@
-from django.db import models
+import logging
+from typing import List, Optional
+
+from django.db import connections, models, router, transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+from redis import RedisError
+
+from .utils import (
+    EmailIdentity,
+    add_to_email_filter,
+    build_email_filter,
+    cache_email_identities,
+    cache_email_identity,
+    drop_email_filter,
+    forget_email_identity,
+    cache_tokens_revoked_at,
+    probe_email,
+    revoke_voter_tokens,
+    tokens_revoked_at,
+)
+
+logger = logging.getLogger(__name__)
+
+# the functions below run once a change is committed, which stands whatever
+# Redis does: errors are logged and a stale cached identity expires after
+# EMAIL_IDENTITY_CACHE_TTL
+
+
+def _quietly(action: str, write, *args):
+    try:
+        write(*args)
+    except RedisError:
+        logger.warning("Could not %s", action, exc_info=True)
+
+
+def _add_to_filter(*emails: str):
+    try:
+        add_to_email_filter(*emails)
+    except RedisError:
+        logger.warning("Could not add emails to the filter", exc_info=True)
+        # a filter missing an email would answer it does not exist, without
+        # one lookups read the database until it is rebuilt
+        try:
+            drop_email_filter()
+        except RedisError:
+            logger.error(
+                "The email filter may miss emails until "
+                "`manage.py rebuild_email_filter` runs"
+            )
+
+
+def remember_email(email: str, email_id: int, is_active: bool):
+    """Update the identity cache and the Bloom filter of known emails"""
+    _quietly(
+        "cache the identity of an email",
+        cache_email_identity,
+        email,
+        email_id,
+        is_active,
+    )
+    _add_to_filter(email)
+
+
+def refresh_emails(old_emails: List[str], rows: List[tuple]):
+    """Drop the cached identities of emails changed in bulk, they are
+    cached again on their next lookup
+
+    Args:
+        old_emails (List[str]): emails before the change
+        rows (List[tuple]): `(email, id, is_active)` after the change
+    """
+    if not rows:
+        return
+    emails = [email for email, _, _ in rows]
+    _quietly(
+        "forget the identity of emails",
+        forget_email_identity,
+        *old_emails,
+        *emails,
+    )
+    _add_to_filter(*emails)
+    inactive = [email_id for _, email_id, is_active in rows if not is_active]
+    if inactive:
+        _quietly("revoke voter tokens", revoke_voter_tokens, *inactive)
+
+
+class EmailsQuerySet(models.QuerySet):
+    # the bulk methods send no signal, `bulk_update` goes through `update`
+
+    def update(self, **kwargs):
+        with transaction.atomic(using=self.db):
+            old_rows = list(self.values_list("id", "email"))
+            updated = super().update(**kwargs)
+            rows = list(
+                self.model._base_manager.using(self.db)
+                .filter(id__in=[email_id for email_id, _ in old_rows])
+                .values_list("email", "id", "is_active")
+            )
+            inactive = [email_id for _, email_id, active in rows if not active]
+            if inactive:
+                # see `revoke_tokens_of_inactive_email`
+                self.model._base_manager.using(self.db).filter(
+                    id__in=inactive
+                ).update(tokens_revoked_at=timezone.now())
+        old_emails = [email for _, email in old_rows]
+        transaction.on_commit(
+            lambda: refresh_emails(old_emails, rows), using=self.db
+        )
+        return updated
+
+    def bulk_create(self, objs, *args, **kwargs):
+        created = super().bulk_create(objs, *args, **kwargs)
+        # new emails have no cached identity and no token yet
+        emails = [obj.email for obj in created]
+        if emails:
+            transaction.on_commit(
+                lambda: _add_to_filter(*emails), using=self.db
+            )
+        return created
+
+
+class EmailsManager(models.Manager.from_queryset(EmailsQuerySet)):
+    def lookup(self, email: str) -> Optional[EmailIdentity]:
+        """Get the id and the state of an email
+
+        The identity cache and the Bloom filter of known emails in Redis are
+        checked first, so cached emails and unknown emails do not touch the
+        database. Other emails are read from the database and cached.
+
+        Args:
+            email (str): user provided email
+
+        Returns:
+            Optional[EmailIdentity]: `(id, is_active)` or None if the email
+            does not exist
+        """
+        try:
+            identity, maybe_known = probe_email(email)
+        except RedisError:
+            identity, maybe_known = None, True
+        if identity is not None:
+            return identity
+        if not maybe_known:
+            return None
+
+        row = self.filter(email=email).values_list("id", "is_active").first()
+        if row is None:
+            return None
+        identity = EmailIdentity(*row)
+        try:
+            cache_email_identity(email, *identity)
+        except RedisError:
+            pass
+        return identity
+
+    def rebuild_filter(self) -> int:
+        """Rebuild the Bloom filter of known emails from the database
+
+        Returns:
+            int: number of emails in the filter
+        """
+        last_id = self.aggregate(last_id=models.Max("id"))["last_id"] or 0
+        count = build_email_filter(
+            self.filter(id__lte=last_id)
+            .values_list("email", flat=True)
+            .iterator(chunk_size=10_000)
+        )
+        # emails created while the filter was built were added to the
+        # replaced filter
+        created = self.filter(id__gt=last_id).values_list("email", flat=True)
+        if created:
+            add_to_email_filter(*created)
+        return count + len(created)
+
+    def activate(self, email: str) -> EmailIdentity:
+        """Create an active email or activate an existing one with a single
+        `INSERT ... ON CONFLICT` statement, concurrent activations of the
+        same email never fail
+
+        The identity cache and the Bloom filter are updated once the
+        transaction commits.
+
+        Args:
+            email (str): verified email
+
+        Returns:
+            EmailIdentity: `(id, is_active)` of the email
+        """
+        table = self.model._meta.db_table
+        sql = (
+            f"INSERT INTO {table} (email, is_active, verified_at) "
+            "VALUES (%s, true, now()) "
+            "ON CONFLICT (email) "
+            "DO UPDATE SET is_active = true, verified_at = now() "
+            "RETURNING id"
+        )
+        db = router.db_for_write(self.model)
+        with connections[db].cursor() as cursor:
+            cursor.execute(sql, [email])
+            identity = EmailIdentity(cursor.fetchone()[0], True)
+
+        transaction.on_commit(lambda: remember_email(email, *identity), db)
+        return identity
+
+    def tokens_revoked_at(self, email_id: int) -> int:
+        """Time in milliseconds the voter tokens of an email issued until are
+        revoked, read from the database and cached
+
+        Args:
+            email_id (int): primary key of the email
+
+        Returns:
+            int: see `users.utils.tokens_revoked_at`
+        """
+        row = (
+            self.filter(id=email_id)
+            .values_list("is_active", "tokens_revoked_at")
+            .first()
+        )
+        revoked_at = tokens_revoked_at(*(row or (None, None)))
+        try:
+            cache_tokens_revoked_at(email_id, revoked_at)
+        except RedisError:
+            pass
+        return revoked_at
+
+    def warm_cache(self) -> int:
+        """Cache the identity of every active email
+
+        Returns:
+            int: number of cached emails
+        """
+        return cache_email_identities(
+            self.filter(is_active=True)
+            .values_list("email", "id", "is_active")
+            .iterator(chunk_size=10_000)
+        )
 
 
 class Emails(models.Model):
     email = models.EmailField(unique=True)
     is_active = models.BooleanField(default=False)
     verified_at = models.DateTimeField(auto_now=True)
+    # voter tokens issued until then are revoked, Redis only caches it
+    tokens_revoked_at = models.DateTimeField(null=True, blank=True)
+
+    objects = EmailsManager()
+
+    def remember(self):
+        remember_email(self.email, self.id, self.is_active)
 
     def __str__(self) -> str:
         return f"{self.email} (active: {self.is_active})"
+
+
+@receiver(pre_save, sender=Emails)
+def revoke_tokens_of_inactive_email(sender, instance, **kwargs):
+    # written with the change, so the revocation stands even if caching it
+    # in Redis fails, a deleted email has no tokens left either
+    if not instance.is_active:
+        instance.tokens_revoked_at = timezone.now()
+
+
+@receiver(post_save, sender=Emails)
+def remember_saved_email(sender, instance, using, **kwargs):
+    transaction.on_commit(instance.remember, using)
+    if not instance.is_active:
+        email_id = instance.id
+        transaction.on_commit(
+            lambda: _quietly(
+                "revoke voter tokens", revoke_voter_tokens, email_id
+            ),
+            using,
+        )
+
+
+@receiver(post_delete, sender=Emails)
+def forget_deleted_email(sender, instance, using, **kwargs):
+    email, email_id = instance.email, instance.id
+    transaction.on_commit(
+        lambda: _quietly(
+            "forget the identity of an email", forget_email_identity, email
+        ),
+        using,
+    )
+    transaction.on_commit(
+        lambda: _quietly("revoke voter tokens", revoke_voter_tokens, email_id),
+        using,
+    )
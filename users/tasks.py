@@ -1,7 +1,20 @@
+import json
+import time
+
 from celery import shared_task
 from django.conf import settings
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
+
+from .mail import (
+    OUTBOX_KEY,
+    is_batched,
+    queue_verification_code,
+    send_queued_emails,
+    verification_email,
+)
+from .utils import extend_lock, get_redis, release_lock
+
+MAIL_LOCK_KEY = "verification:mail:lock"
+OUTBOX_LOCK_KEY = "verification:mail:outbox:lock"
 
 
 @shared_task(bind=True)
@@ -19,13 +32,104 @@ def send_verification_code(self, email: str, code: str) -> int:
         [int]: number of email being sent. in this case it will be 1
     """
     try:
-        return send_mail(
-            subject="Verification Code",
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[email],
-            message=f"Your verification code is {code}",
-            html_message=render_to_string("email.html", {"code": code}),
-        )
+        return verification_email(email, code).send()
     except Exception as e:
         # TODO: log errors
         raise self.retry(exc=e, countdown=5)
+
+
+@shared_task
+def send_queued_verification_codes() -> int:
+    """Send queued verification codes until the queue is empty
+
+    Runs every `VERIFICATION_EMAIL_MAX_LATENCY` seconds (see
+    `CELERY_BEAT_SCHEDULE`) and whenever a full batch is queued. A Redis
+    lock makes sure only one worker sends at a time, it is extended after
+    every batch and a worker that lost it stops.
+
+    Returns:
+        int: number of emails taken off the queue
+    """
+    lock = get_redis().lock(
+        MAIL_LOCK_KEY,
+        timeout=max(60, settings.VERIFICATION_EMAIL_MAX_LATENCY * 10),
+    )
+    if not lock.acquire(blocking=False):
+        return 0
+
+    processed = 0
+    try:
+        deadline = time.monotonic() + settings.VERIFICATION_EMAIL_MAX_LATENCY
+        while time.monotonic() < deadline:
+            sent = send_queued_emails(settings.VERIFICATION_EMAIL_BATCH_SIZE)
+            processed += sent
+            if sent < settings.VERIFICATION_EMAIL_BATCH_SIZE:
+                break
+            if not extend_lock(lock):
+                break
+    finally:
+        release_lock(lock)
+    return processed
+
+
+def deliver_verification_code(email: str, code: str):
+    """Send a verification code according to `VERIFICATION_EMAIL_DELIVERY`
+
+    In `direct` mode every code is sent by its own task over its own SMTP
+    connection, in `batched` mode codes are queued and sent in batches by
+    `send_queued_verification_codes`.
+
+    Args:
+        email (str): destination email address
+        code (str): verification code
+    """
+    if not is_batched():
+        send_verification_code.delay(email=email, code=code)
+        return
+
+    queued = queue_verification_code(email, code)
+    if queued % settings.VERIFICATION_EMAIL_BATCH_SIZE == 0:
+        # do not wait for the next scheduled run with a full batch
+        send_queued_verification_codes.delay()
+
+
+def dispatch_outbox(batch_size: int = None) -> int:
+    """Move one batch of emails from the outbox to the Celery broker, as
+    `send_verification_code` tasks published over one broker connection
+
+    Emails are removed from the outbox once their task is published, if
+    the broker is unavailable the rest of the batch stays in the outbox for
+    the next call. A Redis lock makes sure only one dispatcher runs at a
+    time, see the `dispatch_verification_codes` command.
+
+    Args:
+        batch_size (int, optional): maximum number of emails to move.
+        Defaults to `VERIFICATION_EMAIL_BATCH_SIZE`.
+
+    Returns:
+        int: number of emails taken off the outbox
+    """
+    client = get_redis()
+    batch_size = batch_size or settings.VERIFICATION_EMAIL_BATCH_SIZE
+    lock = client.lock(OUTBOX_LOCK_KEY, timeout=60)
+    if not lock.acquire(blocking=False):
+        return 0
+
+    dispatched = 0
+    try:
+        entries = client.lrange(OUTBOX_KEY, 0, batch_size - 1)
+        if not entries:
+            return 0
+        with send_verification_code.app.producer_or_acquire() as producer:
+            for entry in entries:
+                send_verification_code.apply_async(
+                    kwargs=json.loads(entry), producer=producer
+                )
+                dispatched += 1
+    finally:
+        # emails are only ever appended, so the published ones are at the
+        # head
+        if dispatched:
+            client.ltrim(OUTBOX_KEY, dispatched, -1)
+        release_lock(lock)
+    return dispatched
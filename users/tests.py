@@ -1,18 +1,72 @@
+import asyncio
+import json
+import os
+import smtplib
+import tempfile
+import time
+import uuid
+from io import StringIO
 from unittest import mock
 
+from django.conf import settings
+from django.core import mail
+from django.core.management import call_command
 from django.db.utils import IntegrityError
-from django.test import Client, SimpleTestCase, TestCase
+from django.template.loader import get_template, render_to_string
+from django.test import (
+    Client,
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
 from django.urls import resolve, reverse
 
+from asgiref.sync import async_to_sync
+from config.asgi import application
+from users.aio import EmailAsyncView, close_connections
 from users.api import CheckVerificationCodeView, EmailView
+from users.authentication import VoterTokenAuthentication
 from users.models import Emails
-from users.tasks import send_verification_code
+from users.mail import (
+    MAIL_ATTEMPTS_KEY,
+    MAIL_DEAD_LETTER_KEY,
+    MAIL_QUEUE_KEY,
+    OUTBOX_KEY,
+    PrerenderedTemplate,
+    outbox_verification_code,
+    queue_verification_code,
+    send_queued_emails,
+    verification_email_template,
+)
+from users.throttling import SLIDING_WINDOW_SCRIPT, RedisScopedRateThrottle
+from users.tasks import (
+    MAIL_LOCK_KEY,
+    OUTBOX_LOCK_KEY,
+    deliver_verification_code,
+    dispatch_outbox,
+    send_queued_verification_codes,
+    send_verification_code,
+)
 from users.utils import (
+    EmailIdentity,
+    email_filter_key,
+    VERIFICATION_CODE_KEY,
     generate_verification_code,
-    is_code_correct,
-    is_code_in_redis,
+    get_redis,
+    get_script,
+    is_voter_token_revoked,
+    issue_voter_token,
+    load_voter_token,
+    probe_email,
+    revoke_voter_tokens,
     set_verification_code,
+    use_verification_code,
 )
+from kombu.exceptions import OperationalError
+from redis import RedisError
+from rest_framework.exceptions import AuthenticationFailed
 
 
 class TestUrls(SimpleTestCase):
@@ -32,6 +86,8 @@ class TestViews(TestCase):
         self.client = Client()
         self.send_verification_code_url = reverse("send-verification-code")
         self.check_verification_code_url = reverse("check-verification-code")
+        for key in get_redis().scan_iter("throttle:*"):
+            get_redis().delete(key)
 
     def test_verification_code_POST_no_data_provided(self):
         response = self.client.post(self.send_verification_code_url)
@@ -41,33 +97,53 @@ class TestViews(TestCase):
             response.json().get("email")[0], "This field is required."
         )
 
-    @mock.patch("users.utils.redis.StrictRedis.get", return_value=False)
-    @mock.patch("users.api.is_code_in_redis", return_value=False)
+    @mock.patch("users.api.deliver_verification_code")
+    @mock.patch("users.api.set_verification_code", return_value=True)
     def test_verification_code_POST_successful(
-        self, mock_is_code_in_redis, mock_r_get
+        self, mock_set_verification_code, mock_send
     ):
         response = self.client.post(
             self.send_verification_code_url, data={"email": "test@email.com"}
         )
-        self.assertTrue(mock_is_code_in_redis.called)
+        self.assertTrue(mock_set_verification_code.called)
+        self.assertTrue(mock_send.called)
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, "please check your inbox")
 
-    @mock.patch("users.api.is_code_in_redis", return_value=True)
-    def test_verification_code_POST_wait_120_sec(self, mock_is_code_in_redis):
+    @mock.patch("users.api.deliver_verification_code")
+    @mock.patch("users.api.set_verification_code", return_value=False)
+    def test_verification_code_POST_wait_120_sec(
+        self, mock_set_verification_code, mock_send
+    ):
         response = self.client.post(
             self.send_verification_code_url, data={"email": "test2@email.com"}
         )
-        self.assertTrue(mock_is_code_in_redis.called)
+        self.assertTrue(mock_set_verification_code.called)
+        self.assertFalse(mock_send.called)
         self.assertEqual(response.status_code, 202)
         self.assertEqual(
             response.json().get("detail"), "please wait 120 seconds"
         )
 
-    @mock.patch("users.tasks.send_mail")
-    def test_send_verification_code_func(self, mock_send_mail):
+    @mock.patch("users.api.deliver_verification_code")
+    def test_verification_code_POST_sends_one_code(self, mock_send):
+        get_redis().delete(VERIFICATION_CODE_KEY.format(email="once@email.com"))
+        responses = [
+            self.client.post(
+                self.send_verification_code_url,
+                data={"email": "once@email.com"},
+            )
+            for _ in range(2)
+        ]
+        self.assertEqual([r.status_code for r in responses], [200, 202])
+        self.assertEqual(mock_send.call_count, 1)
+
+    def test_send_verification_code_func(self):
         ret = send_verification_code(email="test@email.com", code="234123")
-        self.assertTrue(mock_send_mail.called)
+        self.assertEqual(ret, 1)
+        self.assertEqual(mail.outbox[0].to, ["test@email.com"])
+        self.assertIn("234123", mail.outbox[0].body)
+        self.assertIn("234123", mail.outbox[0].alternatives[0][0])
 
     def test_check_verification_POST_no_data(self):
         response = self.client.post(self.check_verification_code_url)
@@ -109,28 +185,34 @@ class TestViews(TestCase):
             response.json().get("code")[0], "Code is only 6 digits long"
         )
 
-    @mock.patch("users.api.is_code_correct", return_value=False)
-    def test_check_verification_POST_not_valid_code(self, mock_is_code_correct):
+    @mock.patch("users.api.use_verification_code", return_value=False)
+    def test_check_verification_POST_not_valid_code(self, mock_use_code):
         response = self.client.post(
             self.check_verification_code_url,
             data={"email": "test@email.com", "code": "123456"},
         )
-        self.assertTrue(mock_is_code_correct.called)
+        self.assertTrue(mock_use_code.called)
         self.assertEqual(response.status_code, 401)
         self.assertEqual(response.json().get("detail"), "Code is not correct")
 
-    @mock.patch("users.api.is_code_correct", return_value=True)
-    def test_check_verification_POST_valid_code(self, mock_is_code_correct):
+    @mock.patch("users.api.use_verification_code", return_value=True)
+    def test_check_verification_POST_valid_code(self, mock_use_code):
         response = self.client.post(
             self.check_verification_code_url,
             data={"email": "test@email.com", "code": "123456"},
         )
-        self.assertTrue(mock_is_code_correct.called)
+        self.assertTrue(mock_use_code.called)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json().get("detail"), "successful")
 
         email_obj = Emails.objects.get(email="test@email.com")
         self.assertTrue(email_obj.is_active)
+        self.assertEqual(
+            load_voter_token(response.json().get("token"))[0], email_obj.id
+        )
+        self.assertEqual(
+            response.json().get("expires_in"), settings.VOTER_TOKEN_MAX_AGE
+        )
 
 
 class TestModels(TestCase):
@@ -150,6 +232,340 @@ class TestModels(TestCase):
             f"{self.email_obj.email} (active: {self.email_obj.is_active})",
         )
 
+    def test_activate_new_email(self):
+        with self.assertNumQueries(1):
+            identity = Emails.objects.activate("new@email.com")
+
+        email_obj = Emails.objects.get(email="new@email.com")
+        self.assertEqual(identity, EmailIdentity(email_obj.id, True))
+        self.assertTrue(email_obj.is_active)
+
+    def test_activate_existing_email(self):
+        email_obj = Emails.objects.create(email="inactive@email.com")
+
+        with self.assertNumQueries(1):
+            identity = Emails.objects.activate("inactive@email.com")
+        # activating twice is harmless
+        Emails.objects.activate("inactive@email.com")
+
+        self.assertEqual(identity, EmailIdentity(email_obj.id, True))
+        email_obj.refresh_from_db()
+        self.assertTrue(email_obj.is_active)
+        self.assertEqual(Emails.objects.count(), 2)
+
+
+class TestEmailLookup(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.email_obj = Emails.objects.create(
+            email="test@email.com", is_active=True
+        )
+
+    def setUp(self):
+        # drop identities cached by other tests, their rows were rolled back
+        for pattern in ("emails:*", "voter:revoked:*"):
+            for key in get_redis().scan_iter(pattern):
+                get_redis().delete(key)
+
+    def test_lookup_is_cached(self):
+        with self.assertNumQueries(1):
+            identity = Emails.objects.lookup("test@email.com")
+        self.assertEqual(identity, EmailIdentity(self.email_obj.id, True))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(Emails.objects.lookup("test@email.com"), identity)
+
+    def test_lookup_unknown_email_without_filter(self):
+        with self.assertNumQueries(1):
+            self.assertIsNone(Emails.objects.lookup("unknown@email.com"))
+
+    def test_lookup_unknown_email_with_filter(self):
+        self.assertEqual(Emails.objects.rebuild_filter(), 1)
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(Emails.objects.lookup("unknown@email.com"))
+        with self.assertNumQueries(1):
+            self.assertIsNotNone(Emails.objects.lookup("test@email.com"))
+
+    @mock.patch("users.models.probe_email", side_effect=RedisError)
+    def test_lookup_without_redis(self, mock_probe_email):
+        self.assertEqual(
+            Emails.objects.lookup("test@email.com"),
+            EmailIdentity(self.email_obj.id, True),
+        )
+
+    def test_saved_email_is_remembered(self):
+        Emails.objects.rebuild_filter()
+        with self.captureOnCommitCallbacks(execute=True):
+            email_obj = Emails.objects.create(email="new@email.com")
+
+        identity, maybe_known = probe_email("new@email.com")
+        self.assertEqual(identity, EmailIdentity(email_obj.id, False))
+        self.assertTrue(maybe_known)
+
+    def test_deleted_email_is_forgotten(self):
+        Emails.objects.lookup("test@email.com")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.email_obj.delete()
+
+        self.assertIsNone(probe_email("test@email.com")[0])
+
+    def test_bulk_update_is_not_cached(self):
+        Emails.objects.lookup("test@email.com")
+        token = issue_voter_token(self.email_obj.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            Emails.objects.filter(id=self.email_obj.id).update(is_active=False)
+
+        self.assertEqual(
+            Emails.objects.lookup("test@email.com"),
+            EmailIdentity(self.email_obj.id, False),
+        )
+        self.assertTrue(is_voter_token_revoked(*load_voter_token(token)))
+
+        Emails.objects.rebuild_filter()
+        with self.captureOnCommitCallbacks(execute=True):
+            Emails.objects.filter(id=self.email_obj.id).update(
+                email="renamed@email.com"
+            )
+        self.assertIsNone(Emails.objects.lookup("test@email.com"))
+        self.assertEqual(
+            Emails.objects.lookup("renamed@email.com"),
+            EmailIdentity(self.email_obj.id, False),
+        )
+
+    def test_bulk_created_email_is_known(self):
+        Emails.objects.rebuild_filter()
+        with self.captureOnCommitCallbacks(execute=True):
+            (email_obj,) = Emails.objects.bulk_create(
+                [Emails(email="new@email.com", is_active=True)]
+            )
+
+        self.assertEqual(
+            Emails.objects.lookup("new@email.com"),
+            EmailIdentity(email_obj.id, True),
+        )
+
+    def test_bulk_deleted_email_is_forgotten(self):
+        Emails.objects.lookup("test@email.com")
+        with self.captureOnCommitCallbacks(execute=True):
+            Emails.objects.filter(id=self.email_obj.id).delete()
+
+        self.assertIsNone(Emails.objects.lookup("test@email.com"))
+
+    @mock.patch("users.models.add_to_email_filter", side_effect=RedisError)
+    @mock.patch("users.models.cache_email_identity", side_effect=RedisError)
+    def test_activation_survives_redis_errors(self, cache, add):
+        Emails.objects.rebuild_filter()
+        with mock.patch("users.api.use_verification_code", return_value=True):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    reverse("check-verification-code"),
+                    data={"email": "new@email.com", "code": "123456"},
+                )
+        self.assertEqual(response.status_code, 200)
+
+        # the filter is dropped rather than left without the email
+        self.assertFalse(get_redis().exists(email_filter_key()))
+        email_obj = Emails.objects.get(email="new@email.com")
+        self.assertEqual(
+            Emails.objects.lookup("new@email.com"),
+            EmailIdentity(email_obj.id, True),
+        )
+
+    @mock.patch("users.models.drop_email_filter", side_effect=RedisError)
+    @mock.patch("users.models.add_to_email_filter", side_effect=RedisError)
+    def test_filter_left_behind_is_reported(self, add, drop):
+        with self.assertLogs("users.models", "ERROR") as logs:
+            with self.captureOnCommitCallbacks(execute=True):
+                Emails.objects.bulk_create([Emails(email="new@email.com")])
+        self.assertIn("rebuild_email_filter", logs.output[-1])
+
+    @mock.patch("users.models.revoke_voter_tokens", side_effect=RedisError)
+    @mock.patch("users.models.forget_email_identity", side_effect=RedisError)
+    @mock.patch("users.models.cache_email_identity", side_effect=RedisError)
+    def test_changes_survive_redis_errors(self, *redis_writes):
+        with self.assertLogs("users.models", "WARNING"):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.email_obj.is_active = False
+                self.email_obj.save()
+            with self.captureOnCommitCallbacks(execute=True):
+                Emails.objects.filter(id=self.email_obj.id).update(
+                    is_active=True
+                )
+            with self.captureOnCommitCallbacks(execute=True):
+                self.email_obj.delete()
+        self.assertFalse(Emails.objects.exists())
+
+    def test_activation_is_cached(self):
+        with mock.patch("users.api.use_verification_code", return_value=True):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(
+                    reverse("check-verification-code"),
+                    data={"email": "new@email.com", "code": "123456"},
+                )
+
+        email_obj = Emails.objects.get(email="new@email.com")
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                Emails.objects.lookup("new@email.com"),
+                EmailIdentity(email_obj.id, True),
+            )
+
+    def test_warm_email_cache_command(self):
+        call_command("warm_email_cache", stdout=StringIO())
+
+        self.assertTrue(get_redis().exists(email_filter_key()))
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                Emails.objects.lookup("test@email.com"),
+                EmailIdentity(self.email_obj.id, True),
+            )
+            self.assertIsNone(Emails.objects.lookup("unknown@email.com"))
+
+
+class TestThrottling(SimpleTestCase):
+    def setUp(self):
+        self.url = reverse("send-verification-code")
+        for key in get_redis().scan_iter("throttle:*"):
+            get_redis().delete(key)
+
+    def sliding_window(self, key, window_ms, limit):
+        return get_script(SLIDING_WINDOW_SCRIPT)(
+            keys=[key], args=[window_ms, limit, uuid.uuid4().hex]
+        )
+
+    @mock.patch.object(
+        RedisScopedRateThrottle, "THROTTLE_RATES", {"email": "2/min"}
+    )
+    def test_email_is_throttled(self):
+        for _ in range(2):
+            response = self.client.post(self.url)
+            self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(self.url)
+        self.assertEqual(response.status_code, 429)
+        self.assertLessEqual(int(response["Retry-After"]), 60)
+        # counted in Redis, so shared by every worker
+        self.assertEqual(get_redis().zcard("throttle:email:127.0.0.1"), 2)
+
+    def test_sliding_window(self):
+        self.assertEqual(self.sliding_window("throttle:test:a", 100, 2), 0)
+        self.assertEqual(self.sliding_window("throttle:test:a", 100, 2), 0)
+        wait = self.sliding_window("throttle:test:a", 100, 2)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 100)
+        # other clients are counted separately
+        self.assertEqual(self.sliding_window("throttle:test:b", 100, 2), 0)
+
+        time.sleep(0.11)
+        self.assertEqual(self.sliding_window("throttle:test:a", 100, 2), 0)
+        self.assertEqual(get_redis().zcard("throttle:test:a"), 1)
+
+    @mock.patch.object(
+        RedisScopedRateThrottle, "THROTTLE_RATES", {"email": "1/min"}
+    )
+    @mock.patch("users.throttling.get_script", side_effect=RedisError)
+    def test_redis_unavailable(self, get_script):
+        for _ in range(2):
+            response = self.client.post(self.url)
+            self.assertEqual(response.status_code, 400)
+
+
+class TestVoterToken(SimpleTestCase):
+    def test_voter_token(self):
+        email_id, issued_at = load_voter_token(issue_voter_token(1))
+        self.assertEqual(email_id, 1)
+        self.assertAlmostEqual(issued_at / 1000, time.time(), delta=5)
+
+    def test_voter_token_is_signed(self):
+        token = issue_voter_token(1)
+        self.assertIsNone(load_voter_token(token[:-1]))
+        self.assertIsNone(load_voter_token("not a token"))
+        with override_settings(SECRET_KEY="another secret"):
+            self.assertIsNone(load_voter_token(token))
+
+    @override_settings(VOTER_TOKEN_MAX_AGE=0)
+    def test_voter_token_expires(self):
+        token = issue_voter_token(1)
+        time.sleep(1.1)
+        self.assertIsNone(load_voter_token(token))
+
+    def test_revoke_voter_tokens(self):
+        email_id, issued_at = load_voter_token(issue_voter_token(1))
+        self.assertFalse(is_voter_token_revoked(email_id, issued_at))
+
+        revoke_voter_tokens(email_id)
+        self.assertTrue(is_voter_token_revoked(email_id, issued_at))
+        self.assertLessEqual(
+            get_redis().ttl(f"voter:revoked:{email_id}"),
+            settings.VOTER_TOKEN_MAX_AGE,
+        )
+
+        # tokens issued later are valid
+        time.sleep(0.002)
+        email_id, issued_at = load_voter_token(issue_voter_token(1))
+        self.assertFalse(is_voter_token_revoked(email_id, issued_at))
+
+
+class TestTokenRevocation(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.email_obj = Emails.objects.create(
+            email="test@email.com", is_active=True
+        )
+
+    def setUp(self):
+        for key in get_redis().scan_iter("voter:revoked:*"):
+            get_redis().delete(key)
+        self.token = issue_voter_token(self.email_obj.id)
+
+    def authenticate(self, token):
+        request = RequestFactory().get(
+            "/", HTTP_AUTHORIZATION=f"Bearer {token}"
+        )
+        return VoterTokenAuthentication().authenticate(request)
+
+    def test_revocation_is_read_once(self):
+        with self.assertNumQueries(1):
+            self.authenticate(self.token)
+        with self.assertNumQueries(0):
+            self.authenticate(self.token)
+        self.assertIn(
+            get_redis().ttl(f"voter:revoked:{self.email_obj.id}"),
+            range(1, settings.VOTER_TOKEN_REVOCATION_CACHE_TTL + 1),
+        )
+
+    @mock.patch("users.models.revoke_voter_tokens", side_effect=RedisError)
+    def test_revocation_redis_missed(self, revoke):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.email_obj.is_active = False
+            self.email_obj.save()
+        with self.assertRaisesMessage(AuthenticationFailed, "token revoked"):
+            self.authenticate(self.token)
+
+        # tokens issued before stay revoked once the email is verified again
+        Emails.objects.activate("test@email.com")
+        time.sleep(0.002)
+        with self.assertRaisesMessage(AuthenticationFailed, "token revoked"):
+            self.authenticate(self.token)
+        get_redis().delete(f"voter:revoked:{self.email_obj.id}")
+        with self.assertRaisesMessage(AuthenticationFailed, "token revoked"):
+            self.authenticate(self.token)
+        self.authenticate(issue_voter_token(self.email_obj.id))
+
+    @mock.patch("users.models.revoke_voter_tokens", side_effect=RedisError)
+    def test_bulk_revocation_redis_missed(self, revoke):
+        with self.captureOnCommitCallbacks(execute=True):
+            Emails.objects.filter(id=self.email_obj.id).update(is_active=False)
+        Emails.objects.filter(id=self.email_obj.id).update(is_active=True)
+        with self.assertRaisesMessage(AuthenticationFailed, "token revoked"):
+            self.authenticate(self.token)
+
+    def test_deleted_email(self):
+        Emails.objects.filter(id=self.email_obj.id).delete()
+        with self.assertRaisesMessage(AuthenticationFailed, "token revoked"):
+            self.authenticate(self.token)
+
 
 class TestUtils(SimpleTestCase):
     def test_generate_verification_code_length(self):
@@ -161,30 +577,502 @@ class TestUtils(SimpleTestCase):
     def test_generate_verification_code_returns_str(self):
         self.assertTrue(type(generate_verification_code()) == str)
 
-    @mock.patch("users.utils.redis.StrictRedis.set", return_value=True)
-    def test_set_verification_code(self, mock_set_verification_code):
-        ret = set_verification_code("test@email.com", "123456")
+    def test_set_verification_code(self):
+        key = VERIFICATION_CODE_KEY.format(email="test@email.com")
+        get_redis().delete(key)
 
-        self.assertTrue(mock_set_verification_code.called)
-        self.assertTrue(ret)
+        self.assertTrue(set_verification_code("test@email.com", "123456"))
+        # the pending code is kept
+        self.assertFalse(set_verification_code("test@email.com", "654321"))
+        self.assertEqual(get_redis().get(key), b"123456")
+        self.assertGreater(get_redis().ttl(key), 0)
+
+    def test_use_verification_code(self):
+        key = VERIFICATION_CODE_KEY.format(email="test@email.com")
+        get_redis().set(key, "123123")
+
+        self.assertFalse(use_verification_code("test@email.com", "111111"))
+        self.assertTrue(get_redis().exists(key))
+        self.assertTrue(use_verification_code("test@email.com", 123123))
+        # a code can only be used once
+        self.assertFalse(get_redis().exists(key))
+        self.assertFalse(use_verification_code("test@email.com", "123123"))
+
+    def test_get_redis_is_shared(self):
+        self.assertIs(get_redis(), get_redis())
+        self.assertEqual(
+            get_redis().connection_pool.max_connections,
+            settings.REDIS_MAX_CONNECTIONS,
+        )
 
-    @mock.patch("users.utils.redis.StrictRedis.get", return_value=True)
-    def test_is_code_in_redis(self, mock_is_code_in_redis):
-        self.assertTrue(is_code_in_redis("test@email.com"))
-        self.assertTrue(mock_is_code_in_redis.called)
 
-    @mock.patch("users.utils.redis.StrictRedis.get", return_value=b"123123")
-    def test_is_code_correct(self, mock_is_code_correct):
-        self.assertTrue(is_code_correct("test@email.com", 123123))
-        self.assertTrue(mock_is_code_correct.called)
+class TestMailQueue(SimpleTestCase):
+    def setUp(self):
+        get_redis().delete(
+            MAIL_QUEUE_KEY, MAIL_ATTEMPTS_KEY, MAIL_DEAD_LETTER_KEY
+        )
+
+    def queue(self, count):
+        for i in range(count):
+            queue_verification_code(f"user{i}@email.com", f"{i:06}")
+
+    @mock.patch("users.tasks.send_verification_code.delay")
+    def test_deliver_direct(self, mock_send):
+        deliver_verification_code("test@email.com", "123456")
+        mock_send.assert_called_once_with(email="test@email.com", code="123456")
+        self.assertEqual(get_redis().llen(MAIL_QUEUE_KEY), 0)
+
+    @override_settings(
+        VERIFICATION_EMAIL_DELIVERY="batched", VERIFICATION_EMAIL_BATCH_SIZE=2
+    )
+    @mock.patch("users.tasks.send_queued_verification_codes.delay")
+    @mock.patch("users.tasks.send_verification_code.delay")
+    def test_deliver_batched(self, mock_send, mock_send_queued):
+        deliver_verification_code("test1@email.com", "123456")
+        self.assertFalse(mock_send_queued.called)
+        # a full batch is sent right away
+        deliver_verification_code("test2@email.com", "123456")
+        self.assertTrue(mock_send_queued.called)
+        self.assertFalse(mock_send.called)
+        self.assertEqual(get_redis().llen(MAIL_QUEUE_KEY), 2)
+
+    def test_send_queued_emails_over_one_connection(self):
+        self.queue(3)
+        with mock.patch(
+            "users.mail.get_connection", wraps=mail.get_connection
+        ) as mock_connection:
+            self.assertEqual(send_queued_emails(batch_size=2), 2)
+        self.assertEqual(mock_connection.call_count, 1)
+        self.assertEqual(
+            [m.to for m in mail.outbox],
+            [["user0@email.com"], ["user1@email.com"]],
+        )
+        self.assertIn("000001", mail.outbox[1].body)
+        self.assertEqual(get_redis().llen(MAIL_QUEUE_KEY), 1)
+
+    def test_send_queued_emails_drops_refused_recipients(self):
+        self.queue(2)
+        refused = smtplib.SMTPRecipientsRefused({"user0@email.com": (550, b"")})
+        with mock.patch(
+            "django.core.mail.backends.locmem.EmailBackend.send_messages",
+            side_effect=[refused, 1],
+        ):
+            self.assertEqual(send_queued_emails(), 2)
+        self.assertEqual(get_redis().llen(MAIL_QUEUE_KEY), 0)
+
+    def test_send_queued_emails_keeps_unsent_emails(self):
+        self.queue(3)
+        with mock.patch(
+            "django.core.mail.backends.locmem.EmailBackend.send_messages",
+            side_effect=[1, smtplib.SMTPServerDisconnected()],
+        ):
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                send_queued_emails()
+        self.assertEqual(
+            get_redis().lrange(MAIL_QUEUE_KEY, 0, -1),
+            [
+                b'{"email": "user1@email.com", "code": "000001"}',
+                b'{"email": "user2@email.com", "code": "000002"}',
+            ],
+        )
+
+    @override_settings(VERIFICATION_EMAIL_MAX_ATTEMPTS=2)
+    def test_send_queued_emails_moves_failing_email_aside(self):
+        self.queue(2)
+        failed = smtplib.SMTPDataError(554, b"message rejected")
+        with mock.patch(
+            "django.core.mail.backends.locmem.EmailBackend.send_messages",
+            side_effect=[failed, failed, 1],
+        ):
+            with self.assertRaises(smtplib.SMTPDataError):
+                send_queued_emails()
+            self.assertEqual(get_redis().llen(MAIL_QUEUE_KEY), 2)
 
-    @mock.patch("users.utils.redis.StrictRedis.get", return_value="123123")
-    def test_is_code_correct_not_working_with_str_return_from_redis(
-        self, mock_is_code_correct
+            with self.assertLogs("users.mail", "ERROR"):
+                self.assertEqual(send_queued_emails(), 1)
+            self.assertEqual(send_queued_emails(), 1)
+
+        self.assertEqual(get_redis().llen(MAIL_QUEUE_KEY), 0)
+        self.assertEqual(
+            get_redis().lrange(MAIL_DEAD_LETTER_KEY, 0, -1),
+            [b'{"email": "user0@email.com", "code": "000000"}'],
+        )
+        self.assertFalse(get_redis().exists(MAIL_ATTEMPTS_KEY))
+
+    def test_send_queued_emails_forgets_attempts_once_sent(self):
+        self.queue(1)
+        with mock.patch(
+            "django.core.mail.backends.locmem.EmailBackend.send_messages",
+            side_effect=[smtplib.SMTPServerDisconnected(), 1],
+        ):
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                send_queued_emails()
+            self.assertEqual(get_redis().hlen(MAIL_ATTEMPTS_KEY), 1)
+            self.assertEqual(send_queued_emails(), 1)
+        self.assertFalse(get_redis().exists(MAIL_ATTEMPTS_KEY))
+
+    @override_settings(VERIFICATION_EMAIL_BATCH_SIZE=2)
+    def test_send_queued_verification_codes_task(self):
+        self.queue(5)
+        self.assertEqual(send_queued_verification_codes(), 5)
+        self.assertEqual(len(mail.outbox), 5)
+
+    @override_settings(VERIFICATION_EMAIL_BATCH_SIZE=2)
+    def test_send_queued_verification_codes_task_stops_once_lock_expired(
+        self,
     ):
-        # returns false because the data that is fetched from redis
-        # should be in byte type.
-        # if you call `.decode()` on it, it will raise an AttributeError
+        self.queue(5)
+        send = send_queued_emails
+
+        def send_batch(batch_size):
+            # the batch took longer than the lock timeout
+            get_redis().delete(MAIL_LOCK_KEY)
+            return send(batch_size)
+
+        with mock.patch(
+            "users.tasks.send_queued_emails", side_effect=send_batch
+        ):
+            self.assertEqual(send_queued_verification_codes(), 2)
+        self.assertEqual(len(mail.outbox), 2)
+
+
+class TestOutbox(SimpleTestCase):
+    def setUp(self):
+        get_redis().delete(OUTBOX_KEY, OUTBOX_LOCK_KEY)
+        for i in range(3):
+            get_redis().delete(
+                VERIFICATION_CODE_KEY.format(email=f"user{i}@email.com")
+            )
+
+    def outbox(self):
+        return [
+            json.loads(entry) for entry in get_redis().lrange(OUTBOX_KEY, 0, -1)
+        ]
+
+    def test_outbox_verification_code(self):
+        self.assertTrue(outbox_verification_code("user0@email.com", "123456"))
+        # nothing is recorded for an email that still has a code
+        self.assertFalse(outbox_verification_code("user0@email.com", "654321"))
+
+        key = VERIFICATION_CODE_KEY.format(email="user0@email.com")
+        self.assertEqual(get_redis().get(key), b"123456")
+        self.assertGreater(get_redis().ttl(key), 0)
+        self.assertEqual(
+            self.outbox(), [{"email": "user0@email.com", "code": "123456"}]
+        )
+
+    @override_settings(VERIFICATION_EMAIL_DELIVERY="outbox")
+    @mock.patch("users.tasks.send_verification_code.delay")
+    def test_view_does_not_publish(self, mock_send):
+        url = reverse("send-verification-code")
+        responses = [
+            self.client.post(url, data={"email": "user0@email.com"})
+            for _ in range(2)
+        ]
+        self.assertEqual([r.status_code for r in responses], [200, 202])
+        self.assertFalse(mock_send.called)
+        self.assertEqual(len(self.outbox()), 1)
+
+    @mock.patch("users.tasks.send_verification_code.apply_async")
+    def test_dispatch_outbox(self, mock_apply_async):
+        for i in range(3):
+            outbox_verification_code(f"user{i}@email.com", f"{i:06}")
+
+        self.assertEqual(dispatch_outbox(batch_size=2), 2)
+        self.assertEqual(
+            [c.kwargs["kwargs"] for c in mock_apply_async.call_args_list],
+            [
+                {"email": "user0@email.com", "code": "000000"},
+                {"email": "user1@email.com", "code": "000001"},
+            ],
+        )
+        # every task of the batch is published over one connection
+        producers = {
+            c.kwargs["producer"] for c in mock_apply_async.call_args_list
+        }
+        self.assertEqual(len(producers), 1)
+        self.assertEqual(
+            self.outbox(), [{"email": "user2@email.com", "code": "000002"}]
+        )
+
+    @mock.patch("users.tasks.send_verification_code.apply_async")
+    def test_dispatch_outbox_broker_unavailable(self, mock_apply_async):
+        for i in range(3):
+            outbox_verification_code(f"user{i}@email.com", f"{i:06}")
+        mock_apply_async.side_effect = [None, OperationalError("down")]
+
+        with self.assertRaises(OperationalError):
+            dispatch_outbox()
+        # the email that was not published stays in the outbox
+        self.assertEqual(
+            [entry["email"] for entry in self.outbox()],
+            ["user1@email.com", "user2@email.com"],
+        )
+        self.assertFalse(get_redis().exists(OUTBOX_LOCK_KEY))
+
+    @mock.patch("users.tasks.send_verification_code.apply_async")
+    def test_dispatch_outbox_runs_once_at_a_time(self, mock_apply_async):
+        outbox_verification_code("user0@email.com", "123456")
+        lock = get_redis().lock(OUTBOX_LOCK_KEY, timeout=60)
+        lock.acquire()
+        try:
+            self.assertEqual(dispatch_outbox(), 0)
+        finally:
+            lock.release()
+        self.assertFalse(mock_apply_async.called)
+
+    @override_settings(VERIFICATION_EMAIL_BATCH_SIZE=2)
+    @mock.patch("users.tasks.send_verification_code.apply_async")
+    def test_dispatch_command(self, mock_apply_async):
+        for i in range(3):
+            outbox_verification_code(f"user{i}@email.com", f"{i:06}")
+
+        out = StringIO()
+        call_command("dispatch_verification_codes", "--once", stdout=out)
+        self.assertIn("Dispatched 3 emails", out.getvalue())
+        self.assertEqual(self.outbox(), [])
+
+
+class TestPrerenderedTemplate(SimpleTestCase):
+    def setUp(self):
+        self.templates_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.templates_dir.cleanup)
+        templates = [
+            {
+                "BACKEND": "django.template.backends.django.DjangoTemplates",
+                "DIRS": [
+                    self.templates_dir.name,
+                    *settings.TEMPLATES[0]["DIRS"],
+                ],
+            }
+        ]
+        settings_override = override_settings(TEMPLATES=templates)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def write(self, name, content, mtime):
+        path = os.path.join(self.templates_dir.name, name)
+        with open(path, "w") as f:
+            f.write(content)
+        os.utime(path, (mtime, mtime))
+
+    def test_verification_email_template(self):
+        verification_email_template.clear()
+        self.assertEqual(
+            verification_email_template.render("123456"),
+            render_to_string("email.html", {"code": "123456"}),
+        )
+
+    def test_template_is_compiled_once(self):
+        self.write("code.html", "<h1>{{ code }}</h1>", 1000)
+        template = PrerenderedTemplate("code.html", "code")
+
+        with mock.patch(
+            "users.mail.get_template", wraps=get_template
+        ) as mock_get_template:
+            self.assertEqual(template.render("123456"), "<h1>123456</h1>")
+            self.assertEqual(template.render("654321"), "<h1>654321</h1>")
+        self.assertEqual(mock_get_template.call_count, 1)
+        self.assertEqual(template.render("<b>"), "<h1>&lt;b&gt;</h1>")
+
+    def test_changed_template_is_compiled_again_in_debug(self):
+        self.write("code.html", "<h1>{{ code }}</h1>", 1000)
+        template = PrerenderedTemplate("code.html", "code")
+        template.render("123456")
+
+        self.write("code.html", "<h2>{{ code }}</h2>", 2000)
+        self.assertEqual(template.render("123456"), "<h1>123456</h1>")
+        with override_settings(DEBUG=True):
+            self.assertEqual(template.render("123456"), "<h2>123456</h2>")
+
+    def test_filtered_value_is_rendered(self):
+        self.write("code.html", "{{ code|slice:':3' }}", 1000)
+        template = PrerenderedTemplate("code.html", "code")
+        self.assertEqual(template.render("123456"), "123")
+        self.assertEqual(template.render("654321"), "654")
+
+
+@override_settings(ASYNC_API=True)
+class TestAsyncVerification(TransactionTestCase):
+    # the async views use their own connections, which only see committed
+    # rows
+
+    def setUp(self):
+        for pattern in ("throttle:*", "verification:code:*", "emails:*"):
+            for key in get_redis().scan_iter(pattern):
+                get_redis().delete(key)
+
+    def post(self, path, body, content_type="application/json", headers=()):
+        messages = []
+
+        async def run():
+            async def receive():
+                return {"type": "http.request", "body": body}
+
+            async def send(message):
+                messages.append(message)
+
+            scope = {
+                "type": "http",
+                "method": "POST",
+                "path": path,
+                "headers": [
+                    (b"content-type", content_type.encode()),
+                    *headers,
+                ],
+                "client": ("127.0.0.1", 1234),
+            }
+            try:
+                await asyncio.wait_for(application(scope, receive, send), 5)
+            finally:
+                await close_connections()
+
+        async_to_sync(run)()
+        self.response_headers = {
+            name.decode(): value.decode()
+            for name, value in messages[0]["headers"]
+        }
+        return messages[0]["status"], json.loads(messages[1]["body"])
+
+    @mock.patch("users.aio.deliver_verification_code")
+    def test_send_verification_code(self, mock_send):
+        url = reverse("send-verification-code")
+        body = json.dumps({"email": "test@email.com"}).encode()
+
+        self.assertEqual(self.post(url, body)[0], 200)
+        self.assertEqual(self.post(url, body)[0], 202)
+        mock_send.assert_called_once()
+        code = get_redis().get(
+            VERIFICATION_CODE_KEY.format(email="test@email.com")
+        )
+        self.assertEqual(
+            mock_send.call_args[0], ("test@email.com", code.decode())
+        )
+
+        status, body = self.post(url, b"{}")
+        self.assertEqual(status, 400)
+        self.assertEqual(body, {"email": ["This field is required."]})
+
+    @override_settings(VERIFICATION_EMAIL_DELIVERY="outbox")
+    @mock.patch("users.aio.deliver_verification_code")
+    def test_send_verification_code_outbox(self, mock_send):
+        get_redis().delete(OUTBOX_KEY)
+        status, _ = self.post(
+            reverse("send-verification-code"),
+            b"email=test%40email.com",
+            content_type="application/x-www-form-urlencoded",
+        )
+        self.assertEqual(status, 200)
+        self.assertFalse(mock_send.called)
+        self.assertEqual(get_redis().llen(OUTBOX_KEY), 1)
+
+    def test_check_verification_code(self):
+        url = reverse("check-verification-code")
+        set_verification_code("test@email.com", "123456")
+
+        status, body = self.post(
+            url,
+            json.dumps({"email": "test@email.com", "code": "654321"}).encode(),
+        )
+        self.assertEqual(
+            (status, body), (401, {"detail": "Code is not correct"})
+        )
+
+        status, body = self.post(
+            url,
+            json.dumps({"email": "test@email.com", "code": "123456"}).encode(),
+        )
+        self.assertEqual(status, 200)
+        email_obj = Emails.objects.get(email="test@email.com")
+        self.assertTrue(email_obj.is_active)
+        self.assertEqual(load_voter_token(body["token"])[0], email_obj.id)
+        # the identity is cached for the vote endpoint
+        self.assertEqual(
+            probe_email("test@email.com")[0], EmailIdentity(email_obj.id, True)
+        )
+
+    @mock.patch("redis.asyncio.Redis.set", side_effect=RedisError)
+    @mock.patch(
+        "users.aio.ADD_TO_FILTER_SCRIPT", "return redis.error_reply('down')"
+    )
+    def test_check_verification_code_redis_write_fails(self, redis_set):
+        Emails.objects.rebuild_filter()
+        set_verification_code("test@email.com", "123456")
+
+        status, body = self.post(
+            reverse("check-verification-code"),
+            json.dumps({"email": "test@email.com", "code": "123456"}).encode(),
+        )
+        # the email is active all the same
+        self.assertEqual(status, 200)
+        self.assertIn("token", body)
+        email_obj = Emails.objects.get(email="test@email.com")
+        self.assertTrue(email_obj.is_active)
+        # lookups read the database until the filter is rebuilt
+        self.assertFalse(get_redis().exists(email_filter_key()))
+        self.assertEqual(
+            Emails.objects.lookup("test@email.com"),
+            EmailIdentity(email_obj.id, True),
+        )
+
+    @mock.patch("users.aio.activate_email", side_effect=RuntimeError)
+    def test_unexpected_error(self, activate_email):
+        set_verification_code("test@email.com", "123456")
+        with self.assertLogs("users.aio", "ERROR"):
+            status, body = self.post(
+                reverse("check-verification-code"),
+                json.dumps(
+                    {"email": "test@email.com", "code": "123456"}
+                ).encode(),
+                headers=[(b"origin", b"http://localhost:3000")],
+            )
+        self.assertEqual(status, 500)
+        self.assertEqual(body, {"detail": "A server error occurred."})
+        self.assertEqual(
+            self.response_headers["access-control-allow-origin"],
+            "http://localhost:3000",
+        )
+
+    @mock.patch.object(
+        RedisScopedRateThrottle, "THROTTLE_RATES", {"email": "1/min"}
+    )
+    def test_throttle_is_shared_with_django(self):
+        url = reverse("send-verification-code")
+        with override_settings(ASYNC_API=False):
+            self.assertEqual(self.client.post(url).status_code, 400)
+
+        status, body = self.post(url, b"{}")
+        self.assertEqual(status, 429)
+        self.assertIn("throttled", body["detail"])
+
+    def test_cors_headers(self):
+        url = reverse("check-verification-code")
+        allowed = (b"origin", b"http://localhost:3000")
+        with override_settings(ASYNC_API=False):
+            response = self.client.post(
+                url, HTTP_ORIGIN="http://localhost:3000"
+            )
+        status, _ = self.post(url, b"{}", headers=[allowed])
+        self.assertEqual(status, 400)
+        self.assertEqual(
+            self.response_headers["access-control-allow-origin"],
+            response["access-control-allow-origin"],
+        )
+        self.assertEqual(self.response_headers["vary"], "Origin")
+
+        self.post(url, b"{}", headers=[(b"origin", b"http://evil.com")])
+        self.assertNotIn("access-control-allow-origin", self.response_headers)
+        self.assertEqual(self.response_headers["vary"], "Origin")
 
-        self.assertFalse(is_code_correct("test@gmail.com", "123123"))
-        self.assertTrue(mock_is_code_correct.called)
+    def test_multipart_is_served_by_django(self):
+        scope = {
+            "method": "POST",
+            "headers": [(b"content-type", b"multipart/form-data; boundary=x")],
+        }
+        self.assertFalse(EmailAsyncView().handles(scope))
+        scope["headers"] = [
+            (b"content-type", b"application/json; charset=utf-8")
+        ]
+        self.assertTrue(EmailAsyncView().handles(scope))
+        scope["method"] = "GET"
+        self.assertFalse(EmailAsyncView().handles(scope))
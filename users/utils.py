@@ -1,10 +1,93 @@
+import functools
+import hashlib
+import logging
+import math
 import random
 import string
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from typing import Iterable, Optional, Tuple
 
 import redis
+from config.metrics.instruments import RedisConnection
 from django.conf import settings
+from django.core import signing
+from redis.exceptions import LockNotOwnedError
 
-r = redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=0)
+logger = logging.getLogger(__name__)
+
+_redis = None
+_redis_lock = threading.Lock()
+
+
+def get_redis() -> redis.StrictRedis:
+    """Redis client shared by the whole process
+
+    The connection pool is created on first use and holds at most
+    `REDIS_MAX_CONNECTIONS` connections, a caller waits up to
+    `REDIS_POOL_TIMEOUT` seconds for a free one. A process forked after the
+    pool was created (e.g. a gunicorn or celery worker) opens connections
+    of its own, redis-py resets the pool when it notices the fork.
+
+    Returns:
+        redis.StrictRedis: client
+    """
+    global _redis
+    if _redis is None:
+        with _redis_lock:
+            if _redis is None:
+                pool = redis.BlockingConnectionPool(
+                    host=settings.REDIS_HOST,
+                    port=settings.REDIS_PORT,
+                    db=0,
+                    max_connections=settings.REDIS_MAX_CONNECTIONS,
+                    timeout=settings.REDIS_POOL_TIMEOUT,
+                    connection_class=RedisConnection,
+                )
+                _redis = redis.StrictRedis(connection_pool=pool)
+    return _redis
+
+
+@functools.lru_cache(maxsize=None)
+def get_script(source: str) -> redis.commands.core.Script:
+    """Lua script bound to `get_redis()`, loaded into Redis on first call"""
+    return get_redis().register_script(source)
+
+
+def extend_lock(lock: redis.lock.Lock) -> bool:
+    """Give a held lock its whole timeout again, e.g. between two batches
+    of a long task
+
+    Returns:
+        bool: False if the lock expired and may be held by someone else
+    """
+    try:
+        return lock.reacquire()
+    except LockNotOwnedError:
+        logger.warning("Lock %s expired while held", lock.name)
+        return False
+
+
+def release_lock(lock: redis.lock.Lock):
+    """Release a held lock, unless it already expired"""
+    try:
+        lock.release()
+    except LockNotOwnedError:
+        logger.warning("Lock %s expired while held", lock.name)
+
+
+VERIFICATION_CODE_KEY = "verification:code:{email}"
+
+# a code is only deleted by the request that uses it, a wrong code leaves
+# it in place for the next attempt
+USE_CODE_SCRIPT = """
+    if redis.call("GET", KEYS[1]) == ARGV[1] then
+        return redis.call("DEL", KEYS[1])
+    end
+    return 0
+    """
 
 
 def generate_verification_code() -> str:
@@ -17,41 +100,318 @@ def generate_verification_code() -> str:
 
 
 def set_verification_code(email: str, code: str) -> bool:
-    """Set a key and value in Redis
+    """Store a code for an email unless it already has one
+
+    Checking and setting is one `SET NX EX` command, so concurrent requests
+    never both get to send a code.
 
     Args:
-        email (str): The key that will be used to save code in Redis
+        email (str): email the code is sent to
         code (str): A random 6-digit string
+
+    Returns:
+        bool: False if the email still has a code that did not expire
     """
-    return r.set(email, code, ex=settings.VERIFICATION_CODE_EXPIRY)
+    return bool(
+        get_redis().set(
+            VERIFICATION_CODE_KEY.format(email=email),
+            code,
+            ex=settings.VERIFICATION_CODE_EXPIRY,
+            nx=True,
+        )
+    )
 
 
-def is_code_in_redis(email: str) -> bool:
-    """Check redis with `email` key .e.g `test@example.com`
-    return True if any code is associated with the email
+def use_verification_code(email: str, user_provided_code: str) -> bool:
+    """Check the code of an email and delete it if it is correct, in one
+    atomic step so a code can only be used once
 
     Args:
         email (str): user provided email
+        user_provided_code (str): The code that user sends to API
+
+    Returns:
+        bool: whether the code is correct
+    """
+    script = get_script(USE_CODE_SCRIPT)
+    return bool(
+        script(
+            keys=[VERIFICATION_CODE_KEY.format(email=email)],
+            args=[str(user_provided_code)],
+        )
+    )
+
+
+VOTER_TOKEN_SALT = "users.voter-token"
+
+# time the tokens of an email were revoked at, a cache of
+# `Emails.tokens_revoked_at` (0 if they never were)
+VOTER_TOKEN_REVOKED_KEY = "voter:revoked:{email_id}"
+
+
+def issue_voter_token(email_id: int) -> str:
+    """Sign the id of a verified email and the time it was verified at
+
+    Args:
+        email_id (int): primary key of `users.models.Emails`
 
     Returns:
-        bool: whether there is a code in Redis or not
+        str: token valid for `VOTER_TOKEN_MAX_AGE` seconds
     """
-    code = r.get(email)
-    return code != None
+    return signing.dumps(
+        {"id": email_id, "at": int(time.time() * 1000)}, salt=VOTER_TOKEN_SALT
+    )
 
 
-def is_code_correct(email: str, user_provided_code: str) -> bool:
-    """Get the code from Redis using `email` as key
+def load_voter_token(token: str) -> Optional[Tuple[int, int]]:
+    """Check the signature and the age of a voter token
 
     Args:
-        email (str): Email will be used as a key to get data from Redis
-        user_provided_code (str): The code that user sends to API
+        token (str): token issued by `issue_voter_token`
 
     Returns:
-        bool: if the code in Redis is equal to user provided code then return True
+        Optional[Tuple[int, int]]: id of the email and the time the token
+        was issued at in milliseconds, None if the token is not valid
     """
     try:
-        code_in_db = r.get(email).decode()
-        return str(user_provided_code) == str(code_in_db)
-    except AttributeError:
-        return False
+        payload = signing.loads(
+            token, salt=VOTER_TOKEN_SALT, max_age=settings.VOTER_TOKEN_MAX_AGE
+        )
+        return int(payload["id"]), int(payload["at"])
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        return None
+
+
+def is_voter_token_revoked(email_id: int, issued_at: int) -> Optional[bool]:
+    """Check a token against the revocation cached in Redis
+
+    Returns:
+        Optional[bool]: None if the revocation of the email is not cached,
+        see `users.models.EmailsManager.tokens_revoked_at`
+    """
+    revoked_at = get_redis().get(
+        VOTER_TOKEN_REVOKED_KEY.format(email_id=email_id)
+    )
+    if revoked_at is None:
+        return None
+    return issued_at <= int(revoked_at)
+
+
+def tokens_revoked_at(
+    is_active: Optional[bool], revoked_at: Optional[datetime]
+) -> int:
+    """Time in milliseconds the tokens of an email issued until are revoked
+
+    Args:
+        is_active (Optional[bool]): state of the email, None if it does not
+        exist
+        revoked_at (Optional[datetime]): `Emails.tokens_revoked_at`
+
+    Returns:
+        int: now for an inactive or deleted email, 0 if no token was revoked
+    """
+    if not is_active:
+        return int(time.time() * 1000)
+    return int(revoked_at.timestamp() * 1000) if revoked_at else 0
+
+
+def cache_tokens_revoked_at(email_id: int, revoked_at: int) -> bool:
+    """Cache the revocation of the tokens of an email read from the database
+
+    It is kept `VOTER_TOKEN_REVOCATION_CACHE_TTL` seconds, which bounds how
+    long a revocation Redis missed is not seen.
+    """
+    return get_redis().set(
+        VOTER_TOKEN_REVOKED_KEY.format(email_id=email_id),
+        revoked_at,
+        ex=settings.VOTER_TOKEN_REVOCATION_CACHE_TTL,
+    )
+
+
+def revoke_voter_tokens(*email_ids: int) -> bool:
+    """Cache the revocation of every token issued to emails so far, once
+    `Emails.tokens_revoked_at` is committed
+
+    Args:
+        email_ids (int): primary keys of `users.models.Emails`
+    """
+    revoked_at = int(time.time() * 1000)
+    pipe = get_redis().pipeline(transaction=False)
+    for email_id in email_ids:
+        pipe.set(
+            VOTER_TOKEN_REVOKED_KEY.format(email_id=email_id),
+            revoked_at,
+            ex=settings.VOTER_TOKEN_MAX_AGE,
+        )
+    return all(pipe.execute())
+
+
+EmailIdentity = namedtuple("EmailIdentity", ["id", "is_active"])
+
+EMAIL_IDENTITY_KEY = "emails:identity:{email}"
+
+
+def cache_email_identity(email: str, email_id: int, is_active: bool) -> bool:
+    """Cache the id and the state of an email in Redis
+
+    Args:
+        email (str): email address
+        email_id (int): primary key of `users.models.Emails`
+        is_active (bool): whether the email is verified
+    """
+    return get_redis().set(
+        EMAIL_IDENTITY_KEY.format(email=email),
+        f"{email_id}:{int(is_active)}",
+        ex=settings.EMAIL_IDENTITY_CACHE_TTL,
+    )
+
+
+def cache_email_identities(
+    identities: Iterable[Tuple[str, int, bool]], chunk_size: int = 1000
+) -> int:
+    """Cache many emails, `chunk_size` emails per round trip
+
+    Args:
+        identities (Iterable[Tuple[str, int, bool]]): `(email, id,
+        is_active)` tuples
+
+    Returns:
+        int: number of cached emails
+    """
+    count = 0
+    pipe = get_redis().pipeline(transaction=False)
+    for email, email_id, is_active in identities:
+        pipe.set(
+            EMAIL_IDENTITY_KEY.format(email=email),
+            f"{email_id}:{int(is_active)}",
+            ex=settings.EMAIL_IDENTITY_CACHE_TTL,
+        )
+        count += 1
+        if count % chunk_size == 0:
+            pipe.execute()
+    pipe.execute()
+    return count
+
+
+def forget_email_identity(*emails: str) -> int:
+    return get_redis().delete(
+        *[EMAIL_IDENTITY_KEY.format(email=email) for email in emails]
+    )
+
+
+def email_filter_size() -> Tuple[int, int]:
+    """Size of the Bloom filter of known emails
+
+    Returns:
+        Tuple[int, int]: number of bits and number of hash functions needed
+        for `EMAIL_FILTER_CAPACITY` emails with `EMAIL_FILTER_ERROR_RATE`
+    """
+    capacity = settings.EMAIL_FILTER_CAPACITY
+    error_rate = settings.EMAIL_FILTER_ERROR_RATE
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+
+def email_filter_key() -> str:
+    # the size is part of the key, so resizing the filter never reads a
+    # filter that was built with another size
+    return "emails:filter:{}:{}".format(*email_filter_size())
+
+
+def email_filter_offsets(email: str) -> list:
+    """Bit offsets of an email in the Bloom filter (double hashing)"""
+    bits, hashes = email_filter_size()
+    digest = hashlib.blake2b(email.encode(), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "big")
+    h2 = int.from_bytes(digest[8:], "big") | 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+# only set bits of an existing filter, setting bits on a missing key would
+# create a filter that does not know about any other email
+ADD_TO_FILTER_SCRIPT = """
+    if redis.call("EXISTS", KEYS[1]) == 0 then
+        return 0
+    end
+    for _, offset in ipairs(ARGV) do
+        redis.call("SETBIT", KEYS[1], offset, 1)
+    end
+    return 1
+    """
+
+
+def add_to_email_filter(*emails: str) -> bool:
+    """Add emails to the Bloom filter of known emails
+
+    Nothing is added while the filter does not exist, it is created from
+    the database by `build_email_filter`.
+
+    Returns:
+        bool: whether the filter exists
+    """
+    offsets = [o for email in emails for o in email_filter_offsets(email)]
+    script = get_script(ADD_TO_FILTER_SCRIPT)
+    return bool(script(keys=[email_filter_key()], args=offsets))
+
+
+def drop_email_filter() -> bool:
+    """Delete the Bloom filter of known emails, lookups read the database
+    until `build_email_filter` creates it again"""
+    return bool(get_redis().delete(email_filter_key()))
+
+
+def build_email_filter(emails: Iterable[str]) -> int:
+    """Replace the Bloom filter of known emails
+
+    The filter is built in memory, written to a temporary key and renamed,
+    so lookups never see a partial filter.
+
+    Args:
+        emails (Iterable[str]): every known email
+
+    Returns:
+        int: number of emails in the filter
+    """
+    bits, _ = email_filter_size()
+    bitmap = bytearray(math.ceil(bits / 8))
+    count = 0
+    for email in emails:
+        for offset in email_filter_offsets(email):
+            bitmap[offset // 8] |= 0x80 >> (offset % 8)
+        count += 1
+
+    key = email_filter_key()
+    client = get_redis()
+    client.set(f"{key}:building", bytes(bitmap))
+    client.rename(f"{key}:building", key)
+    return count
+
+
+def probe_email(email: str) -> Tuple[Optional[EmailIdentity], bool]:
+    """Look an email up in the identity cache and the Bloom filter with one
+    round trip to Redis
+
+    Args:
+        email (str): user provided email
+
+    Returns:
+        Tuple[Optional[EmailIdentity], bool]: cached identity if any, and
+        False if the email is certainly unknown
+    """
+    key = email_filter_key()
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.get(EMAIL_IDENTITY_KEY.format(email=email))
+    pipe.exists(key)
+    for offset in email_filter_offsets(email):
+        pipe.getbit(key, offset)
+    cached, filter_exists, *filter_bits = pipe.execute()
+
+    identity = None
+    if cached is not None:
+        email_id, is_active = cached.decode().split(":")
+        identity = EmailIdentity(int(email_id), is_active == "1")
+
+    # without a filter every email might be known
+    maybe_known = not filter_exists or all(filter_bits)
+    return identity, maybe_known
@@ -0,0 +1,152 @@
+"""Native async `PUT /api/vote/`, see `users.aio`"""
+
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import asyncpg
+import redis
+from rest_framework import status
+from rest_framework.exceptions import PermissionDenied
+from users.aio import (
+    AsyncAPIView,
+    AsyncRequest,
+    get_async_redis,
+    get_db_pool,
+    lookup_email,
+)
+
+from .cache import CATALOG_VERSION_KEY
+from .ingest import STREAM_KEY, Row, is_buffered
+from .models import Voters, Votes
+from .serializer import VoteUpdateSerializer
+from .utils import vote_options_cache
+
+
+async def get_catalog_version() -> int:
+    """Async `votes.cache.get_catalog_version`"""
+    client = get_async_redis()
+    version = await client.get(CATALOG_VERSION_KEY)
+    if version is None:
+        await client.set(CATALOG_VERSION_KEY, int(time.time() * 1000), nx=True)
+        version = await client.get(CATALOG_VERSION_KEY)
+    return int(version)
+
+
+async def get_vote_options(
+    vote_ids: Iterable[int],
+) -> Dict[int, Optional[List[str]]]:
+    """Async `vote_options_cache.get_many`, sharing its entries"""
+    vote_ids = set(vote_ids)
+    try:
+        version = await get_catalog_version()
+    except redis.RedisError:
+        return await load_vote_options(vote_ids)
+
+    now = time.monotonic()
+    found = vote_options_cache.cached(version, vote_ids, now)
+    missing = vote_ids - found.keys()
+    if missing:
+        loaded = await load_vote_options(missing)
+        found.update(loaded)
+        vote_options_cache.update(version, loaded, now)
+    return found
+
+
+async def load_vote_options(vote_ids: set) -> Dict[int, Optional[List[str]]]:
+    options = dict.fromkeys(vote_ids)
+    async with (await get_db_pool()).acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT id, first_option, second_option "
+            f"FROM {Votes._meta.db_table} WHERE id = ANY($1::bigint[])",
+            list(vote_ids),
+        )
+    for row in rows:
+        options[row["id"]] = [row["first_option"], row["second_option"]]
+    return options
+
+
+async def save_votes(rows: List[Row]) -> bool:
+    """Async `votes.ingest.save_votes`
+
+    Raises:
+        asyncpg.ForeignKeyViolationError: a vote was deleted
+
+    Returns:
+        bool: True if the votes were buffered instead of written
+    """
+    if is_buffered():
+        pipe = get_async_redis().pipeline(transaction=False)
+        for voter_id, vote_id, choice in rows:
+            pipe.xadd(
+                STREAM_KEY,
+                {"voter_id": voter_id, "vote_id": vote_id, "choice": choice},
+            )
+        await pipe.execute()
+        return True
+
+    table = Voters._meta.db_table
+    values = ", ".join(
+        f"(${i * 3 + 1}, ${i * 3 + 2}, ${i * 3 + 3})" for i in range(len(rows))
+    )
+    async with (await get_db_pool()).acquire() as conn:
+        await conn.execute(
+            f"INSERT INTO {table} (voter_id, vote_id, choice) "
+            f"VALUES {values} "
+            "ON CONFLICT (voter_id, vote_id) "
+            "DO UPDATE SET choice = EXCLUDED.choice "
+            f"WHERE {table}.choice IS DISTINCT FROM EXCLUDED.choice",
+            *[value for row in rows for value in row],
+        )
+    return False
+
+
+class VotesAsyncView(AsyncAPIView):
+    """`votes.api.VotesView.put`, other methods are served by django"""
+
+    throttle_scope = "vote"
+    accept_voter_token = True
+
+    async def put(self, request: AsyncRequest) -> Tuple[int, dict]:
+        serializer = VoteUpdateSerializer(
+            data=request.data, context={"request": request}
+        )
+        serializer.is_valid(raise_exception=True)
+
+        vote_id = serializer.data.get("vote_id")
+        user_choice = serializer.data.get("user_choice")
+        ALLOWED_CHOICES = (await get_vote_options([vote_id]))[vote_id]
+        if ALLOWED_CHOICES is None:
+            return status.HTTP_404_NOT_FOUND, {"detail": "vote does not exist"}
+
+        if user_choice not in ALLOWED_CHOICES:
+            return status.HTTP_400_BAD_REQUEST, {
+                "detail": f"{user_choice!r} is not a valid option",
+                "valid_options": ALLOWED_CHOICES,
+            }
+
+        if request.auth is not None:
+            email_obj = request.user
+        else:
+            email_obj = await lookup_email(serializer.data.get("email"))
+        if email_obj is None:
+            return status.HTTP_404_NOT_FOUND, {"detail": "email not found"}
+        if not email_obj.is_active:
+            raise PermissionDenied(detail="email not activated")
+
+        try:
+            buffered = await save_votes(
+                [(email_obj.id, vote_id, ALLOWED_CHOICES.index(user_choice))]
+            )
+        except asyncpg.ForeignKeyViolationError:
+            # the vote was deleted after it was validated
+            return status.HTTP_404_NOT_FOUND, {"detail": "vote does not exist"}
+
+        if buffered:
+            return status.HTTP_202_ACCEPTED, {
+                "detail": "accepted",
+                "user_choice": user_choice,
+            }
+        return status.HTTP_200_OK, {
+            "detail": "successful",
+            "user_choice": user_choice,
+        }
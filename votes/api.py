@@ -1,38 +1,113 @@
-from django.db.models import Q
+from typing import Optional
+
+from config.db.routers import use_replicas
+from django.db import IntegrityError
+from django.http import HttpResponse
+from django.utils.cache import parse_etags, patch_cache_control
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
+from redis import RedisError
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from users.authentication import VoterTokenAuthentication
 from users.models import Emails
+from users.utils import EmailIdentity
 
-from .models import Voters, Votes
+from .cache import (
+    catalog_etag,
+    get_cached_catalog_page,
+    get_catalog_version,
+    set_cached_catalog_page,
+)
+from .ingest import drop_orphans, save_votes
+from .models import Votes
+from .pagination import VotesCursorPagination
 from .permission import ActiveEmailOnly
-from .serializer import VotesSerializer, VoteUpdateSerializer
+from .serializer import (
+    VoteBatchSerializer,
+    VotesSerializer,
+    VoteUpdateSerializer,
+)
+from .utils import get_vote_results, vote_options_cache
+
+
+def get_voter(request, email: str) -> Optional[EmailIdentity]:
+    """Identity of the voter, from the voter token if the request has one
+    or else from the email in its body
+
+    Args:
+        request (rest_framework.request.Request): request
+        email (str): email sent by a request without a token
+
+    Returns:
+        Optional[EmailIdentity]: `(id, is_active)` or None if the email
+        does not exist
+    """
+    if request.auth is not None:
+        return request.user
+    return Emails.objects.lookup(email)
 
 
 class VotesView(APIView):
+    authentication_classes = [VoterTokenAuthentication]
     permission_classes = [ActiveEmailOnly]
+    throttle_scope = "vote"
+
+    def get_throttles(self):
+        # only casting votes is throttled, the catalog is served from cache
+        if self.request.method != "PUT":
+            return []
+        return super().get_throttles()
 
     @swagger_auto_schema(
         operation_id="Get list of votes",
         operation_description=f"""
-        Get list of votes 
+        Get list of votes ordered by id, one page at a time.
+        Follow the `next` link to get the following page.
+
+        Use `fields` to only get some of the fields e.g. `?fields=id,title`
         """,
+        manual_parameters=[
+            openapi.Parameter(
+                "cursor", openapi.IN_QUERY, type=openapi.TYPE_STRING
+            ),
+            openapi.Parameter(
+                "page_size", openapi.IN_QUERY, type=openapi.TYPE_INTEGER
+            ),
+            openapi.Parameter(
+                "fields", openapi.IN_QUERY, type=openapi.TYPE_STRING
+            ),
+        ],
         responses={
             200: openapi.Response(
                 description="ok",
                 examples={
-                    "application/json": [
-                        {
-                            "id": 1,
-                            "title": "cats vs dogs",
-                            "slug": "cats-vs-dogs",
-                            "description": "test vote",
-                            "first_option": "cats",
-                            "second_option": "dogs",
-                        },
-                    ]
+                    "application/json": {
+                        "next": "http://localhost/api/vote/?cursor=cD0x",
+                        "previous": None,
+                        "results": [
+                            {
+                                "id": 1,
+                                "title": "cats vs dogs",
+                                "slug": "cats-vs-dogs",
+                                "description": "test vote",
+                                "first_option": "cats",
+                                "second_option": "dogs",
+                            },
+                        ],
+                    }
+                },
+            ),
+            304: openapi.Response(description="not modified"),
+            400: openapi.Response(
+                description="unknown fields",
+                examples={
+                    "application/json": {
+                        "detail": "unknown fields: 'votes'",
+                        "valid_fields": ["id", "title", "slug"],
+                    }
                 },
             ),
         },
@@ -41,15 +116,83 @@ class VotesView(APIView):
     def get(self, request):
         """Get list of votes
 
+        Rendered pages are cached in Redis under the current catalog version,
+        which is bumped whenever a vote is saved or deleted. The version is
+        also sent as `ETag` so clients can poll with `If-None-Match`.
+
+        Args:
+            request (django.request): django request object
+
+        Returns:
+            rest_framework.response.Response: a page of votes in Json format
+            | 304 | 400
+        """
+        url = request.build_absolute_uri()
+        try:
+            version = get_catalog_version()
+            etag = catalog_etag(version)
+            if etag in parse_etags(request.headers.get("If-None-Match", "")):
+                return Response(
+                    status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag}
+                )
+            content = get_cached_catalog_page(version, url)
+        except RedisError:
+            # serve the catalog from the database while Redis is unavailable
+            version = content = None
+
+        if content is not None:
+            response = HttpResponse(content, content_type="application/json")
+        elif version is None:
+            return self.list_votes(request)
+        else:
+            # the page is cached until the next version, a lagging replica
+            # would keep serving it without the latest votes
+            with use_replicas(False):
+                response = self.list_votes(request)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            try:
+                set_cached_catalog_page(
+                    version, url, JSONRenderer().render(response.data)
+                )
+            except RedisError:
+                pass
+
+        response["ETag"] = etag
+        patch_cache_control(response, no_cache=True)
+        return response
+
+    def list_votes(self, request):
+        """Get a page of votes from the database
+
         Args:
             request (django.request): django request object
 
         Returns:
-            rest_framework.response.Response: list of all votes in Json format
+            rest_framework.response.Response: a page of votes | 400
         """
         votes = Votes.objects.all()
-        serializer = VotesSerializer(instance=votes, many=True)
-        return Response(serializer.data)
+
+        fields = None
+        if request.query_params.get("fields"):
+            fields = request.query_params.get("fields").split(",")
+            valid_fields = list(VotesSerializer().fields)
+            unknown_fields = [f for f in fields if f not in valid_fields]
+            if unknown_fields:
+                return Response(
+                    {
+                        "detail": f"unknown fields: {', '.join(map(repr, unknown_fields))}",
+                        "valid_fields": valid_fields,
+                    },
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            # `id` is always loaded, the cursor is built from it
+            votes = votes.only("id", *fields)
+
+        paginator = VotesCursorPagination()
+        page = paginator.paginate_queryset(votes, request, view=self)
+        serializer = VotesSerializer(instance=page, many=True, fields=fields)
+        return paginator.get_paginated_response(serializer.data)
 
     @swagger_auto_schema(
         operation_id="Insert or Update vote",
@@ -67,6 +210,15 @@ class VotesView(APIView):
                     }
                 },
             ),
+            202: openapi.Response(
+                description="accepted, the vote will be saved shortly",
+                examples={
+                    "application/json": {
+                        "detail": "accepted",
+                        "user_choice": "cats",
+                    }
+                },
+            ),
             404: openapi.Response(
                 description="vote does not exist",
                 examples={
@@ -88,31 +240,28 @@ class VotesView(APIView):
     def put(self, request):
         """update if already exists or add new data to `votes.models.Voters`
 
+        The vote and the choice are checked against `vote_options_cache`
+        before the email is looked up (see `Emails.objects.lookup`), or
+        taken from the voter token without any lookup, then the vote is
+        written with one `INSERT ... ON CONFLICT` statement, or
+        appended to the ingestion stream when `VOTES_INGESTION_MODE` is
+        `buffered`.
+
         Args:
             request (django.request): django request object
 
         Returns:
-            rest_framework.response.Response: successful | 404 | 400
+            rest_framework.response.Response: successful | 202 | 404 | 403
+            | 400
         """
-        serializer = VoteUpdateSerializer(data=request.data)
+        serializer = VoteUpdateSerializer(
+            data=request.data, context={"request": request}
+        )
         serializer.is_valid(raise_exception=True)
 
-        try:
-            email_obj = Emails.objects.get(email=serializer.data.get("email"))
-        except Emails.DoesNotExist:
-            return Response(
-                {"detail": "email not found"}, status=status.HTTP_404_NOT_FOUND
-            )
-
-        self.check_object_permissions(request, email_obj)
-
-        try:
-            user_vote = Votes.objects.get(id=serializer.data.get("vote_id"))
-            ALLOWED_CHOICES = [
-                user_vote.first_option,
-                user_vote.second_option,
-            ]
-        except Votes.DoesNotExist:
+        vote_id = serializer.data.get("vote_id")
+        ALLOWED_CHOICES = vote_options_cache.get(vote_id)
+        if ALLOWED_CHOICES is None:
             return Response(
                 {"detail": "vote does not exist"},
                 status=status.HTTP_404_NOT_FOUND,
@@ -127,16 +276,41 @@ class VotesView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+        email_obj = get_voter(request, serializer.data.get("email"))
+        if email_obj is None:
+            return Response(
+                {"detail": "email not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+
+        self.check_object_permissions(request, email_obj)
+
         try:
-            voter = Voters.objects.get(Q(voter=email_obj) & Q(vote=user_vote))
-            voter.user_choice = serializer.data.get("user_choice")
-        except Voters.DoesNotExist:
-            voter = Voters(
-                voter=email_obj,
-                vote=user_vote,
-                user_choice=serializer.data.get("user_choice"),
+            buffered = save_votes(
+                [
+                    (
+                        email_obj.id,
+                        vote_id,
+                        ALLOWED_CHOICES.index(
+                            serializer.data.get("user_choice")
+                        ),
+                    )
+                ]
+            )
+        except IntegrityError:
+            # the vote was deleted after it was validated
+            return Response(
+                {"detail": "vote does not exist"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        if buffered:
+            return Response(
+                {
+                    "detail": "accepted",
+                    "user_choice": serializer.data.get("user_choice"),
+                },
+                status=status.HTTP_202_ACCEPTED,
             )
-        voter.save()
 
         return Response(
             {
@@ -144,3 +318,190 @@ class VotesView(APIView):
                 "user_choice": serializer.data.get("user_choice"),
             }
         )
+
+
+class VotesBatchView(APIView):
+    authentication_classes = [VoterTokenAuthentication]
+    permission_classes = [ActiveEmailOnly]
+    throttle_scope = "vote"
+
+    @swagger_auto_schema(
+        operation_id="Insert or Update a ballot of votes",
+        operation_description=f"""
+        Users can update/insert their vote on several votes at once.
+        Every vote gets its own result, invalid votes do not prevent
+        the others from being saved.
+        """,
+        request_body=VoteBatchSerializer,
+        responses={
+            200: openapi.Response(
+                description="ok",
+                examples={
+                    "application/json": {
+                        "results": [
+                            {
+                                "vote_id": 1,
+                                "status": 200,
+                                "detail": "successful",
+                                "user_choice": "cats",
+                            },
+                            {
+                                "vote_id": 2,
+                                "status": 404,
+                                "detail": "vote does not exist",
+                            },
+                            {
+                                "vote_id": 3,
+                                "status": 400,
+                                "detail": "'fox' is not a valid option",
+                                "valid_options": ["red", "blue"],
+                            },
+                        ]
+                    }
+                },
+            ),
+            404: openapi.Response(
+                description="email not found",
+                examples={"application/json": {"detail": "email not found"}},
+            ),
+        },
+        security=[],
+    )
+    def put(self, request):
+        """update if already exists or add new data to `votes.models.Voters`
+        for every vote of the ballot
+
+        The email (unless it is cached or the request has a voter token),
+        the options of all votes that are not in `vote_options_cache` and
+        the upsert of all valid votes take one query each.
+
+        Args:
+            request (django.request): django request object
+
+        Returns:
+            rest_framework.response.Response: per vote results | 404 | 403
+            | 400
+        """
+        serializer = VoteBatchSerializer(
+            data=request.data, context={"request": request}
+        )
+        serializer.is_valid(raise_exception=True)
+
+        email_obj = get_voter(request, serializer.data.get("email"))
+        if email_obj is None:
+            return Response(
+                {"detail": "email not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+
+        self.check_object_permissions(request, email_obj)
+
+        ballot = serializer.data.get("votes")
+        vote_options = vote_options_cache.get_many(
+            item["vote_id"] for item in ballot
+        )
+
+        results, rows = [], []
+        for item in ballot:
+            vote_id, user_choice = item["vote_id"], item["user_choice"]
+            ALLOWED_CHOICES = vote_options.get(vote_id)
+            if ALLOWED_CHOICES is None:
+                results.append(
+                    {
+                        "vote_id": vote_id,
+                        "status": status.HTTP_404_NOT_FOUND,
+                        "detail": "vote does not exist",
+                    }
+                )
+            elif user_choice not in ALLOWED_CHOICES:
+                results.append(
+                    {
+                        "vote_id": vote_id,
+                        "status": status.HTTP_400_BAD_REQUEST,
+                        "detail": f"{user_choice!r} is not a valid option",
+                        "valid_options": ALLOWED_CHOICES,
+                    }
+                )
+            else:
+                rows.append(
+                    (email_obj.id, vote_id, ALLOWED_CHOICES.index(user_choice))
+                )
+                results.append(
+                    {
+                        "vote_id": vote_id,
+                        "status": status.HTTP_200_OK,
+                        "detail": "successful",
+                        "user_choice": user_choice,
+                    }
+                )
+
+        try:
+            buffered = save_votes(rows)
+        except IntegrityError:
+            # votes deleted after they were validated
+            saved = drop_orphans(rows)
+            buffered = save_votes(saved)
+            deleted = {row[1] for row in rows} - {row[1] for row in saved}
+            for result in results:
+                if result["vote_id"] in deleted:
+                    result.update(
+                        status=status.HTTP_404_NOT_FOUND,
+                        detail="vote does not exist",
+                    )
+                    result.pop("user_choice")
+
+        if buffered:
+            for result in results:
+                if result["status"] == status.HTTP_200_OK:
+                    result["status"] = status.HTTP_202_ACCEPTED
+                    result["detail"] = "accepted"
+
+        return Response({"results": results})
+
+
+class VoteResultsView(APIView):
+    @swagger_auto_schema(
+        operation_id="Get vote results",
+        operation_description=f"""
+        Get number of voters for each option of a vote
+        """,
+        responses={
+            200: openapi.Response(
+                description="ok",
+                examples={
+                    "application/json": {
+                        "vote_id": 1,
+                        "results": [
+                            {"option": "cats", "count": 12},
+                            {"option": "dogs", "count": 30},
+                        ],
+                        "total": 42,
+                    }
+                },
+            ),
+            404: openapi.Response(
+                description="vote does not exist",
+                examples={
+                    "application/json": {"detail": "vote does not exist"}
+                },
+            ),
+        },
+        security=[],
+    )
+    def get(self, request, vote_id):
+        """Read the results of a vote from `votes.models.VoteTally`
+
+        Args:
+            request (django.request): django request object
+            vote_id (int): id of the vote
+
+        Returns:
+            rest_framework.response.Response: results | 404
+        """
+        results = get_vote_results(vote_id)
+        if results is None:
+            return Response(
+                {"detail": "vote does not exist"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        return Response(results)
@@ -0,0 +1,100 @@
+import hashlib
+import logging
+import time
+from typing import Optional
+
+from django.conf import settings
+from django.db import transaction
+from redis import RedisError
+from users.utils import get_redis
+
+logger = logging.getLogger(__name__)
+
+CATALOG_VERSION_KEY = "votes:catalog:version"
+CATALOG_PAGE_KEY = "votes:catalog:{version}:{digest}"
+
+
+def get_catalog_version() -> int:
+    """Get the current version of the vote catalog from Redis
+
+    The version starts from the current time in milliseconds instead of 0,
+    so a version (and the ETags built from it) is never reused after Redis
+    loses its data.
+
+    Returns:
+        int: version of the catalog
+    """
+    client = get_redis()
+    version = client.get(CATALOG_VERSION_KEY)
+    if version is None:
+        client.set(CATALOG_VERSION_KEY, int(time.time() * 1000), nx=True)
+        version = client.get(CATALOG_VERSION_KEY)
+    return int(version)
+
+
+def bump_catalog_version() -> int:
+    """Invalidate every cached page of the vote catalog
+
+    Returns:
+        int: the new version
+    """
+    get_catalog_version()
+    return get_redis().incr(CATALOG_VERSION_KEY)
+
+
+def _bump_committed_change():
+    # the change is committed whatever Redis does, the cached pages expire
+    # after `VOTES_CATALOG_CACHE_TTL` instead
+    try:
+        bump_catalog_version()
+    except RedisError:
+        logger.warning("Could not invalidate the vote catalog", exc_info=True)
+
+
+def invalidate_catalog(using: Optional[str] = None):
+    """Bump the catalog version once the current transaction commits
+
+    Called by the `post_save` and `post_delete` receivers of `Votes` and by
+    the bulk methods of `VotesQuerySet`, which send no signal.
+
+    Args:
+        using (str, optional): database alias of the transaction
+    """
+    transaction.on_commit(_bump_committed_change, using=using)
+
+
+def catalog_etag(version: int) -> str:
+    return f'"votes-{version}"'
+
+
+def _page_key(version: int, url: str) -> str:
+    digest = hashlib.sha1(url.encode()).hexdigest()
+    return CATALOG_PAGE_KEY.format(version=version, digest=digest)
+
+
+def get_cached_catalog_page(version: int, url: str) -> Optional[bytes]:
+    """Get a rendered page of the vote catalog
+
+    Args:
+        version (int): catalog version
+        url (str): absolute url of the page, including the query string
+
+    Returns:
+        Optional[bytes]: rendered JSON or None if it is not cached
+    """
+    return get_redis().get(_page_key(version, url))
+
+
+def set_cached_catalog_page(version: int, url: str, content: bytes) -> bool:
+    """Cache a rendered page of the vote catalog
+
+    Args:
+        version (int): catalog version the page was built with
+        url (str): absolute url of the page, including the query string
+        content (bytes): rendered JSON
+    """
+    return get_redis().set(
+        _page_key(version, url),
+        content,
+        ex=settings.VOTES_CATALOG_CACHE_TTL,
+    )
@@ -0,0 +1,146 @@
+"""Durable log of vote changes with per-consumer offsets
+
+Every change of `Voters` is appended to `VoteEvent` by a trigger, in the
+same transaction as the change. A consumer reads the events after its
+offset, processes them and then commits the position of the last one, so
+after a restart it carries on where it stopped. Events are delivered at
+least once: a consumer that crashes before committing reads them again.
+
+    events = consume_events("analytics")
+    for event in events:
+        ...
+    if events:
+        commit_offset("analytics", events[-1].position)
+"""
+
+from datetime import timedelta
+from typing import Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .models import VoteEvent, VoteEventConsumer
+
+Position = Tuple[int, int]
+
+START: Position = (0, 0)
+
+# ids are handed out when an event is written but transactions commit in a
+# different order, so a reader going by id could skip an event committed
+# late. Events are read in (txid, id) order instead, and only from
+# transactions older than every running one (the snapshot's xmin): those
+# have all committed or rolled back, so nothing can appear before a position
+# that was already read.
+READ_EVENTS_SQL = """
+SELECT id, txid, vote_id, choice, old_choice, created_at
+FROM votes_voteevent
+WHERE txid < txid_snapshot_xmin(txid_current_snapshot())
+    AND (txid, id) > (%s, %s)
+    {where}
+ORDER BY txid, id
+LIMIT %s
+"""
+
+
+def read_events(
+    after: Position = START,
+    vote_ids: Optional[Iterable[int]] = None,
+    limit: int = None,
+) -> List[VoteEvent]:
+    """Read committed events in order
+
+    A long running transaction holds back every event written after it
+    started until it finishes.
+
+    Args:
+        after (Position, optional): only read events after this position.
+        Defaults to the start of the log.
+        vote_ids (Iterable[int], optional): only read events of these votes.
+        Defaults to every vote.
+        limit (int, optional): maximum number of events. Defaults to
+        `VOTE_EVENTS_BATCH_SIZE`.
+
+    Returns:
+        List[VoteEvent]: events, the position of the last one is where the
+        next read should start
+    """
+    where, params = "", []
+    if vote_ids is not None:
+        where, params = "AND vote_id = ANY(%s)", [list(vote_ids)]
+    return list(
+        VoteEvent.objects.raw(
+            READ_EVENTS_SQL.format(where=where),
+            [*after, *params, limit or settings.VOTE_EVENTS_BATCH_SIZE],
+        )
+    )
+
+
+def get_offset(consumer: str) -> Position:
+    """Get the position of the last event a consumer has processed
+
+    Args:
+        consumer (str): name of the consumer
+
+    Returns:
+        Position: position, `START` for a new consumer
+    """
+    offset = VoteEventConsumer.objects.filter(name=consumer).first()
+    return offset.position if offset else START
+
+
+def commit_offset(consumer: str, position: Position):
+    """Store the position of the last event a consumer has processed
+
+    Args:
+        consumer (str): name of the consumer
+        position (Position): `VoteEvent.position` of the event
+    """
+    VoteEventConsumer.objects.update_or_create(
+        name=consumer,
+        defaults={"txid": position[0], "event_id": position[1]},
+    )
+
+
+def consume_events(
+    consumer: str,
+    vote_ids: Optional[Iterable[int]] = None,
+    limit: int = None,
+) -> List[VoteEvent]:
+    """Read the events after the offset of a consumer, without moving it
+
+    Args:
+        consumer (str): name of the consumer
+        vote_ids (Iterable[int], optional): only read events of these votes
+        limit (int, optional): maximum number of events
+
+    Returns:
+        List[VoteEvent]: events to process before calling `commit_offset`
+    """
+    return read_events(get_offset(consumer), vote_ids=vote_ids, limit=limit)
+
+
+def prune_events(retention: timedelta = None) -> int:
+    """Delete events that every consumer has processed and events older
+    than the retention period, whether processed or not
+
+    Args:
+        retention (timedelta, optional): how long to keep events for.
+        Defaults to `VOTE_EVENTS_RETENTION_DAYS`.
+
+    Returns:
+        int: number of deleted events
+    """
+    if retention is None:
+        retention = timedelta(days=settings.VOTE_EVENTS_RETENTION_DAYS)
+    cutoff = timezone.now() - retention
+
+    offsets = [offset.position for offset in VoteEventConsumer.objects.all()]
+    where, params = "created_at < %s", [cutoff]
+    if offsets:
+        where += " OR (txid, id) <= (%s, %s)"
+        params += min(offsets)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM votes_voteevent WHERE {where}", params)
+        return cursor.rowcount
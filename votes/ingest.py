@@ -0,0 +1,136 @@
+from typing import Iterable, List, Tuple
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from redis import ResponseError
+from users.models import Emails
+from users.utils import get_redis
+
+from .models import Voters, Votes
+from .utils import vote_options_cache
+
+STREAM_KEY = "votes:ingest"
+GROUP_NAME = "votes-ingest"
+CONSUMER_NAME = "drainer"
+LOCK_KEY = "votes:ingest:lock"
+
+Row = Tuple[int, int, int]
+
+
+def is_buffered() -> bool:
+    return settings.VOTES_INGESTION_MODE == "buffered"
+
+
+def save_votes(rows: Iterable[Row]) -> bool:
+    """Save validated votes according to `VOTES_INGESTION_MODE`
+
+    In `direct` mode votes are upserted into `Voters` right away, in
+    `buffered` mode they are appended to a Redis stream and written later
+    by `drain_votes`.
+
+    Args:
+        rows (Iterable[Row]): `(voter_id, vote_id, choice)` tuples
+
+    Returns:
+        bool: True if the votes were buffered instead of written
+    """
+    if not is_buffered():
+        Voters.objects.upsert(rows)
+        return False
+
+    pipe = get_redis().pipeline(transaction=False)
+    for voter_id, vote_id, choice in rows:
+        pipe.xadd(
+            STREAM_KEY,
+            {"voter_id": voter_id, "vote_id": vote_id, "choice": choice},
+        )
+    pipe.execute()
+    return True
+
+
+def _ensure_group():
+    try:
+        get_redis().xgroup_create(STREAM_KEY, GROUP_NAME, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def _read_batch(batch_size: int) -> list:
+    # entries that were read but not acknowledged (e.g. the worker died
+    # before acknowledging them) are replayed before any new entry, so a
+    # vote is never overwritten by an older one
+    for start in ("0", ">"):
+        streams = get_redis().xreadgroup(
+            GROUP_NAME, CONSUMER_NAME, {STREAM_KEY: start}, count=batch_size
+        )
+        entries = streams[0][1] if streams else []
+        if entries:
+            return entries
+    return []
+
+
+def _collapse(entries: list) -> List[Row]:
+    """Keep only the latest choice of each voter for each vote"""
+    latest = {}
+    for _, fields in entries:
+        key = (int(fields[b"voter_id"]), int(fields[b"vote_id"]))
+        if b"choice" in fields:
+            latest[key] = int(fields[b"choice"])
+        else:
+            # buffered before choices were stored as option indexes
+            options = vote_options_cache.get(key[1]) or []
+            user_choice = fields[b"user_choice"].decode()
+            if user_choice in options:
+                latest[key] = options.index(user_choice)
+    return [(*key, choice) for key, choice in latest.items()]
+
+
+def drop_orphans(rows: List[Row]) -> List[Row]:
+    """Remove votes whose vote or email was deleted after they were buffered"""
+    vote_ids = set(
+        Votes.objects.filter(id__in={row[1] for row in rows}).values_list(
+            "id", flat=True
+        )
+    )
+    voter_ids = set(
+        Emails.objects.filter(id__in={row[0] for row in rows}).values_list(
+            "id", flat=True
+        )
+    )
+    return [row for row in rows if row[0] in voter_ids and row[1] in vote_ids]
+
+
+def drain_votes(batch_size: int = None) -> int:
+    """Write one batch of buffered votes into `Voters`
+
+    Entries are acknowledged and removed from the stream only after they
+    are written, so they are delivered at least once. Writing an entry
+    twice is harmless because the upsert is idempotent. Only one drainer
+    should run at a time, see `votes.tasks.drain_vote_buffer`.
+
+    Args:
+        batch_size (int, optional): maximum number of stream entries to
+        read. Defaults to `VOTES_INGEST_BATCH_SIZE`.
+
+    Returns:
+        int: number of stream entries processed
+    """
+    _ensure_group()
+    entries = _read_batch(batch_size or settings.VOTES_INGEST_BATCH_SIZE)
+    if not entries:
+        return 0
+
+    rows = _collapse(entries)
+    try:
+        with transaction.atomic():
+            Voters.objects.upsert(rows)
+    except IntegrityError:
+        Voters.objects.upsert(drop_orphans(rows))
+
+    entry_ids = [entry_id for entry_id, _ in entries]
+    pipe = get_redis().pipeline()
+    pipe.xack(STREAM_KEY, GROUP_NAME, *entry_ids)
+    pipe.xdel(STREAM_KEY, *entry_ids)
+    pipe.execute()
+    return len(entries)
@@ -0,0 +1,367 @@
+"""Live vote results pushed to clients as server-sent events
+
+Every process keeps a single `LISTEN vote_channel` connection, see
+`VoteChannelListener`. The results of a watched vote are read once, then
+kept up to date from the notifications, which carry the choice a voter
+moved from and to, and pushed to every stream of that vote at most once per
+`VOTE_LIVE_COALESCE_WINDOW_MS`.
+"""
+
+import asyncio
+import json
+import logging
+import re
+from collections import Counter, defaultdict
+from typing import Dict, Optional, Set
+
+import psycopg2
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connections
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from .utils import get_vote_results
+
+CHANNEL = "vote_channel"
+RECONNECT_DELAY = 1.0
+LIVE_RESULTS_PATH = re.compile(r"^/api/vote/(?P<vote_id>[0-9]+)/live/$")
+
+logger = logging.getLogger(__name__)
+
+
+def load_results(vote_id: int) -> Optional[dict]:
+    # runs outside of django's request cycle, so connections are managed
+    # the way a request would manage them
+    try:
+        return get_vote_results(vote_id)
+    finally:
+        close_old_connections()
+
+
+def apply_deltas(results: dict, deltas: Counter) -> dict:
+    """Add the change in number of voters of each option to the results
+
+    Args:
+        results (dict): results as returned by `get_vote_results`
+        deltas (Counter): option index -> change in number of voters
+
+    Returns:
+        dict: new results
+    """
+    options = [
+        {**option, "count": option["count"] + deltas.get(index, 0)}
+        for index, option in enumerate(results["results"])
+    ]
+    return {
+        **results,
+        "results": options,
+        "total": sum(option["count"] for option in options),
+    }
+
+
+class VoteChannelListener:
+    """Fan out the notifications of one `LISTEN` connection to subscribers
+    of each vote
+
+    The results of a vote are read from the database when it gets its first
+    subscriber and then updated in memory from the notifications. Changes
+    are collected for `VOTE_LIVE_COALESCE_WINDOW_MS` and published as one
+    update per vote, however many votes were cast in the meantime.
+
+    Subscribers get a queue holding the latest results of their vote (None
+    if the vote does not exist), older results are replaced rather than
+    queued so a slow client never falls behind.
+
+    Args:
+        channel (str): postgres notification channel
+    """
+
+    def __init__(self, channel: str = CHANNEL):
+        self.channel = channel
+        self._subscribers: Dict[int, Set[asyncio.Queue]] = defaultdict(set)
+        self._results: Dict[int, Optional[dict]] = {}
+        self._deltas: Dict[int, Counter] = defaultdict(Counter)
+        self._refreshing: Dict[int, bool] = {}
+        self._flush_handle = None
+        self._conn = None
+        self._loop = None
+        self._lock = None
+
+    async def subscribe(self, vote_id: int) -> asyncio.Queue:
+        """Start receiving the results of a vote
+
+        Args:
+            vote_id (int): id of the vote
+
+        Returns:
+            asyncio.Queue: queue the latest results are put on
+        """
+        await self._ensure_listening()
+        queue = asyncio.Queue(maxsize=1)
+        self._subscribers[vote_id].add(queue)
+        if vote_id in self._results:
+            queue.put_nowait(self._results[vote_id])
+        elif vote_id not in self._refreshing:
+            self.refresh(vote_id)
+        return queue
+
+    def unsubscribe(self, vote_id: int, queue: asyncio.Queue):
+        queues = self._subscribers.get(vote_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[vote_id]
+            self._results.pop(vote_id, None)
+            self._deltas.pop(vote_id, None)
+
+    def publish(self, vote_id: int, results: Optional[dict]):
+        for queue in self._subscribers.get(vote_id, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(results)
+
+    def dispatch(self, payload: str):
+        """Handle one notification of `vote_channel`
+
+        Args:
+            payload (str): json with the `vote_id` and either the new
+            `choice` and the `old_choice` of a written `votes_voters` row or
+            the `deltas` of every option changed by a statement
+        """
+        try:
+            event = json.loads(payload)
+            vote_id = int(event["vote_id"])
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Ignoring malformed notification %r", payload)
+            return
+        if vote_id not in self._subscribers:
+            return
+
+        if (
+            self._results.get(vote_id) is None
+            or vote_id in self._refreshing
+            or not ("old_choice" in event or "deltas" in event)
+        ):
+            # the change can not be applied to known results
+            self.refresh(vote_id)
+            return
+
+        deltas = self._deltas[vote_id]
+        if "deltas" in event:
+            for choice, delta in event["deltas"].items():
+                deltas[int(choice)] += delta
+        else:
+            if event["old_choice"] is not None:
+                deltas[event["old_choice"]] -= 1
+            if event.get("choice") is not None:
+                deltas[event["choice"]] += 1
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                settings.VOTE_LIVE_COALESCE_WINDOW_MS / 1000, self.flush
+            )
+
+    def flush(self):
+        """Publish the changes collected since the last flush"""
+        self._flush_handle = None
+        deltas, self._deltas = self._deltas, defaultdict(Counter)
+        for vote_id, counts in deltas.items():
+            results = self._results.get(vote_id)
+            if results is None or not any(counts.values()):
+                continue
+            self._results[vote_id] = apply_deltas(results, counts)
+            self.publish(vote_id, self._results[vote_id])
+
+    def refresh(self, vote_id: int):
+        """Read the results of a vote and publish them, unless nobody is
+        watching it"""
+        if vote_id not in self._subscribers:
+            return
+        # the read includes every change notified so far
+        self._deltas.pop(vote_id, None)
+        if vote_id in self._refreshing:
+            self._refreshing[vote_id] = True
+            return
+        self._refreshing[vote_id] = False
+        asyncio.ensure_future(self._refresh(vote_id))
+
+    async def _refresh(self, vote_id: int):
+        try:
+            while True:
+                results = await sync_to_async(load_results)(vote_id)
+                if not self._refreshing[vote_id]:
+                    break
+                self._refreshing[vote_id] = False
+        except Exception:
+            logger.exception("Could not refresh results of vote %s", vote_id)
+            return
+        finally:
+            del self._refreshing[vote_id]
+
+        if vote_id in self._subscribers:
+            self._results[vote_id] = results
+            self.publish(vote_id, results)
+
+    async def _ensure_listening(self):
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._loop is not loop:
+            self._close()
+            self._flush_handle = None
+            self._loop = loop
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._conn is None:
+                await self._listen()
+
+    async def _listen(self):
+        params = connections["default"].get_connection_params()
+        self._conn = await self._loop.run_in_executor(
+            None, self._connect, params
+        )
+        self._loop.add_reader(self._conn.fileno(), self._on_readable)
+
+    def _connect(self, params: dict):
+        conn = psycopg2.connect(**params)
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.channel}")
+        return conn
+
+    def _on_readable(self):
+        try:
+            self._conn.poll()
+        except psycopg2.Error:
+            logger.exception("Lost the %s connection", self.channel)
+            self._close()
+            asyncio.ensure_future(self._reconnect())
+            return
+
+        while self._conn.notifies:
+            self.dispatch(self._conn.notifies.pop(0).payload)
+
+    async def _reconnect(self):
+        while self._subscribers and self._conn is None:
+            await asyncio.sleep(RECONNECT_DELAY)
+            try:
+                await self._ensure_listening()
+            except psycopg2.Error:
+                logger.warning("Could not listen to %s", self.channel)
+                continue
+            # notifications sent while disconnected are lost
+            for vote_id in list(self._subscribers):
+                self.refresh(vote_id)
+
+    def _close(self):
+        if self._conn is None:
+            return
+        try:
+            self._loop.remove_reader(self._conn.fileno())
+        except (ValueError, RuntimeError):
+            pass
+        self._conn.close()
+        self._conn = None
+
+
+listener = VoteChannelListener()
+
+
+def _event(name: str, data: dict) -> bytes:
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+async def _send_json(send, status: int, data: dict):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json")],
+        }
+    )
+    await send(
+        {"type": "http.response.body", "body": json.dumps(data).encode()}
+    )
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def live_results_app(scope, receive, send, vote_id: int):
+    """ASGI app streaming the results of a vote as server-sent events
+
+    A `results` event with the same body as `vote-results` is sent right
+    away and again after votes are cast, at most once per
+    `VOTE_LIVE_COALESCE_WINDOW_MS`. Comments are sent every
+    `VOTE_LIVE_KEEPALIVE` seconds while nothing changes.
+
+    Args:
+        scope (dict): ASGI connection scope
+        receive (Callable): ASGI receive channel
+        send (Callable): ASGI send channel
+        vote_id (int): id of the vote
+    """
+    if scope["method"] != "GET":
+        await _send_json(send, 405, {"detail": "method not allowed"})
+        return
+
+    queue = await listener.subscribe(vote_id)
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    started = False
+    try:
+        while True:
+            update = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait(
+                {update, disconnected},
+                timeout=settings.VOTE_LIVE_KEEPALIVE,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if disconnected in done:
+                update.cancel()
+                break
+            if update not in done:
+                update.cancel()
+                if started:
+                    await send(
+                        {
+                            "type": "http.response.body",
+                            "body": b": keep-alive\n\n",
+                            "more_body": True,
+                        }
+                    )
+                continue
+
+            results = update.result()
+            if results is None:
+                if started:
+                    # the vote was deleted
+                    await send({"type": "http.response.body", "body": b""})
+                else:
+                    await _send_json(
+                        send, 404, {"detail": "vote does not exist"}
+                    )
+                break
+
+            if not started:
+                await send(
+                    {
+                        "type": "http.response.start",
+                        "status": 200,
+                        "headers": [
+                            (b"content-type", b"text/event-stream"),
+                            (b"cache-control", b"no-cache"),
+                            (b"x-accel-buffering", b"no"),
+                        ],
+                    }
+                )
+                started = True
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": _event("results", results),
+                    "more_body": True,
+                }
+            )
+    finally:
+        listener.unsubscribe(vote_id, queue)
+        disconnected.cancel()
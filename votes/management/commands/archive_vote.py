@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from votes.models import Votes
+from votes.partitions import archive_name, detach_partition
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete a vote and keep its ballots in a votes_voters_archive_<id> "
+        "table"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("vote_id", type=int, help="id of the vote")
+
+    def handle(self, *args, **options):
+        vote_id = options["vote_id"]
+        with transaction.atomic():
+            try:
+                vote = Votes.objects.select_for_update().get(id=vote_id)
+            except Votes.DoesNotExist:
+                raise CommandError(f"Vote {vote_id} does not exist.")
+            if not detach_partition(vote_id, archive=True):
+                raise CommandError(
+                    f"Vote {vote_id} has no partition, run "
+                    f"`partition_votes --vote {vote_id}` first."
+                )
+            vote.delete()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Deleted vote {vote_id}, its ballots are in "
+                f"{archive_name(vote_id)}."
+            )
+        )
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from votes.models import Votes
+from votes.partitions import move_from_default, votes_in_default
+
+
+class Command(BaseCommand):
+    help = (
+        "Move the ballots of votes without a partition of their own out of "
+        "votes_voters_default"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--vote",
+            dest="vote_ids",
+            type=int,
+            action="append",
+            help="id of the vote to move, can be repeated (default: all)",
+        )
+
+    def handle(self, *args, **options):
+        if options["vote_ids"]:
+            vote_ids = list(
+                Votes.objects.filter(id__in=options["vote_ids"])
+                .order_by("id")
+                .values_list("id", flat=True)
+            )
+        else:
+            vote_ids = votes_in_default()
+        moved = 0
+        for vote_id in vote_ids:
+            # one short lock of the default partition per vote
+            moved += move_from_default(vote_id)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Moved {moved} ballots of {len(vote_ids)} votes."
+            )
+        )
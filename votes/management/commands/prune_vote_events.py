@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from votes.events import prune_events
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete vote events every consumer has processed and events older "
+        "than the retention period"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            help="retention period in days (default: VOTE_EVENTS_RETENTION_DAYS)",
+        )
+
+    def handle(self, *args, **options):
+        retention = options["days"]
+        if retention is not None:
+            retention = timedelta(days=retention)
+        count = prune_events(retention)
+        self.stdout.write(self.style.SUCCESS(f"Deleted {count} vote events."))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from votes.utils import rebuild_tallies
+
+
+class Command(BaseCommand):
+    help = "Rebuild the per-option vote counters from the Voters table"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--vote",
+            dest="vote_ids",
+            type=int,
+            action="append",
+            help="id of the vote to rebuild, can be repeated (default: all)",
+        )
+
+    def handle(self, *args, **options):
+        rows = rebuild_tallies(options["vote_ids"])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {rows} tally rows."))
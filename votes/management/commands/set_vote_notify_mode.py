@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from votes.utils import (
+    NOTIFY_TRIGGER_MODES,
+    get_notify_trigger_mode,
+    set_notify_trigger_mode,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Choose whether vote changes are published on vote_channel once per "
+        "row or once per statement"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "mode",
+            nargs="?",
+            choices=NOTIFY_TRIGGER_MODES,
+            default=settings.VOTE_NOTIFY_TRIGGER_MODE,
+            help="trigger mode (default: VOTE_NOTIFY_TRIGGER_MODE)",
+        )
+
+    def handle(self, *args, **options):
+        previous = get_notify_trigger_mode()
+        set_notify_trigger_mode(options["mode"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Vote notifications switched from {previous} to "
+                f"{options['mode']} mode."
+            )
+        )
@@ -0,0 +1,96 @@
+# Generated by Django 3.2.9 on 2026-10-18 10:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+TALLY_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION vote_tally_func() RETURNS trigger AS $$
+DECLARE
+    option_index smallint;
+BEGIN
+    IF TG_OP = 'UPDATE'
+        AND OLD.vote_id = NEW.vote_id
+        AND OLD.user_choice = NEW.user_choice THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        SELECT CASE OLD.user_choice
+            WHEN v.first_option THEN 0
+            WHEN v.second_option THEN 1
+        END INTO option_index
+        FROM votes_votes v WHERE v.id = OLD.vote_id;
+
+        UPDATE votes_votetally SET count = count - 1
+        WHERE vote_id = OLD.vote_id AND choice = option_index;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT CASE NEW.user_choice
+            WHEN v.first_option THEN 0
+            WHEN v.second_option THEN 1
+        END INTO option_index
+        FROM votes_votes v WHERE v.id = NEW.vote_id;
+
+        IF option_index IS NOT NULL THEN
+            INSERT INTO votes_votetally (vote_id, choice, count)
+            VALUES (NEW.vote_id, option_index, 1)
+            ON CONFLICT (vote_id, choice)
+            DO UPDATE SET count = votes_votetally.count + 1;
+        END IF;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS vote_tally_trigger ON votes_voters;
+CREATE TRIGGER vote_tally_trigger
+AFTER INSERT OR UPDATE OR DELETE ON votes_voters
+FOR EACH ROW EXECUTE PROCEDURE vote_tally_func();
+
+INSERT INTO votes_votetally (vote_id, choice, count)
+SELECT counted.vote_id, counted.choice, counted.count
+FROM (
+    SELECT voters.vote_id,
+           CASE voters.user_choice
+               WHEN v.first_option THEN 0
+               WHEN v.second_option THEN 1
+           END AS choice,
+           count(*) AS count
+    FROM votes_voters voters
+    JOIN votes_votes v ON v.id = voters.vote_id
+    GROUP BY 1, 2
+) counted
+WHERE counted.choice IS NOT NULL;
+"""
+
+DROP_TALLY_FUNCTION_SQL = """
+DROP TRIGGER IF EXISTS vote_tally_trigger ON votes_voters;
+DROP FUNCTION IF EXISTS vote_tally_func();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('votes', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VoteTally',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('choice', models.PositiveSmallIntegerField()),
+                ('count', models.BigIntegerField(default=0)),
+                ('vote', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tallies', to='votes.votes')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='votetally',
+            constraint=models.UniqueConstraint(fields=('vote', 'choice'), name='vote_tally_unique_constraint'),
+        ),
+        migrations.RunSQL(TALLY_FUNCTION_SQL, DROP_TALLY_FUNCTION_SQL),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 3.2.9 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+# keeps `choice` filled while processes that only know about `user_choice`
+# are still writing, it is dropped in 0006_remove_voters_user_choice
+SYNC_CHOICE_SQL = """
+CREATE OR REPLACE FUNCTION vote_choice_sync_func() RETURNS trigger AS $$
+BEGIN
+    -- a process that still writes the text changes only `user_choice`, a
+    -- `choice` copied from the old row would otherwise be kept
+    IF NEW.user_choice IS NOT NULL AND (
+        TG_OP = 'INSERT' OR NEW.user_choice IS DISTINCT FROM OLD.user_choice
+    ) THEN
+        SELECT CASE NEW.user_choice
+            WHEN v.first_option THEN 0
+            WHEN v.second_option THEN 1
+        END INTO NEW.choice
+        FROM votes_votes v WHERE v.id = NEW.vote_id;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS vote_choice_sync_trigger ON votes_voters;
+CREATE TRIGGER vote_choice_sync_trigger
+BEFORE INSERT OR UPDATE ON votes_voters
+FOR EACH ROW EXECUTE PROCEDURE vote_choice_sync_func();
+"""
+
+DROP_SYNC_CHOICE_SQL = """
+DROP TRIGGER IF EXISTS vote_choice_sync_trigger ON votes_voters;
+DROP FUNCTION IF EXISTS vote_choice_sync_func();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('votes', '0002_votetally'),
+    ]
+
+    operations = [
+        # without a default or a CHECK constraint adding the column does not
+        # scan or rewrite `votes_voters`
+        migrations.AddField(
+            model_name='voters',
+            name='choice',
+            field=models.SmallIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='voters',
+            name='user_choice',
+            field=models.CharField(max_length=256, null=True),
+        ),
+        migrations.RunSQL(SYNC_CHOICE_SQL, DROP_SYNC_CHOICE_SQL),
+    ]
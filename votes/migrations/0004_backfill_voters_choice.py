@@ -0,0 +1,127 @@
+# Generated by Django 3.2.9 on 2026-10-18 14:02
+
+from django.db import migrations, transaction
+
+BATCH_SIZE = 10_000
+
+BACKFILL_SQL = """
+UPDATE votes_voters SET choice = CASE votes_voters.user_choice
+    WHEN v.first_option THEN 0
+    WHEN v.second_option THEN 1
+END
+FROM votes_votes v
+WHERE v.id = votes_voters.vote_id
+  AND votes_voters.id >= %s AND votes_voters.id < %s
+  AND votes_voters.choice IS NULL
+"""
+
+BACKFILL_USER_CHOICE_SQL = """
+UPDATE votes_voters SET user_choice = CASE votes_voters.choice
+    WHEN 0 THEN v.first_option
+    WHEN 1 THEN v.second_option
+END
+FROM votes_votes v
+WHERE v.id = votes_voters.vote_id
+  AND votes_voters.id >= %s AND votes_voters.id < %s
+  AND votes_voters.user_choice IS NULL
+"""
+
+# ballots whose text matches none of the options of their vote (the option
+# was renamed after they were cast) can not be converted, they are moved
+# as they are to `UNMAPPED_TABLE` to be fixed by hand and put back
+UNMAPPED_TABLE = "votes_voters_unmapped"
+
+CREATE_UNMAPPED_SQL = f"""
+CREATE TABLE IF NOT EXISTS {UNMAPPED_TABLE} (LIKE votes_voters)
+"""
+
+MOVE_UNMAPPED_SQL = f"""
+WITH unmapped AS (
+    DELETE FROM votes_voters
+    WHERE id >= %s AND id < %s AND choice IS NULL
+    RETURNING *
+)
+INSERT INTO {UNMAPPED_TABLE} SELECT * FROM unmapped
+"""
+
+# the columns are named, reverting 0006 adds `user_choice` back last,
+# ballots whose vote or voter is gone meanwhile stay in `UNMAPPED_TABLE`
+RESTORE_UNMAPPED_SQL = f"""
+WITH restored AS (
+    INSERT INTO votes_voters ({{columns}})
+    SELECT {{columns}} FROM {UNMAPPED_TABLE} AS unmapped
+    WHERE EXISTS (SELECT 1 FROM votes_votes WHERE id = unmapped.vote_id)
+      AND EXISTS (SELECT 1 FROM users_emails WHERE id = unmapped.voter_id)
+    ON CONFLICT DO NOTHING
+    RETURNING id
+)
+DELETE FROM {UNMAPPED_TABLE} WHERE id IN (SELECT id FROM restored)
+"""
+
+
+def drop_unmapped_if_empty(cursor):
+    cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {UNMAPPED_TABLE})")
+    if not cursor.fetchone()[0]:
+        cursor.execute(f"DROP TABLE {UNMAPPED_TABLE}")
+
+
+def backfill_choice(apps, schema_editor):
+    """Convert `user_choice` to `choice` in batches of `BATCH_SIZE` rows,
+    each batch in its own short transaction so rows are never locked for
+    long"""
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT min(id), max(id) FROM votes_voters")
+        first_id, last_id = cursor.fetchone()
+        if first_id is None:
+            return
+
+        cursor.execute(CREATE_UNMAPPED_SQL)
+        for start in range(first_id, last_id + 1, BATCH_SIZE):
+            cursor.execute(BACKFILL_SQL, [start, start + BATCH_SIZE])
+            cursor.execute(MOVE_UNMAPPED_SQL, [start, start + BATCH_SIZE])
+        drop_unmapped_if_empty(cursor)
+
+
+def backfill_user_choice(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) "
+            "FROM pg_attribute WHERE attrelid = to_regclass(%s) "
+            "AND attnum > 0 AND NOT attisdropped",
+            [UNMAPPED_TABLE],
+        )
+        (columns,) = cursor.fetchone()
+        if columns is not None:
+            cursor.execute(RESTORE_UNMAPPED_SQL.format(columns=columns))
+            drop_unmapped_if_empty(cursor)
+        cursor.execute("SELECT min(id), max(id) FROM votes_voters")
+        first_id, last_id = cursor.fetchone()
+        if first_id is None:
+            return
+
+        # the tally trigger of 0002 counts the text, filling it in would
+        # count every ballot a second time
+        for start in range(first_id, last_id + 1, BATCH_SIZE):
+            with transaction.atomic(using=schema_editor.connection.alias):
+                cursor.execute(
+                    "ALTER TABLE votes_voters DISABLE TRIGGER vote_tally_trigger"
+                )
+                cursor.execute(
+                    BACKFILL_USER_CHOICE_SQL, [start, start + BATCH_SIZE]
+                )
+                cursor.execute(
+                    "ALTER TABLE votes_voters ENABLE TRIGGER vote_tally_trigger"
+                )
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('votes', '0003_voters_choice'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_choice, backfill_user_choice),
+    ]
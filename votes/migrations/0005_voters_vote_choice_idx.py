@@ -0,0 +1,20 @@
+# Generated by Django 3.2.9 on 2026-10-18 14:02
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('votes', '0004_backfill_voters_choice'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='voters',
+            index=models.Index(fields=['vote', 'choice'], name='voters_vote_choice_idx'),
+        ),
+    ]
@@ -0,0 +1,148 @@
+# Generated by Django 3.2.9 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+TALLY_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION vote_tally_func() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE'
+        AND OLD.vote_id = NEW.vote_id
+        AND OLD.choice = NEW.choice THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE votes_votetally SET count = count - 1
+        WHERE vote_id = OLD.vote_id AND choice = OLD.choice;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO votes_votetally (vote_id, choice, count)
+        VALUES (NEW.vote_id, NEW.choice, 1)
+        ON CONFLICT (vote_id, choice)
+        DO UPDATE SET count = votes_votetally.count + 1;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+PREVIOUS_TALLY_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION vote_tally_func() RETURNS trigger AS $$
+DECLARE
+    option_index smallint;
+BEGIN
+    IF TG_OP = 'UPDATE'
+        AND OLD.vote_id = NEW.vote_id
+        AND OLD.user_choice = NEW.user_choice THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        SELECT CASE OLD.user_choice
+            WHEN v.first_option THEN 0
+            WHEN v.second_option THEN 1
+        END INTO option_index
+        FROM votes_votes v WHERE v.id = OLD.vote_id;
+
+        UPDATE votes_votetally SET count = count - 1
+        WHERE vote_id = OLD.vote_id AND choice = option_index;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT CASE NEW.user_choice
+            WHEN v.first_option THEN 0
+            WHEN v.second_option THEN 1
+        END INTO option_index
+        FROM votes_votes v WHERE v.id = NEW.vote_id;
+
+        IF option_index IS NOT NULL THEN
+            INSERT INTO votes_votetally (vote_id, choice, count)
+            VALUES (NEW.vote_id, option_index, 1)
+            ON CONFLICT (vote_id, choice)
+            DO UPDATE SET count = votes_votetally.count + 1;
+        END IF;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# a validated CHECK constraint lets SET NOT NULL skip the table scan that
+# would otherwise hold an ACCESS EXCLUSIVE lock, validation itself only
+# takes a SHARE UPDATE EXCLUSIVE lock. The migration is not atomic and
+# every statement commits on its own, so the ACCESS EXCLUSIVE locks taken
+# to add the constraint and to set NOT NULL are not held while it is
+# validated. A constraint left by a run that failed to validate it is
+# dropped first.
+CHOICE_NOT_NULL_SQL = [
+    "ALTER TABLE votes_voters DROP CONSTRAINT IF EXISTS voters_choice_not_null",
+    "ALTER TABLE votes_voters ADD CONSTRAINT voters_choice_not_null "
+    "CHECK (choice IS NOT NULL) NOT VALID",
+    "ALTER TABLE votes_voters VALIDATE CONSTRAINT voters_choice_not_null",
+    "ALTER TABLE votes_voters ALTER COLUMN choice SET NOT NULL",
+    "ALTER TABLE votes_voters DROP CONSTRAINT voters_choice_not_null",
+]
+
+CHOICE_NULL_SQL = """
+ALTER TABLE votes_voters ALTER COLUMN choice DROP NOT NULL;
+"""
+
+DROP_SYNC_CHOICE_SQL = """
+DROP TRIGGER IF EXISTS vote_choice_sync_trigger ON votes_voters;
+DROP FUNCTION IF EXISTS vote_choice_sync_func();
+"""
+
+SYNC_CHOICE_SQL = """
+CREATE OR REPLACE FUNCTION vote_choice_sync_func() RETURNS trigger AS $$
+BEGIN
+    -- a process that still writes the text changes only `user_choice`, a
+    -- `choice` copied from the old row would otherwise be kept
+    IF NEW.user_choice IS NOT NULL AND (
+        TG_OP = 'INSERT' OR NEW.user_choice IS DISTINCT FROM OLD.user_choice
+    ) THEN
+        SELECT CASE NEW.user_choice
+            WHEN v.first_option THEN 0
+            WHEN v.second_option THEN 1
+        END INTO NEW.choice
+        FROM votes_votes v WHERE v.id = NEW.vote_id;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER vote_choice_sync_trigger
+BEFORE INSERT OR UPDATE ON votes_voters
+FOR EACH ROW EXECUTE PROCEDURE vote_choice_sync_func();
+"""
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('votes', '0005_voters_vote_choice_idx'),
+    ]
+
+    operations = [
+        migrations.RunSQL(DROP_SYNC_CHOICE_SQL, SYNC_CHOICE_SQL),
+        migrations.RunSQL(TALLY_FUNCTION_SQL, PREVIOUS_TALLY_FUNCTION_SQL),
+        migrations.RunSQL(
+            CHOICE_NOT_NULL_SQL,
+            CHOICE_NULL_SQL,
+            state_operations=[
+                migrations.AlterField(
+                    model_name='voters',
+                    name='choice',
+                    field=models.SmallIntegerField(),
+                ),
+            ],
+        ),
+        migrations.RemoveField(
+            model_name='voters',
+            name='user_choice',
+        ),
+    ]
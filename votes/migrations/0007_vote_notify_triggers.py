@@ -0,0 +1,99 @@
+from django.db import migrations
+
+# `seq` keeps notifications unique, postgres only delivers one of the
+# notifications with the same payload sent in a transaction
+NOTIFY_FUNCTIONS_SQL = """
+CREATE SEQUENCE IF NOT EXISTS votes_notification_seq;
+
+CREATE OR REPLACE FUNCTION vote_notify_func() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify('vote_channel', json_build_object(
+            'seq', nextval('votes_notification_seq'),
+            'vote_id', NEW.vote_id,
+            'choice', NEW.choice,
+            'old_choice', NULL
+        )::text);
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM pg_notify('vote_channel', json_build_object(
+            'seq', nextval('votes_notification_seq'),
+            'vote_id', NEW.vote_id,
+            'choice', NEW.choice,
+            'old_choice', OLD.choice
+        )::text);
+    ELSE
+        PERFORM pg_notify('vote_channel', json_build_object(
+            'seq', nextval('votes_notification_seq'),
+            'vote_id', OLD.vote_id,
+            'choice', NULL,
+            'old_choice', OLD.choice
+        )::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION vote_notify_statement_func() RETURNS trigger AS $$
+DECLARE
+    changed_rows text;
+    changes record;
+BEGIN
+    -- transition tables that the trigger does not define can not be
+    -- referenced, even in a branch that is never taken
+    IF TG_OP = 'INSERT' THEN
+        changed_rows := 'SELECT vote_id, choice, 1 AS delta FROM new_rows';
+    ELSIF TG_OP = 'UPDATE' THEN
+        changed_rows := 'SELECT vote_id, choice, 1 AS delta FROM new_rows '
+            'UNION ALL SELECT vote_id, choice, -1 FROM old_rows';
+    ELSE
+        changed_rows := 'SELECT vote_id, choice, -1 AS delta FROM old_rows';
+    END IF;
+
+    FOR changes IN EXECUTE format(
+        'SELECT vote_id, json_object_agg(choice, delta) AS deltas FROM ('
+        '    SELECT vote_id, choice, sum(delta) AS delta FROM (%s) AS changed'
+        '    GROUP BY vote_id, choice HAVING sum(delta) <> 0'
+        ') AS totals GROUP BY vote_id',
+        changed_rows
+    ) LOOP
+        PERFORM pg_notify('vote_channel', json_build_object(
+            'seq', nextval('votes_notification_seq'),
+            'vote_id', changes.vote_id,
+            'deltas', changes.deltas
+        )::text);
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# the trigger used to be created by a script outside of the migrations
+ROW_TRIGGER_SQL = """
+DROP TRIGGER IF EXISTS vote_notify_trigger ON votes_voters;
+CREATE TRIGGER vote_notify_trigger
+AFTER INSERT OR UPDATE OR DELETE ON votes_voters
+FOR EACH ROW EXECUTE PROCEDURE vote_notify_func();
+"""
+
+DROP_NOTIFY_SQL = """
+DROP TRIGGER IF EXISTS vote_notify_trigger ON votes_voters;
+DROP TRIGGER IF EXISTS vote_notify_insert_trigger ON votes_voters;
+DROP TRIGGER IF EXISTS vote_notify_update_trigger ON votes_voters;
+DROP TRIGGER IF EXISTS vote_notify_delete_trigger ON votes_voters;
+DROP FUNCTION IF EXISTS vote_notify_statement_func();
+DROP FUNCTION IF EXISTS vote_notify_func();
+DROP SEQUENCE IF EXISTS votes_notification_seq;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('votes', '0006_remove_voters_user_choice'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            NOTIFY_FUNCTIONS_SQL + ROW_TRIGGER_SQL, DROP_NOTIFY_SQL
+        ),
+    ]
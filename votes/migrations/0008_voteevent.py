@@ -0,0 +1,76 @@
+# Generated by Django 3.2.9 on 2026-10-18 11:14
+
+from django.db import migrations, models
+
+# txid_current() orders events by transaction, see votes.events.read_events
+EVENT_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION vote_event_func() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO votes_voteevent (txid, vote_id, choice, old_choice, created_at)
+        VALUES (txid_current(), NEW.vote_id, NEW.choice, NULL, now());
+    ELSIF TG_OP = 'UPDATE' THEN
+        IF OLD.choice IS DISTINCT FROM NEW.choice THEN
+            INSERT INTO votes_voteevent (txid, vote_id, choice, old_choice, created_at)
+            VALUES (txid_current(), NEW.vote_id, NEW.choice, OLD.choice, now());
+        END IF;
+    ELSE
+        INSERT INTO votes_voteevent (txid, vote_id, choice, old_choice, created_at)
+        VALUES (txid_current(), OLD.vote_id, NULL, OLD.choice, now());
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER vote_event_trigger
+AFTER INSERT OR UPDATE OR DELETE ON votes_voters
+FOR EACH ROW EXECUTE PROCEDURE vote_event_func();
+"""
+
+DROP_EVENT_TRIGGER_SQL = """
+DROP TRIGGER IF EXISTS vote_event_trigger ON votes_voters;
+DROP FUNCTION IF EXISTS vote_event_func();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('votes', '0007_vote_notify_triggers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VoteEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('txid', models.BigIntegerField()),
+                ('vote_id', models.IntegerField()),
+                ('choice', models.SmallIntegerField(null=True)),
+                ('old_choice', models.SmallIntegerField(null=True)),
+                ('created_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='VoteEventConsumer',
+            fields=[
+                ('name', models.CharField(max_length=128, primary_key=True, serialize=False)),
+                ('txid', models.BigIntegerField(default=0)),
+                ('event_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='voteevent',
+            index=models.Index(fields=['txid', 'id'], name='vote_event_position_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='voteevent',
+            index=models.Index(fields=['vote_id', 'txid', 'id'], name='vote_event_vote_position_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='voteevent',
+            index=models.Index(fields=['created_at'], name='vote_event_created_idx'),
+        ),
+        migrations.RunSQL(EVENT_TRIGGER_SQL, DROP_EVENT_TRIGGER_SQL),
+    ]
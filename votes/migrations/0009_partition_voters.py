@@ -0,0 +1,211 @@
+import re
+
+from django.conf import settings
+from django.db import migrations, transaction
+
+BATCH_SIZE = 10_000
+
+TABLE = "votes_voters"
+NEW_TABLE = "votes_voters_new"
+OLD_TABLE = "votes_voters_old"
+DEFAULT_PARTITION = "votes_voters_default"
+
+# keeps the new table in step with the writes made while it is filled
+MIRROR_SQL = """
+CREATE FUNCTION votes_voters_mirror_func() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM votes_voters_new
+        WHERE voter_id = OLD.voter_id AND vote_id = OLD.vote_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO votes_voters_new VALUES (NEW.*);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER votes_voters_mirror_trigger
+AFTER INSERT OR UPDATE OR DELETE ON votes_voters
+FOR EACH ROW EXECUTE PROCEDURE votes_voters_mirror_func();
+"""
+
+DROP_MIRROR_SQL = """
+DROP TRIGGER votes_voters_mirror_trigger ON votes_voters;
+DROP FUNCTION votes_voters_mirror_func();
+"""
+
+# the copied rows are locked so a concurrent update or delete either waits
+# for the copy, and is then mirrored over it, or is copied once committed
+BACKFILL_SQL = """
+INSERT INTO votes_voters_new
+SELECT * FROM votes_voters WHERE id >= %s AND id < %s
+FOR SHARE
+ON CONFLICT DO NOTHING
+"""
+
+
+def build_table(cursor, partitioned):
+    """Create `NEW_TABLE` with the columns, constraints and indexes of
+    `TABLE`, named with a `_new` suffix until the tables are swapped"""
+    partition_by = " PARTITION BY LIST (vote_id)" if partitioned else ""
+    cursor.execute(
+        f"CREATE TABLE {NEW_TABLE} (LIKE {TABLE} INCLUDING DEFAULTS)"
+        + partition_by
+    )
+
+    cursor.execute(
+        "SELECT conname, contype, pg_get_constraintdef(oid) "
+        "FROM pg_constraint WHERE conrelid = %s::regclass",
+        [TABLE],
+    )
+    for name, kind, definition in cursor.fetchall():
+        if kind == "p":
+            # the key of a partitioned table has to include the partition
+            # keys, the vote and the voter for votes split by voter
+            columns = "id, vote_id, voter_id" if partitioned else "id"
+            definition = f"PRIMARY KEY ({columns})"
+        cursor.execute(
+            f"ALTER TABLE {NEW_TABLE} ADD CONSTRAINT {name}_new {definition}"
+        )
+
+    for name, definition in table_indexes(cursor, TABLE):
+        definition = re.sub(
+            r" ON (ONLY )?\S+ USING ", f" ON {NEW_TABLE} USING ", definition
+        )
+        cursor.execute(
+            definition.replace(f" INDEX {name} ", f" INDEX {name}_new ", 1)
+        )
+
+    if partitioned:
+        cursor.execute(
+            f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {NEW_TABLE} DEFAULT"
+        )
+        cursor.execute("SELECT id FROM votes_votes")
+        for (vote_id,) in cursor.fetchall():
+            create_partition(cursor, vote_id)
+
+
+def table_indexes(cursor, table):
+    """Names and definitions of the indexes that are not constraints"""
+    cursor.execute(
+        "SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid) "
+        "FROM pg_index WHERE indrelid = %s::regclass AND NOT EXISTS ("
+        "    SELECT 1 FROM pg_constraint WHERE conindid = indexrelid"
+        ")",
+        [table],
+    )
+    return cursor.fetchall()
+
+
+def create_partition(cursor, vote_id):
+    """`votes.partitions.create_partition` as of this migration"""
+    name = f"{TABLE}_{vote_id}"
+    modulus = settings.VOTERS_HASH_PARTITIONS
+    if modulus > 1:
+        cursor.execute(
+            f"CREATE TABLE {name} PARTITION OF {NEW_TABLE} "
+            f"FOR VALUES IN ({vote_id}) PARTITION BY HASH (voter_id)"
+        )
+        for remainder in range(modulus):
+            cursor.execute(
+                f"CREATE TABLE {name}_{remainder} PARTITION OF {name} "
+                f"FOR VALUES WITH (MODULUS {modulus}, REMAINDER {remainder})"
+            )
+    else:
+        cursor.execute(
+            f"CREATE TABLE {name} PARTITION OF {NEW_TABLE} "
+            f"FOR VALUES IN ({vote_id})"
+        )
+
+
+def backfill(cursor):
+    """Copy the rows in batches of `BATCH_SIZE`, each batch in its own
+    short transaction, rows written meanwhile are mirrored"""
+    cursor.execute(f"SELECT min(id), max(id) FROM {TABLE}")
+    first_id, last_id = cursor.fetchone()
+    if first_id is None:
+        return
+    for start in range(first_id, last_id + 1, BATCH_SIZE):
+        cursor.execute(BACKFILL_SQL, [start, start + BATCH_SIZE])
+
+
+def swap_tables(cursor):
+    """Put `NEW_TABLE` in place of `TABLE` with its names and triggers,
+    blocking `TABLE` only while the catalog is updated"""
+    cursor.execute(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE")
+    cursor.execute(DROP_MIRROR_SQL)
+
+    # tally, events and whichever notify triggers are installed
+    cursor.execute(
+        "SELECT tgname, pg_get_triggerdef(oid) FROM pg_trigger "
+        "WHERE tgrelid = %s::regclass AND NOT tgisinternal",
+        [TABLE],
+    )
+    triggers = cursor.fetchall()
+    for name, _ in triggers:
+        cursor.execute(f"DROP TRIGGER {name} ON {TABLE}")
+
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [TABLE])
+    (sequence,) = cursor.fetchone()
+
+    for table, old_suffix, new_suffix in (
+        (TABLE, "", "_old"),
+        (NEW_TABLE, "_new", ""),
+    ):
+        cursor.execute(
+            "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass",
+            [table],
+        )
+        for (name,) in cursor.fetchall():
+            new_name = name[: len(name) - len(old_suffix)] + new_suffix
+            cursor.execute(
+                f"ALTER TABLE {table} RENAME CONSTRAINT {name} TO {new_name}"
+            )
+        for name, _ in table_indexes(cursor, table):
+            new_name = name[: len(name) - len(old_suffix)] + new_suffix
+            cursor.execute(f"ALTER INDEX {name} RENAME TO {new_name}")
+        if table == TABLE:
+            cursor.execute(f"ALTER TABLE {TABLE} RENAME TO {OLD_TABLE}")
+        else:
+            cursor.execute(f"ALTER TABLE {NEW_TABLE} RENAME TO {TABLE}")
+
+    cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {TABLE}.id")
+    for _, definition in triggers:
+        cursor.execute(definition)
+
+
+def move_table(schema_editor, partitioned):
+    """Rebuild `votes_voters` while it is written to: build the new table
+    and mirror the writes to it, copy the rows, swap the tables"""
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        with transaction.atomic(using=connection.alias):
+            build_table(cursor, partitioned)
+            cursor.execute(MIRROR_SQL)
+        backfill(cursor)
+        with transaction.atomic(using=connection.alias):
+            swap_tables(cursor)
+        cursor.execute(f"DROP TABLE {OLD_TABLE}")
+        cursor.execute(f"ANALYZE {TABLE}")
+
+
+def partition_voters(apps, schema_editor):
+    move_table(schema_editor, partitioned=True)
+
+
+def merge_voters(apps, schema_editor):
+    move_table(schema_editor, partitioned=False)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('votes', '0008_voteevent'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_voters, merge_voters),
+    ]
@@ -0,0 +1,83 @@
+from django.db import migrations
+
+# The row trigger of 0006 decremented the tally of the old choice and then
+# incremented the one of the new choice, so two voters switching in
+# opposite directions locked the two rows in opposite orders and
+# deadlocked. The changes of a statement are now added up per tally row
+# and applied by one statement in (vote_id, choice) order, every
+# transaction locks the rows it needs in the same order.
+TALLY_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION vote_tally_statement_func() RETURNS trigger AS $$
+DECLARE
+    changed_rows text;
+BEGIN
+    -- transition tables that the trigger does not define can not be
+    -- referenced, even in a branch that is never taken
+    IF TG_OP = 'INSERT' THEN
+        changed_rows := 'SELECT vote_id, choice, 1 AS delta FROM new_rows';
+    ELSIF TG_OP = 'UPDATE' THEN
+        changed_rows := 'SELECT vote_id, choice, 1 AS delta FROM new_rows '
+            'UNION ALL SELECT vote_id, choice, -1 FROM old_rows';
+    ELSE
+        changed_rows := 'SELECT vote_id, choice, -1 AS delta FROM old_rows';
+    END IF;
+
+    -- like the row trigger, only existing tallies are decremented, e.g.
+    -- not those a cascade delete of the vote already removed
+    EXECUTE format(
+        'INSERT INTO votes_votetally (vote_id, choice, count) '
+        'SELECT vote_id, choice, sum(delta) FROM (%s) AS changed '
+        'GROUP BY vote_id, choice '
+        'HAVING sum(delta) > 0 OR sum(delta) < 0 AND EXISTS ('
+        '    SELECT 1 FROM votes_votetally AS tally'
+        '    WHERE tally.vote_id = changed.vote_id'
+        '    AND tally.choice = changed.choice'
+        ') '
+        'ORDER BY vote_id, choice '
+        'ON CONFLICT (vote_id, choice) '
+        'DO UPDATE SET count = votes_votetally.count + EXCLUDED.count',
+        changed_rows
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS vote_tally_trigger ON votes_voters;
+
+CREATE TRIGGER vote_tally_insert_trigger
+AFTER INSERT ON votes_voters
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE vote_tally_statement_func();
+
+CREATE TRIGGER vote_tally_update_trigger
+AFTER UPDATE ON votes_voters
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE vote_tally_statement_func();
+
+CREATE TRIGGER vote_tally_delete_trigger
+AFTER DELETE ON votes_voters
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE vote_tally_statement_func();
+"""
+
+ROW_TRIGGER_SQL = """
+DROP TRIGGER IF EXISTS vote_tally_insert_trigger ON votes_voters;
+DROP TRIGGER IF EXISTS vote_tally_update_trigger ON votes_voters;
+DROP TRIGGER IF EXISTS vote_tally_delete_trigger ON votes_voters;
+DROP FUNCTION IF EXISTS vote_tally_statement_func();
+
+CREATE TRIGGER vote_tally_trigger
+AFTER INSERT OR UPDATE OR DELETE ON votes_voters
+FOR EACH ROW EXECUTE PROCEDURE vote_tally_func();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('votes', '0009_partition_voters'),
+    ]
+
+    operations = [
+        migrations.RunSQL(TALLY_FUNCTION_SQL, ROW_TRIGGER_SQL),
+    ]
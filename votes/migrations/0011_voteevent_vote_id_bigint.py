@@ -0,0 +1,18 @@
+# Generated by Django 3.2.9 on 2026-10-18 12:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('votes', '0010_vote_tally_statement_triggers'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='voteevent',
+            name='vote_id',
+            field=models.BigIntegerField(),
+        ),
+    ]
@@ -1,8 +1,38 @@
-from django.db import models
+from typing import Iterable, Tuple
+
+from django.db import connections, models, router, transaction
 from django.db.models.constraints import UniqueConstraint
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.text import slugify
 from users.models import Emails
 
+from .cache import invalidate_catalog
+from .partitions import create_partition, detach_partition
+
+
+class VotesQuerySet(models.QuerySet):
+    def delete(self):
+        """Detach the partitions of the votes first, see `Votes.delete`"""
+        with transaction.atomic(using=self.db):
+            for vote_id in self.values_list("id", flat=True):
+                detach_partition(vote_id, using=self.db)
+            return super().delete()
+
+    # the bulk methods send no signal, `bulk_update` goes through `update`
+
+    def update(self, **kwargs):
+        updated = super().update(**kwargs)
+        if updated:
+            invalidate_catalog(self.db)
+        return updated
+
+    def bulk_create(self, objs, *args, **kwargs):
+        created = super().bulk_create(objs, *args, **kwargs)
+        if created:
+            invalidate_catalog(self.db)
+        return created
+
 
 class Votes(models.Model):
     title = models.CharField(max_length=256)
@@ -11,22 +41,93 @@ class Votes(models.Model):
     first_option = models.CharField(max_length=256)
     second_option = models.CharField(max_length=256)
 
+    objects = VotesQuerySet.as_manager()
+
+    @property
+    def options(self) -> list:
+        """Options of the vote, indexed the same way as `VoteTally.choice`"""
+        return [self.first_option, self.second_option]
+
     def save(self, *args, **kwargs):
         self.slug = slugify(self.title)
-        return super().save(*args, **kwargs)
+        adding = self._state.adding
+        using = kwargs.get("using") or router.db_for_write(Votes)
+        with transaction.atomic(using=using):
+            saved = super().save(*args, **kwargs)
+            if adding:
+                create_partition(self.id, using=self._state.db)
+        return saved
+
+    def delete(self, *args, **kwargs):
+        # the ballots go with the partition instead of one by one through
+        # the cascade, see `votes.partitions`
+        using = kwargs.get("using") or router.db_for_write(Votes)
+        with transaction.atomic(using=using):
+            detach_partition(self.id, using=using)
+            return super().delete(*args, **kwargs)
 
     def __str__(self) -> str:
         return self.title + f"({self.first_option}, {self.second_option})"
 
 
+@receiver(post_save, sender=Votes)
+@receiver(post_delete, sender=Votes)
+def invalidate_catalog_on_change(sender, using, **kwargs):
+    invalidate_catalog(using)
+
+
+class VotersManager(models.Manager):
+    def upsert(self, rows: Iterable[Tuple[int, int, int]]) -> int:
+        """Insert or update voters with a single `INSERT ... ON CONFLICT`
+        statement on `vote_voter_unique_constraint`
+
+        Args:
+            rows (Iterable[Tuple[int, int, int]]): `(voter_id, vote_id,
+            choice)` tuples, a `(voter_id, vote_id)` pair must not appear
+            twice
+
+        Returns:
+            int: number of inserted or changed rows
+        """
+        rows = list(rows)
+        if not rows:
+            return 0
+
+        table = self.model._meta.db_table
+        values = ", ".join(["(%s, %s, %s)"] * len(rows))
+        sql = (
+            f"INSERT INTO {table} (voter_id, vote_id, choice) "
+            f"VALUES {values} "
+            "ON CONFLICT (voter_id, vote_id) "
+            "DO UPDATE SET choice = EXCLUDED.choice "
+            f"WHERE {table}.choice IS DISTINCT FROM EXCLUDED.choice"
+        )
+        params = [value for row in rows for value in row]
+
+        db = router.db_for_write(self.model)
+        with connections[db].cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+
 class Voters(models.Model):
+    """Ballot of a voter in a vote.
+
+    `votes_voters` is partitioned by vote (see migration
+    `0009_partition_voters` and `votes.partitions`), its primary key is
+    `(id, vote_id, voter_id)` in the database.
+    """
+
     voter = models.ForeignKey(
         to=Emails, related_name="votes", on_delete=models.CASCADE
     )
     vote = models.ForeignKey(
         to=Votes, related_name="voters", on_delete=models.CASCADE
     )
-    user_choice = models.CharField(max_length=256)
+    # index of the option in `Votes.options`
+    choice = models.SmallIntegerField()
+
+    objects = VotersManager()
 
     class Meta:
         constraints = [
@@ -34,6 +135,99 @@ class Voters(models.Model):
                 fields=["voter", "vote"], name="vote_voter_unique_constraint"
             )
         ]
+        indexes = [
+            models.Index(
+                fields=["vote", "choice"], name="voters_vote_choice_idx"
+            )
+        ]
+
+    @property
+    def user_choice(self) -> str:
+        """Text of the chosen option"""
+        return self.vote.options[self.choice]
+
+    @user_choice.setter
+    def user_choice(self, value: str):
+        self.choice = self.vote.options.index(value)
 
     def __str__(self) -> str:
         return f"{self.voter.email} ({self.user_choice})"
+
+
+class VoteTally(models.Model):
+    """Number of voters per option of a vote.
+
+    Rows are maintained by the `vote_tally_*_trigger` database triggers on
+    `votes_voters` (see migrations `0002_votetally` and
+    `0010_vote_tally_statement_triggers`), so reading the results
+    of a vote never has to scan `Voters`. `votes.utils.rebuild_tallies`
+    recomputes them from scratch.
+    """
+
+    vote = models.ForeignKey(
+        to=Votes, related_name="tallies", on_delete=models.CASCADE
+    )
+    choice = models.PositiveSmallIntegerField()
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(
+                fields=["vote", "choice"], name="vote_tally_unique_constraint"
+            )
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.vote_id}[{self.choice}] = {self.count}"
+
+
+class VoteEvent(models.Model):
+    """Change of a vote, kept after it has been applied to `Voters`.
+
+    Rows are written by the `vote_event_trigger` database trigger on
+    `votes_voters` (see migration `0008_voteevent`) in the same transaction
+    as the change, so the log never misses or invents a vote. `choice` is
+    None when a vote was removed and `old_choice` is None when it was cast
+    for the first time. Events are read in the order of
+    `votes.events.read_events`, see there.
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    txid = models.BigIntegerField()
+    vote_id = models.BigIntegerField()
+    choice = models.SmallIntegerField(null=True)
+    old_choice = models.SmallIntegerField(null=True)
+    created_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["txid", "id"], name="vote_event_position_idx"),
+            models.Index(
+                fields=["vote_id", "txid", "id"],
+                name="vote_event_vote_position_idx",
+            ),
+            models.Index(fields=["created_at"], name="vote_event_created_idx"),
+        ]
+
+    @property
+    def position(self) -> Tuple[int, int]:
+        return (self.txid, self.id)
+
+    def __str__(self) -> str:
+        return f"{self.vote_id}: {self.old_choice} -> {self.choice}"
+
+
+class VoteEventConsumer(models.Model):
+    """Position of the last `VoteEvent` a consumer has processed"""
+
+    name = models.CharField(max_length=128, primary_key=True)
+    txid = models.BigIntegerField(default=0)
+    event_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def position(self) -> Tuple[int, int]:
+        return (self.txid, self.event_id)
+
+    def __str__(self) -> str:
+        return f"{self.name} @ {self.txid}-{self.event_id}"
@@ -0,0 +1,15 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class VotesCursorPagination(CursorPagination):
+    """Keyset pagination over `votes.models.Votes` ordered by `id`
+
+    Args:
+        CursorPagination (class): DRF cursor pagination class
+    """
+
+    ordering = "id"
+    page_size = settings.VOTES_PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = settings.VOTES_MAX_PAGE_SIZE
@@ -0,0 +1,242 @@
+"""Partitions of `votes_voters`
+
+Since migration `0009_partition_voters` the ballots of every vote are in a
+partition of their own, `votes_voters_<vote id>`, created with the vote and
+split by voter into `VOTERS_HASH_PARTITIONS` tables when more than 1. The
+ballots of a vote without a partition, e.g. created by a process still
+running the previous code during a deploy, go to `votes_voters_default`
+until `manage.py partition_votes` moves them.
+
+Deleting a vote detaches and drops its partition first, so its ballots go
+at once instead of row by row through the cascade and the triggers.
+
+Attaching and detaching lock `votes_voters`. A lock waiting behind a long
+query would queue every read and write of the table behind it, so the
+changes give up waiting after `VOTERS_PARTITION_LOCK_TIMEOUT` seconds and
+are tried again, up to `VOTERS_PARTITION_LOCK_ATTEMPTS` times. `DETACH
+PARTITION CONCURRENTLY` is not an option, the table has a default
+partition.
+"""
+
+import time
+from typing import Callable, List, TypeVar
+
+from django.conf import settings
+from django.db import (
+    DEFAULT_DB_ALIAS,
+    OperationalError,
+    connections,
+    transaction,
+)
+from psycopg2 import errorcodes
+
+TABLE = "votes_voters"
+DEFAULT_PARTITION = "votes_voters_default"
+
+
+def partition_name(vote_id: int) -> str:
+    return f"{TABLE}_{int(vote_id)}"
+
+
+def archive_name(vote_id: int) -> str:
+    return f"{TABLE}_archive_{int(vote_id)}"
+
+
+def _is_partition(cursor, name: str) -> bool:
+    cursor.execute(
+        "SELECT EXISTS (SELECT 1 FROM pg_inherits "
+        "WHERE inhparent = %s::regclass AND inhrelid = to_regclass(%s))",
+        [TABLE, name],
+    )
+    return cursor.fetchone()[0]
+
+
+def _check_constraints(using: str):
+    # a table with foreign keys still to check, deferred until the end of
+    # the transaction that wrote to it, cannot be altered
+    connections[using].check_constraints()
+
+
+T = TypeVar("T")
+
+
+def _lock_not_available(error: OperationalError) -> bool:
+    return getattr(error.__cause__, "pgcode", None) == (
+        errorcodes.LOCK_NOT_AVAILABLE
+    )
+
+
+def _alter(using: str, change: Callable[..., T]) -> T:
+    """Run `change(cursor)` in a transaction, or a savepoint, that waits at
+    most `VOTERS_PARTITION_LOCK_TIMEOUT` seconds for each lock
+
+    Raises:
+        OperationalError: the locks were not granted after
+        `VOTERS_PARTITION_LOCK_ATTEMPTS` attempts
+    """
+    timeout = f"{int(settings.VOTERS_PARTITION_LOCK_TIMEOUT * 1000)}ms"
+    attempts = settings.VOTERS_PARTITION_LOCK_ATTEMPTS
+    for attempt in range(1, attempts + 1):
+        try:
+            with transaction.atomic(using=using), connections[
+                using
+            ].cursor() as cursor:
+                # releasing a savepoint keeps what SET LOCAL changed for the
+                # rest of the transaction, the previous value is put back
+                cursor.execute("SHOW lock_timeout")
+                (previous,) = cursor.fetchone()
+                cursor.execute("SET LOCAL lock_timeout = %s", [timeout])
+                result = change(cursor)
+                cursor.execute("SET LOCAL lock_timeout = %s", [previous])
+                return result
+        except OperationalError as e:
+            if attempt == attempts or not _lock_not_available(e):
+                raise
+        time.sleep(settings.VOTERS_PARTITION_LOCK_TIMEOUT * attempt)
+
+
+def _create_table(cursor, name: str):
+    """Create the standalone table of a partition, with its hash partitions"""
+    modulus = settings.VOTERS_HASH_PARTITIONS
+    if modulus <= 1:
+        cursor.execute(f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)")
+        return
+    cursor.execute(
+        f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS) "
+        "PARTITION BY HASH (voter_id)"
+    )
+    for remainder in range(modulus):
+        cursor.execute(
+            f"CREATE TABLE {name}_{remainder} PARTITION OF {name} "
+            f"FOR VALUES WITH (MODULUS {modulus}, REMAINDER {remainder})"
+        )
+
+
+def _attach(cursor, name: str, vote_id: int):
+    # the constraints, indexes and triggers of `votes_voters` are added to
+    # the table, the foreign keys checked against its rows
+    cursor.execute(
+        f"ALTER TABLE {TABLE} ATTACH PARTITION {name} "
+        f"FOR VALUES IN ({int(vote_id)})"
+    )
+
+
+def create_partition(vote_id: int, using: str = DEFAULT_DB_ALIAS) -> bool:
+    """Give a vote a partition of its own
+
+    Attaching scans `votes_voters_default` for ballots of the vote, so it is
+    done with the vote, see `Votes.save`, and `move_from_default` takes
+    over once the vote has ballots.
+
+    Args:
+        vote_id (int): id of the vote
+        using (str): database alias
+
+    Returns:
+        bool: False if the vote already had a partition
+    """
+    name = partition_name(vote_id)
+
+    def create(cursor) -> bool:
+        if _is_partition(cursor, name):
+            return False
+        _create_table(cursor, name)
+        _attach(cursor, name, vote_id)
+        return True
+
+    return _alter(using, create)
+
+
+def detach_partition(
+    vote_id: int, archive: bool = False, using: str = DEFAULT_DB_ALIAS
+) -> bool:
+    """Take the ballots of a vote out of `votes_voters` at once
+
+    The partition is dropped, or with `archive` kept as
+    `votes_voters_archive_<vote id>` without its foreign keys so the vote
+    can be deleted. No row is deleted so the triggers on `votes_voters` do
+    not run: the vote tallies are deleted with the vote and no event or
+    notification is sent for the ballots.
+
+    Args:
+        vote_id (int): id of the vote
+        archive (bool): keep the ballots in a table of their own
+        using (str): database alias
+
+    Returns:
+        bool: False if the vote had no partition, its ballots if any are in
+        `votes_voters_default`
+    """
+    name = partition_name(vote_id)
+
+    def detach(cursor) -> bool:
+        if not _is_partition(cursor, name):
+            return False
+        _check_constraints(using)
+        cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {name}")
+        if not archive:
+            cursor.execute(f"DROP TABLE {name}")
+            return True
+
+        cursor.execute(
+            "SELECT conname FROM pg_constraint "
+            "WHERE conrelid = %s::regclass AND contype = 'f'",
+            [name],
+        )
+        for (constraint,) in cursor.fetchall():
+            cursor.execute(f"ALTER TABLE {name} DROP CONSTRAINT {constraint}")
+        cursor.execute(f"ALTER TABLE {name} RENAME TO {archive_name(vote_id)}")
+        return True
+
+    return _alter(using, detach)
+
+
+def votes_in_default(using: str = DEFAULT_DB_ALIAS) -> List[int]:
+    """Ids of the votes with ballots in `votes_voters_default`"""
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"SELECT DISTINCT vote_id FROM {DEFAULT_PARTITION} ORDER BY vote_id"
+        )
+        return [vote_id for (vote_id,) in cursor.fetchall()]
+
+
+def move_from_default(vote_id: int, using: str = DEFAULT_DB_ALIAS) -> int:
+    """Move the ballots of a vote from `votes_voters_default` to a partition
+    of its own
+
+    Writes to `votes_voters_default` are blocked meanwhile, those to the
+    other partitions are not. The ballots are moved without running the
+    triggers, so tallies, events and notifications are left as they are.
+
+    Args:
+        vote_id (int): id of the vote
+        using (str): database alias
+
+    Returns:
+        int: number of ballots moved
+    """
+    name = partition_name(vote_id)
+
+    def move(cursor) -> int:
+        cursor.execute(
+            f"LOCK TABLE {DEFAULT_PARTITION} IN SHARE ROW EXCLUSIVE MODE"
+        )
+        if _is_partition(cursor, name):
+            return 0
+        _check_constraints(using)
+        _create_table(cursor, name)
+        cursor.execute(
+            f"INSERT INTO {name} SELECT * FROM {DEFAULT_PARTITION} "
+            "WHERE vote_id = %s",
+            [vote_id],
+        )
+        moved = cursor.rowcount
+        cursor.execute(f"ALTER TABLE {DEFAULT_PARTITION} DISABLE TRIGGER USER")
+        cursor.execute(
+            f"DELETE FROM {DEFAULT_PARTITION} WHERE vote_id = %s", [vote_id]
+        )
+        cursor.execute(f"ALTER TABLE {DEFAULT_PARTITION} ENABLE TRIGGER USER")
+        _attach(cursor, name, vote_id)
+        return moved
+
+    return _alter(using, move)
@@ -1,6 +1,6 @@
 from rest_framework.exceptions import PermissionDenied
 from rest_framework.permissions import BasePermission
-from users.models import Emails
+from users.utils import EmailIdentity
 
 
 class ActiveEmailOnly(BasePermission):
@@ -10,14 +10,15 @@ class ActiveEmailOnly(BasePermission):
         BasePermission (class): DRF base permission class
     """
 
-    def has_object_permission(self, request, view, obj: Emails) -> bool:
+    def has_object_permission(self, request, view, obj: EmailIdentity) -> bool:
         """This is object based permission that will be used by calling
         `self.check_object_permissions(request, email_obj)` inside the view
 
         Args:
             request (django.request): django request object
             view ([type]): django view object
-            obj (Emails): Email object `users.models.Emails`
+            obj (EmailIdentity): `users.utils.EmailIdentity` returned by
+            `Emails.objects.lookup` (or an `users.models.Emails` object)
 
         Raises:
             PermissionDenied: raise error to client with custom message(403 code)
@@ -1,15 +1,44 @@
+from django.conf import settings
 from rest_framework import serializers
 
 from .models import Votes
 
 
 class VotesSerializer(serializers.ModelSerializer):
+    """serializer for `votes.models.Votes`
+
+    Args:
+        fields (list, optional): only serialize these fields. Defaults to
+        every field of the model.
+    """
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
+
     class Meta:
         model = Votes
         fields = "__all__"
 
 
-class VoteUpdateSerializer(serializers.Serializer):
+class VoterSerializer(serializers.Serializer):
+    """serializer of a request sent by a voter, the email identifies the
+    voter unless the request is authenticated with a voter token (see
+    `users.authentication.VoterTokenAuthentication`)
+    """
+
+    email = serializers.EmailField()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get("request")
+        if request is not None and request.auth is not None:
+            self.fields.pop("email")
+
+
+class VoteUpdateSerializer(VoterSerializer):
     """serializer to check data that client is providing
 
     Args:
@@ -17,6 +46,35 @@ class VoteUpdateSerializer(serializers.Serializer):
         all serializers attributes
     """
 
-    email = serializers.EmailField()
     user_choice = serializers.CharField()
     vote_id = serializers.IntegerField()
+
+
+class BallotItemSerializer(serializers.Serializer):
+    vote_id = serializers.IntegerField()
+    user_choice = serializers.CharField()
+
+
+class VoteBatchSerializer(VoterSerializer):
+    """serializer to check a ballot of several votes sent by one email
+
+    Args:
+        serializers (rest_framework.serializers.Serializer): To inherit
+        all serializers attributes
+    """
+
+    votes = BallotItemSerializer(many=True, allow_empty=False)
+
+    def validate_votes(self, value):
+        if len(value) > settings.VOTES_BATCH_MAX_SIZE:
+            raise serializers.ValidationError(
+                f"At most {settings.VOTES_BATCH_MAX_SIZE} votes are allowed"
+            )
+
+        vote_ids = [item["vote_id"] for item in value]
+        if len(set(vote_ids)) != len(vote_ids):
+            raise serializers.ValidationError(
+                "Each vote_id can only appear once"
+            )
+
+        return value
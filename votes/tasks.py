@@ -0,0 +1,52 @@
+import time
+
+from celery import shared_task
+from django.conf import settings
+from users.utils import extend_lock, get_redis, release_lock
+
+from .events import prune_events
+from .ingest import LOCK_KEY, drain_votes
+
+
+@shared_task
+def drain_vote_buffer() -> int:
+    """Write buffered votes into the database until the stream is empty
+
+    Runs every `VOTES_INGEST_FLUSH_INTERVAL` seconds (see
+    `CELERY_BEAT_SCHEDULE`). A Redis lock makes sure only one worker drains
+    the stream at a time, which keeps the votes in order. The lock is
+    extended after every batch, a drain that lost it stops.
+
+    Returns:
+        int: number of buffered votes processed
+    """
+    lock = get_redis().lock(
+        LOCK_KEY, timeout=max(60, settings.VOTES_INGEST_FLUSH_INTERVAL * 10)
+    )
+    if not lock.acquire(blocking=False):
+        return 0
+
+    processed = 0
+    try:
+        deadline = time.monotonic() + settings.VOTES_INGEST_FLUSH_INTERVAL
+        while time.monotonic() < deadline:
+            drained = drain_votes(settings.VOTES_INGEST_BATCH_SIZE)
+            processed += drained
+            if drained < settings.VOTES_INGEST_BATCH_SIZE:
+                break
+            if not extend_lock(lock):
+                break
+    finally:
+        release_lock(lock)
+    return processed
+
+
+@shared_task
+def prune_vote_events() -> int:
+    """Delete vote events every consumer has processed or that are older
+    than `VOTE_EVENTS_RETENTION_DAYS`, runs every hour
+
+    Returns:
+        int: number of deleted events
+    """
+    return prune_events()
@@ -1,14 +1,116 @@
+import asyncio
 import json
+import os
+import select
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from io import StringIO
+from typing import Dict
+from unittest import mock
 
+import psycopg2
+from asgiref.sync import async_to_sync, sync_to_async
+from config.asgi import application
+from config.db.base import POOL_STATS_KEY, close_pools
+from config.db.middleware import PRIMARY_COOKIE
+from config.db.pool import ConnectionPool, PoolTimeout
+from config import app as celery_app
+from config.db.routers import ReplicaRouter, replica_health, use_replicas
+from config.metrics.collector import METRICS_KEY, collector, render
+from config.metrics.instruments import RequestMetrics, measure
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import OperationalError, connection, connections, transaction
 from django.db.utils import IntegrityError
-from django.test import SimpleTestCase, TestCase
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
 from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
 from django.urls import resolve, reverse
+from django.utils import timezone
 from django.utils.text import slugify
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from redis import RedisError
 from users.models import Emails
+from users.throttling import RedisScopedRateThrottle
+from users.aio import close_connections
+from users.utils import get_redis, issue_voter_token
 
-from .api import VotesView
-from .models import Voters, Votes
+from .api import VoteResultsView, VotesBatchView, VotesView
+from .cache import bump_catalog_version
+from .live import (
+    VoteChannelListener,
+    apply_deltas,
+    listener,
+    load_results,
+)
+from .events import (
+    START,
+    commit_offset,
+    consume_events,
+    get_offset,
+    prune_events,
+    read_events,
+)
+from .ingest import (
+    CONSUMER_NAME,
+    GROUP_NAME,
+    LOCK_KEY,
+    STREAM_KEY,
+    drain_votes,
+)
+from .models import VoteEvent, Voters, Votes, VoteTally
+from .partitions import (
+    DEFAULT_PARTITION,
+    archive_name,
+    create_partition,
+    detach_partition,
+    partition_name,
+    votes_in_default,
+)
+from .tasks import drain_vote_buffer
+from .utils import (
+    VoteOptionsCache,
+    get_notify_trigger_mode,
+    rebuild_tallies,
+    set_notify_trigger_mode,
+    vote_options_cache,
+)
+
+
+def clear_metrics():
+    """Drop the request metrics recorded by other tests"""
+    collector.flush(force=True)
+    get_redis().delete(METRICS_KEY)
+
+
+def parse_metrics(text: str) -> Dict[str, float]:
+    """Samples of a Prometheus text exposition by series"""
+    return {
+        series: float(value)
+        for series, value in (
+            line.rsplit(" ", 1)
+            for line in text.splitlines()
+            if line and not line.startswith("#")
+        )
+    }
+
+
+def reset_caches():
+    """Drop what other tests cached in Redis and in this process, the rows
+    they were built from were rolled back"""
+    bump_catalog_version()
+    vote_options_cache.clear()
+    for pattern in ("emails:*", "throttle:*", "voter:revoked:*"):
+        for key in get_redis().scan_iter(pattern):
+            get_redis().delete(key)
 
 
 class TestUrls(SimpleTestCase):
@@ -18,6 +120,14 @@ class TestUrls(SimpleTestCase):
     def test_vote_url(self):
         self.assertEqual(resolve(self.vote_url).func.view_class, VotesView)
 
+    def test_vote_batch_url(self):
+        url = reverse("vote-batch")
+        self.assertEqual(resolve(url).func.view_class, VotesBatchView)
+
+    def test_vote_results_url(self):
+        url = reverse("vote-results", kwargs={"vote_id": 1})
+        self.assertEqual(resolve(url).func.view_class, VoteResultsView)
+
 
 class TestViews(TestCase):
     @classmethod
@@ -37,10 +147,135 @@ class TestViews(TestCase):
             second_option="cats",
         )
 
+    def setUp(self):
+        reset_caches()
+
     def test_votes_list(self):
         response = self.client.get(self.vote_url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.json()), 1)
+        self.assertEqual(len(response.json().get("results")), 1)
+        self.assertIsNone(response.json().get("next"))
+
+    def test_votes_list_is_paginated(self):
+        for i in range(2):
+            Votes.objects.create(
+                title=f"vote {i}",
+                description="",
+                first_option="a",
+                second_option="b",
+            )
+
+        response = self.client.get(self.vote_url, data={"page_size": 2})
+        first_page = [vote["id"] for vote in response.json().get("results")]
+        self.assertEqual(len(first_page), 2)
+
+        response = self.client.get(response.json().get("next"))
+        second_page = [vote["id"] for vote in response.json().get("results")]
+        self.assertEqual(len(second_page), 1)
+        self.assertGreater(second_page[0], max(first_page))
+        self.assertIsNone(response.json().get("next"))
+
+    def test_votes_list_sparse_fields(self):
+        with self.assertNumQueries(1) as context:
+            response = self.client.get(
+                self.vote_url, data={"fields": "id,title"}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json().get("results"),
+            [{"id": self.dogs_cats_vote.id, "title": "Dogs vs Cats"}],
+        )
+        self.assertNotIn("description", context.captured_queries[0]["sql"])
+
+    def test_votes_list_is_cached(self):
+        response = self.client.get(self.vote_url)
+        with self.assertNumQueries(0):
+            cached_response = self.client.get(self.vote_url)
+
+        self.assertEqual(cached_response.status_code, 200)
+        self.assertEqual(cached_response.json(), response.json())
+        self.assertEqual(cached_response["ETag"], response["ETag"])
+
+    def test_votes_list_not_modified(self):
+        etag = self.client.get(self.vote_url)["ETag"]
+        with self.assertNumQueries(0):
+            response = self.client.get(self.vote_url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_votes_list_cache_is_invalidated_on_save(self):
+        etag = self.client.get(self.vote_url)["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            Votes.objects.create(
+                title="new vote",
+                description="",
+                first_option="a",
+                second_option="b",
+            )
+
+        response = self.client.get(self.vote_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(len(response.json().get("results")), 2)
+
+    def test_votes_list_cache_is_invalidated_on_delete(self):
+        self.client.get(self.vote_url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.dogs_cats_vote.delete()
+
+        response = self.client.get(self.vote_url)
+        self.assertEqual(response.json().get("results"), [])
+
+    def test_votes_list_cache_is_invalidated_on_bulk_changes(self):
+        self.client.get(self.vote_url)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            Votes.objects.filter(id=self.dogs_cats_vote.id).update(
+                title="Wolves vs Cats"
+            )
+        self.assertEqual(len(callbacks), 1)
+
+        response = self.client.get(self.vote_url)
+        self.assertEqual(
+            response.json().get("results")[0]["title"], "Wolves vs Cats"
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Votes.objects.bulk_create(
+                [
+                    Votes(
+                        title="new vote",
+                        description="",
+                        first_option="a",
+                        second_option="b",
+                    )
+                ]
+            )
+        response = self.client.get(self.vote_url)
+        self.assertEqual(len(response.json().get("results")), 2)
+
+    @mock.patch("votes.cache.get_redis", side_effect=RedisError)
+    def test_vote_is_saved_without_redis(self, mock_get_redis):
+        with self.assertLogs("votes.cache", "WARNING"):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.dogs_cats_vote.title = "Wolves vs Cats"
+                self.dogs_cats_vote.save()
+        self.dogs_cats_vote.refresh_from_db()
+        self.assertEqual(self.dogs_cats_vote.title, "Wolves vs Cats")
+
+    @mock.patch("votes.api.get_catalog_version", side_effect=RedisError)
+    def test_votes_list_without_redis(self, mock_get_catalog_version):
+        response = self.client.get(self.vote_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json().get("results")), 1)
+        self.assertFalse(response.has_header("ETag"))
+
+    def test_votes_list_unknown_fields(self):
+        response = self.client.get(self.vote_url, data={"fields": "id,votes"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json().get("detail"), "unknown fields: 'votes'"
+        )
 
     def test_vote_PUT_no_data(self):
         response = self.client.put(self.vote_url)
@@ -66,6 +301,20 @@ class TestViews(TestCase):
             response.json().get("email")[0], "Enter a valid email address."
         )
 
+    @mock.patch.object(
+        RedisScopedRateThrottle, "THROTTLE_RATES", {"vote": "2/min"}
+    )
+    def test_vote_PUT_is_throttled(self):
+        for _ in range(2):
+            response = self.client.put(self.vote_url)
+            self.assertEqual(response.status_code, 400)
+
+        response = self.client.put(self.vote_url)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+        # reading the catalog is not throttled
+        self.assertEqual(self.client.get(self.vote_url).status_code, 200)
+
     def test_vote_PUT_email_does_not_exist(self):
         response = self.client.put(
             self.vote_url,
@@ -73,7 +322,7 @@ class TestViews(TestCase):
                 {
                     "email": "test@email.com",
                     "user_choice": "dogs",
-                    "vote_id": 1,
+                    "vote_id": self.dogs_cats_vote.id,
                 }
             ),
             content_type="application/json",
@@ -88,7 +337,7 @@ class TestViews(TestCase):
                 {
                     "email": "test_inactive@email.com",
                     "user_choice": "dogs",
-                    "vote_id": 1,
+                    "vote_id": self.dogs_cats_vote.id,
                 }
             ),
             content_type="application/json",
@@ -103,7 +352,7 @@ class TestViews(TestCase):
                 {
                     "email": "test_active@email.com",
                     "user_choice": "dogs",
-                    "vote_id": 2,
+                    "vote_id": self.dogs_cats_vote.id + 1,
                 }
             ),
             content_type="application/json",
@@ -118,7 +367,7 @@ class TestViews(TestCase):
                 {
                     "email": "test_active@email.com",
                     "user_choice": "invalid choice",
-                    "vote_id": 1,
+                    "vote_id": self.dogs_cats_vote.id,
                 }
             ),
             content_type="application/json",
@@ -136,7 +385,7 @@ class TestViews(TestCase):
                 {
                     "email": "test_active@email.com",
                     "user_choice": "dogs",
-                    "vote_id": 1,
+                    "vote_id": self.dogs_cats_vote.id,
                 }
             ),
             content_type="application/json",
@@ -159,7 +408,7 @@ class TestViews(TestCase):
                 {
                     "email": "test_active@email.com",
                     "user_choice": "cats",
-                    "vote_id": 1,
+                    "vote_id": self.dogs_cats_vote.id,
                 }
             ),
             content_type="application/json",
@@ -173,7 +422,7 @@ class TestViews(TestCase):
                 {
                     "email": "test_active@email.com",
                     "user_choice": "dogs",
-                    "vote_id": 1,
+                    "vote_id": self.dogs_cats_vote.id,
                 }
             ),
             content_type="application/json",
@@ -189,50 +438,2002 @@ class TestViews(TestCase):
             "dogs",
         )
 
+    def test_vote_PUT_uses_two_queries(self):
+        data = json.dumps(
+            {
+                "email": "test_active@email.com",
+                "user_choice": "cats",
+                "vote_id": self.dogs_cats_vote.id,
+            }
+        )
+        vote_options_cache.get(self.dogs_cats_vote.id)
+        with self.assertNumQueries(2):
+            response = self.client.put(
+                self.vote_url, data=data, content_type="application/json"
+            )
+        self.assertEqual(response.status_code, 200)
+
+        # the email is cached now
+        with self.assertNumQueries(1):
+            response = self.client.put(
+                self.vote_url, data=data, content_type="application/json"
+            )
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(
+            Voters.objects.get(voter=self.email_obj_active).user_choice, "cats"
+        )
+
+    def test_vote_PUT_with_voter_token(self):
+        token = issue_voter_token(self.email_obj_active.id)
+        data = json.dumps(
+            {"user_choice": "cats", "vote_id": self.dogs_cats_vote.id}
+        )
+        vote_options_cache.get(self.dogs_cats_vote.id)
+        # the email is neither cached nor read, only whether its tokens
+        # were revoked, once
+        with self.assertNumQueries(2):
+            response = self.client.put(
+                self.vote_url,
+                data=data,
+                content_type="application/json",
+                HTTP_AUTHORIZATION=f"Bearer {token}",
+            )
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(1):
+            response = self.client.put(
+                self.vote_url,
+                data=data,
+                content_type="application/json",
+                HTTP_AUTHORIZATION=f"Bearer {token}",
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            Voters.objects.get(voter=self.email_obj_active).user_choice, "cats"
+        )
+
+    def test_vote_PUT_with_invalid_voter_token(self):
+        token = issue_voter_token(self.email_obj_active.id)
+        data = json.dumps(
+            {"user_choice": "cats", "vote_id": self.dogs_cats_vote.id}
+        )
+        for authorization in (f"Bearer {token}x", "Bearer", "Bearer a b"):
+            response = self.client.put(
+                self.vote_url,
+                data=data,
+                content_type="application/json",
+                HTTP_AUTHORIZATION=authorization,
+            )
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(response["WWW-Authenticate"], "Bearer")
+
+    def test_vote_PUT_with_revoked_voter_token(self):
+        token = issue_voter_token(self.email_obj_active.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.email_obj_active.is_active = False
+            self.email_obj_active.save()
+
+        response = self.client.put(
+            self.vote_url,
+            data=json.dumps(
+                {"user_choice": "cats", "vote_id": self.dogs_cats_vote.id}
+            ),
+            content_type="application/json",
+            HTTP_AUTHORIZATION=f"Bearer {token}",
+        )
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json().get("detail"), "token revoked")
+
+    @mock.patch(
+        "users.authentication.is_voter_token_revoked", side_effect=RedisError
+    )
+    def test_vote_PUT_with_voter_token_redis_unavailable(self, revoked):
+        token = issue_voter_token(self.email_obj_inactive.id)
+        response = self.client.put(
+            self.vote_url,
+            data=json.dumps(
+                {"user_choice": "cats", "vote_id": self.dogs_cats_vote.id}
+            ),
+            content_type="application/json",
+            HTTP_AUTHORIZATION=f"Bearer {token}",
+        )
+        # the email is checked in the database instead
+        self.assertEqual(response.status_code, 401)
+
+    def test_vote_PUT_invalid_vote_without_queries(self):
+        data = {
+            "email": "test_active@email.com",
+            "user_choice": "fox",
+            "vote_id": self.dogs_cats_vote.id,
+        }
+        vote_options_cache.get(self.dogs_cats_vote.id)
+        vote_options_cache.get(self.dogs_cats_vote.id + 1)
+
+        with self.assertNumQueries(0):
+            response = self.client.put(
+                self.vote_url,
+                data=json.dumps(data),
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, 400)
+
+            data["vote_id"] = self.dogs_cats_vote.id + 1
+            response = self.client.put(
+                self.vote_url,
+                data=json.dumps(data),
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, 404)
+
+
+class TestVoteOptionsCache(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.vote = Votes.objects.create(
+            title="Dogs vs Cats",
+            description="testing vote",
+            first_option="dogs",
+            second_option="cats",
+        )
 
-class TestModels(TestCase):
     def setUp(self):
-        self.vote = Votes.objects.create(
-            title="some title for a vote",
-            description="some description",
-            first_option="option a",
-            second_option="option b",
+        self.cache = VoteOptionsCache(maxsize=2, ttl=60)
+
+    def test_get_many(self):
+        missing_id = self.vote.id + 1
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.cache.get_many([self.vote.id, missing_id]),
+                {self.vote.id: ["dogs", "cats"], missing_id: None},
+            )
+        with self.assertNumQueries(0):
+            self.assertEqual(self.cache.get(self.vote.id), ["dogs", "cats"])
+            self.assertIsNone(self.cache.get(missing_id))
+
+    def test_version_change_drops_entries(self):
+        self.cache.get(self.vote.id)
+        Votes.objects.filter(id=self.vote.id).update(first_option="wolves")
+        bump_catalog_version()
+
+        self.assertEqual(self.cache.get(self.vote.id), ["wolves", "cats"])
+
+    def test_entries_expire(self):
+        self.cache.ttl = 0
+        self.cache.get(self.vote.id)
+        with self.assertNumQueries(1):
+            self.cache.get(self.vote.id)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.cache.get_many([self.vote.id, self.vote.id + 1])
+        self.cache.get(self.vote.id)
+        self.cache.get(self.vote.id + 2)
+
+        with self.assertNumQueries(0):
+            self.cache.get(self.vote.id)
+        with self.assertNumQueries(1):
+            self.cache.get(self.vote.id + 1)
+
+
+class TestBatchViews(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.batch_url = reverse("vote-batch")
+        cls.email_obj_active = Emails.objects.create(
+            email="test_active@email.com", is_active=True
         )
-        self.email_obj = Emails.objects.create(
-            email="test@email.com", is_active=True
+        cls.email_obj_inactive = Emails.objects.create(
+            email="test_inactive@email.com", is_active=False
+        )
+        cls.dogs_cats_vote = Votes.objects.create(
+            title="Dogs vs Cats",
+            description="testing vote",
+            first_option="dogs",
+            second_option="cats",
+        )
+        cls.red_blue_vote = Votes.objects.create(
+            title="Red vs Blue",
+            description="testing vote",
+            first_option="red",
+            second_option="blue",
         )
 
-    def test_vote_is_assigned_slug_on_creation(self):
-        self.assertEqual(self.vote.slug, slugify("some title for a vote"))
+    def setUp(self):
+        reset_caches()
 
-    def test_vote_model_str(self):
+    def put_ballot(self, email, votes):
+        return self.client.put(
+            self.batch_url,
+            data=json.dumps({"email": email, "votes": votes}),
+            content_type="application/json",
+        )
+
+    def test_vote_batch_PUT_no_votes(self):
+        response = self.put_ballot("test_active@email.com", [])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("votes", response.json())
+
+    def test_vote_batch_PUT_duplicate_vote(self):
+        vote_id = self.dogs_cats_vote.id
+        response = self.put_ballot(
+            "test_active@email.com",
+            [
+                {"vote_id": vote_id, "user_choice": "dogs"},
+                {"vote_id": vote_id, "user_choice": "cats"},
+            ],
+        )
+        self.assertEqual(response.status_code, 400)
         self.assertEqual(
-            str(self.vote),
-            f"{self.vote.title}({self.vote.first_option}, {self.vote.second_option})",
+            response.json().get("votes")[0], "Each vote_id can only appear once"
         )
 
-    def test_voter_model_str(self):
-        voter_obj = Voters.objects.create(
-            vote=self.vote, voter=self.email_obj, user_choice="option a"
+    @override_settings(VOTES_BATCH_MAX_SIZE=1)
+    def test_vote_batch_PUT_too_many_votes(self):
+        response = self.put_ballot(
+            "test_active@email.com",
+            [
+                {"vote_id": self.dogs_cats_vote.id, "user_choice": "dogs"},
+                {"vote_id": self.dogs_cats_vote.id + 1, "user_choice": "a"},
+            ],
         )
+        self.assertEqual(response.status_code, 400)
         self.assertEqual(
-            str(voter_obj),
-            f"{self.email_obj.email} ({voter_obj.user_choice})",
+            response.json(), {"votes": ["At most 1 votes are allowed"]}
         )
 
-    def test_voter_models_unique_constraint(self):
-        email_obj = Emails.objects.create(
-            email="test1@email.com", is_active=True
+    def test_vote_batch_PUT_email_does_not_exist(self):
+        response = self.put_ballot(
+            "test@email.com",
+            [{"vote_id": self.dogs_cats_vote.id, "user_choice": "dogs"}],
         )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json().get("detail"), "email not found")
 
-        Voters.objects.create(
-            vote=self.vote, voter=email_obj, user_choice="cats"
+    def test_vote_batch_PUT_email_does_not_have_permission(self):
+        response = self.put_ballot(
+            "test_inactive@email.com",
+            [{"vote_id": self.dogs_cats_vote.id, "user_choice": "dogs"}],
         )
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json().get("detail"), "email not activated")
 
-        with self.assertRaises(IntegrityError):
-            Voters.objects.create(
-                vote=self.vote, voter=email_obj, user_choice="option b"
+    def test_vote_batch_PUT_per_vote_results(self):
+        missing_vote_id = self.red_blue_vote.id + 1
+        with self.assertNumQueries(3):
+            response = self.put_ballot(
+                "test_active@email.com",
+                [
+                    {"vote_id": self.dogs_cats_vote.id, "user_choice": "cats"},
+                    {"vote_id": missing_vote_id, "user_choice": "cats"},
+                    {"vote_id": self.red_blue_vote.id, "user_choice": "fox"},
+                ],
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [result["status"] for result in response.json().get("results")],
+            [200, 404, 400],
+        )
+        self.assertEqual(
+            response.json().get("results")[2].get("valid_options"),
+            ["red", "blue"],
+        )
+        self.assertEqual(
+            list(
+                Voters.objects.filter(voter=self.email_obj_active).values_list(
+                    "vote_id", "choice"
+                )
+            ),
+            [(self.dogs_cats_vote.id, 1)],
+        )
+
+    def test_vote_batch_PUT_update_votes(self):
+        self.put_ballot(
+            "test_active@email.com",
+            [
+                {"vote_id": self.dogs_cats_vote.id, "user_choice": "cats"},
+                {"vote_id": self.red_blue_vote.id, "user_choice": "red"},
+            ],
+        )
+        response = self.put_ballot(
+            "test_active@email.com",
+            [
+                {"vote_id": self.dogs_cats_vote.id, "user_choice": "dogs"},
+                {"vote_id": self.red_blue_vote.id, "user_choice": "red"},
+            ],
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            dict(
+                Voters.objects.filter(voter=self.email_obj_active).values_list(
+                    "vote_id", "choice"
+                )
+            ),
+            {self.dogs_cats_vote.id: 0, self.red_blue_vote.id: 0},
+        )
+
+
+class TestBatchViewsDeletedVote(TransactionTestCase):
+    # the foreign keys are checked when the upsert commits
+
+    def setUp(self):
+        reset_caches()
+        self.batch_url = reverse("vote-batch")
+        self.email_obj_active = Emails.objects.create(
+            email="test_active@email.com", is_active=True
+        )
+        self.dogs_cats_vote = Votes.objects.create(
+            title="Dogs vs Cats",
+            description="testing vote",
+            first_option="dogs",
+            second_option="cats",
+        )
+
+    put_ballot = TestBatchViews.put_ballot
+
+    def test_vote_batch_PUT_vote_deleted_after_validation(self):
+        deleted_vote_id = self.dogs_cats_vote.id + 1
+        options = {
+            self.dogs_cats_vote.id: ["dogs", "cats"],
+            deleted_vote_id: ["red", "blue"],
+        }
+        with mock.patch.object(
+            vote_options_cache, "get_many", return_value=options
+        ):
+            response = self.put_ballot(
+                "test_active@email.com",
+                [
+                    {"vote_id": self.dogs_cats_vote.id, "user_choice": "cats"},
+                    {"vote_id": deleted_vote_id, "user_choice": "red"},
+                ],
             )
 
-    def test_voter_models_user_choice_max_length(self):
-        self.assertEqual(Voters._meta.get_field("user_choice").max_length, 256)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json().get("results")[1],
+            {
+                "vote_id": deleted_vote_id,
+                "status": 404,
+                "detail": "vote does not exist",
+            },
+        )
+        self.assertEqual(response.json().get("results")[0]["status"], 200)
+        self.assertEqual(
+            list(
+                Voters.objects.filter(voter=self.email_obj_active).values_list(
+                    "vote_id", "choice"
+                )
+            ),
+            [(self.dogs_cats_vote.id, 1)],
+        )
+
+
+@override_settings(VOTES_INGESTION_MODE="buffered")
+class TestIngestion(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.email_obj = Emails.objects.create(
+            email="test_active@email.com", is_active=True
+        )
+        cls.vote = Votes.objects.create(
+            title="Dogs vs Cats",
+            description="testing vote",
+            first_option="dogs",
+            second_option="cats",
+        )
+
+    def setUp(self):
+        reset_caches()
+        get_redis().delete(STREAM_KEY)
+
+    def cast_vote(self, user_choice):
+        return self.client.put(
+            reverse("vote"),
+            data=json.dumps(
+                {
+                    "email": self.email_obj.email,
+                    "user_choice": user_choice,
+                    "vote_id": self.vote.id,
+                }
+            ),
+            content_type="application/json",
+        )
+
+    def test_vote_PUT_is_buffered(self):
+        response = self.cast_vote("dogs")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json().get("detail"), "accepted")
+        self.assertFalse(Voters.objects.exists())
+        self.assertEqual(get_redis().xlen(STREAM_KEY), 1)
+
+    def test_vote_PUT_invalid_choice_is_not_buffered(self):
+        response = self.cast_vote("fox")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(get_redis().xlen(STREAM_KEY), 0)
+
+    def test_drain_collapses_changed_votes(self):
+        self.cast_vote("dogs")
+        self.cast_vote("cats")
+
+        self.assertEqual(drain_votes(), 2)
+
+        self.assertEqual(
+            list(Voters.objects.values_list("voter_id", "choice")),
+            [(self.email_obj.id, 1)],
+        )
+        self.assertEqual(get_redis().xlen(STREAM_KEY), 0)
+        self.assertEqual(drain_votes(), 0)
+
+    def test_drain_replays_unacknowledged_votes(self):
+        self.cast_vote("cats")
+        # read the entry without acknowledging it, like a crashed worker
+        get_redis().xgroup_create(STREAM_KEY, GROUP_NAME, id="0")
+        get_redis().xreadgroup(GROUP_NAME, CONSUMER_NAME, {STREAM_KEY: ">"})
+        self.cast_vote("dogs")
+
+        self.assertEqual(drain_votes(), 1)
+        self.assertEqual(drain_votes(), 1)
+        self.assertEqual(Voters.objects.get().user_choice, "dogs")
+
+    def test_drain_converts_text_choices(self):
+        get_redis().xadd(
+            STREAM_KEY,
+            {
+                "voter_id": self.email_obj.id,
+                "vote_id": self.vote.id,
+                "user_choice": "cats",
+            },
+        )
+        self.assertEqual(drain_votes(), 1)
+        self.assertEqual(Voters.objects.get().choice, 1)
+
+    def test_drain_vote_buffer_task(self):
+        self.cast_vote("dogs")
+        self.assertEqual(drain_vote_buffer(), 1)
+        self.assertEqual(Voters.objects.get().user_choice, "dogs")
+
+    @override_settings(VOTES_INGEST_BATCH_SIZE=1)
+    def test_drain_vote_buffer_task_stops_once_lock_expired(self):
+        def drain(batch_size):
+            # the drain took longer than the lock timeout
+            get_redis().delete(LOCK_KEY)
+            return batch_size
+
+        with mock.patch("votes.tasks.drain_votes", side_effect=drain) as drain:
+            self.assertEqual(drain_vote_buffer(), 1)
+        self.assertEqual(drain.call_count, 1)
+
+
+class TestResults(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.email_obj = Emails.objects.create(
+            email="test_active@email.com", is_active=True
+        )
+        cls.vote = Votes.objects.create(
+            title="Dogs vs Cats",
+            description="testing vote",
+            first_option="dogs",
+            second_option="cats",
+        )
+        cls.results_url = reverse(
+            "vote-results", kwargs={"vote_id": cls.vote.id}
+        )
+
+    def setUp(self):
+        reset_caches()
+
+    def cast_vote(self, email, user_choice):
+        return self.client.put(
+            reverse("vote"),
+            data=json.dumps(
+                {
+                    "email": email,
+                    "user_choice": user_choice,
+                    "vote_id": self.vote.id,
+                }
+            ),
+            content_type="application/json",
+        )
+
+    def counts(self):
+        return [
+            r["count"]
+            for r in self.client.get(self.results_url).json()["results"]
+        ]
+
+    def test_results_vote_does_not_exist(self):
+        response = self.client.get(
+            reverse("vote-results", kwargs={"vote_id": self.vote.id + 1})
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json().get("detail"), "vote does not exist")
+
+    def test_results_without_voters(self):
+        response = self.client.get(self.results_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(),
+            {
+                "vote_id": self.vote.id,
+                "results": [
+                    {"option": "dogs", "count": 0},
+                    {"option": "cats", "count": 0},
+                ],
+                "total": 0,
+            },
+        )
+
+    def test_results_count_new_votes(self):
+        other = Emails.objects.create(email="other@email.com", is_active=True)
+        self.cast_vote(self.email_obj.email, "dogs")
+        self.cast_vote(other.email, "dogs")
+        self.assertEqual(self.counts(), [2, 0])
+
+    def test_results_follow_changed_vote(self):
+        self.cast_vote(self.email_obj.email, "dogs")
+        self.cast_vote(self.email_obj.email, "cats")
+        self.cast_vote(self.email_obj.email, "cats")
+        self.assertEqual(self.counts(), [0, 1])
+
+    def test_results_follow_deleted_voter(self):
+        self.cast_vote(self.email_obj.email, "dogs")
+        Voters.objects.filter(voter=self.email_obj).delete()
+        self.assertEqual(self.counts(), [0, 0])
+
+    def test_rebuild_tallies(self):
+        self.cast_vote(self.email_obj.email, "cats")
+        VoteTally.objects.all().update(count=100)
+
+        self.assertEqual(rebuild_tallies([self.vote.id]), 1)
+        self.assertEqual(self.counts(), [0, 1])
+
+    def test_rebuild_tallies_command(self):
+        self.cast_vote(self.email_obj.email, "dogs")
+        VoteTally.objects.all().delete()
+
+        call_command("rebuild_tallies", stdout=StringIO())
+        self.assertEqual(self.counts(), [1, 0])
+
+
+# like django's test client, keep the connection of the test transaction
+@mock.patch("votes.live.close_old_connections", mock.Mock())
+@mock.patch.object(VoteChannelListener, "_listen", mock.AsyncMock())
+class TestLiveResults(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.email_obj = Emails.objects.create(
+            email="test_active@email.com", is_active=True
+        )
+        cls.vote = Votes.objects.create(
+            title="Dogs vs Cats",
+            description="testing vote",
+            first_option="dogs",
+            second_option="cats",
+        )
+        cls.live_url = f"/api/vote/{cls.vote.id}/live/"
+
+    def setUp(self):
+        reset_caches()
+
+    async def notify(self, choice, old_choice=None):
+        await sync_to_async(Voters.objects.upsert)(
+            [(self.email_obj.id, self.vote.id, choice)]
+        )
+        listener.dispatch(
+            json.dumps(
+                {
+                    "id": 1,
+                    "vote_id": self.vote.id,
+                    "choice": choice,
+                    "old_choice": old_choice,
+                }
+            )
+        )
+
+    def stream(self, path, method="GET", choices=(), headers=()):
+        """Open a live stream, vote `choices` one after the other once the
+        first event is sent and close the stream after the next one"""
+        messages = []
+
+        async def run():
+            closed = asyncio.Event()
+
+            async def receive():
+                await closed.wait()
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                messages.append(message)
+                events = [m for m in messages if m.get("more_body")]
+                if len(events) == 1 and message is events[0]:
+                    old_choice = None
+                    for choice in choices:
+                        await self.notify(choice, old_choice)
+                        old_choice = choice
+                elif len(events) > 1:
+                    closed.set()
+
+            scope = {
+                "type": "http",
+                "method": method,
+                "path": path,
+                "headers": list(headers),
+            }
+            await asyncio.wait_for(application(scope, receive, send), 5)
+
+        async_to_sync(run)()
+        return messages
+
+    def events(self, messages):
+        return [
+            json.loads(m["body"].decode().split("data: ")[1])
+            for m in messages
+            if m.get("more_body")
+        ]
+
+    def test_live_results_vote_does_not_exist(self):
+        messages = self.stream(f"/api/vote/{self.vote.id + 1}/live/")
+        self.assertEqual(messages[0]["status"], 404)
+        self.assertEqual(
+            json.loads(messages[1]["body"]), {"detail": "vote does not exist"}
+        )
+        self.assertEqual(listener._subscribers, {})
+
+    def test_live_results_only_get(self):
+        messages = self.stream(self.live_url, method="POST")
+        self.assertEqual(messages[0]["status"], 405)
+
+    def test_live_results_stream(self):
+        messages = self.stream(self.live_url, choices=[0, 1])
+
+        self.assertEqual(messages[0]["status"], 200)
+        self.assertIn(
+            (b"content-type", b"text/event-stream"), messages[0]["headers"]
+        )
+        first, second = self.events(messages)
+        self.assertEqual(
+            second,
+            self.client.get(
+                reverse("vote-results", kwargs={"vote_id": self.vote.id})
+            ).json(),
+        )
+        self.assertEqual([r["count"] for r in first["results"]], [0, 0])
+        self.assertEqual([r["count"] for r in second["results"]], [0, 1])
+        self.assertEqual(listener._subscribers, {})
+
+    def test_live_results_cors_headers(self):
+        messages = self.stream(
+            self.live_url,
+            choices=[0],
+            headers=[(b"origin", b"http://localhost:3000")],
+        )
+        self.assertEqual(messages[0]["status"], 200)
+        self.assertIn(
+            (b"access-control-allow-origin", b"http://localhost:3000"),
+            messages[0]["headers"],
+        )
+
+        messages = self.stream(
+            self.live_url,
+            choices=[1],
+            headers=[(b"origin", b"http://evil.com")],
+        )
+        self.assertNotIn(
+            b"access-control-allow-origin",
+            [name for name, _ in messages[0]["headers"]],
+        )
+
+    @override_settings(VOTE_LIVE_COALESCE_WINDOW_MS=10)
+    def test_listener_coalesces_notifications(self):
+        other_vote = Votes.objects.create(
+            title="other", description="", first_option="a", second_option="b"
+        )
+
+        def payload(vote_id, choice, old_choice=None):
+            return json.dumps(
+                {"vote_id": vote_id, "choice": choice, "old_choice": old_choice}
+            )
+
+        async def run():
+            queue = await listener.subscribe(self.vote.id)
+            other_queue = await listener.subscribe(other_vote.id)
+            try:
+                with mock.patch(
+                    "votes.live.load_results", wraps=load_results
+                ) as load:
+                    await asyncio.wait_for(queue.get(), 5)
+                    await asyncio.wait_for(other_queue.get(), 5)
+                    for _ in range(5):
+                        listener.dispatch(payload(self.vote.id, 0))
+                    listener.dispatch(payload(self.vote.id, 1, 0))
+                    # sent by the statement level triggers
+                    listener.dispatch(
+                        json.dumps(
+                            {"vote_id": self.vote.id, "deltas": {"0": 2}}
+                        )
+                    )
+                    listener.dispatch("not json")
+                    results = await asyncio.wait_for(queue.get(), 5)
+                    await asyncio.sleep(0.05)
+                return results, load.call_count, queue.empty(), other_queue
+            finally:
+                listener.unsubscribe(self.vote.id, queue)
+                listener.unsubscribe(other_vote.id, other_queue)
+
+        results, reads, drained, other_queue = async_to_sync(run)()
+        self.assertEqual([r["count"] for r in results["results"]], [6, 1])
+        self.assertEqual(results["total"], 7)
+        # one read for each vote when it is first watched, none afterwards
+        self.assertEqual(reads, 2)
+        self.assertTrue(drained)
+        self.assertTrue(other_queue.empty())
+
+    def test_listener_refreshes_on_row_notifications(self):
+        async def run():
+            queue = await listener.subscribe(self.vote.id)
+            try:
+                await asyncio.wait_for(queue.get(), 5)
+                await sync_to_async(Voters.objects.upsert)(
+                    [(self.email_obj.id, self.vote.id, 1)]
+                )
+                # sent by the trigger before notifications had `old_choice`
+                listener.dispatch(
+                    json.dumps(
+                        {
+                            "id": 1,
+                            "voter_id": self.email_obj.id,
+                            "vote_id": self.vote.id,
+                            "choice": 1,
+                        }
+                    )
+                )
+                return await asyncio.wait_for(queue.get(), 5)
+            finally:
+                listener.unsubscribe(self.vote.id, queue)
+
+        results = async_to_sync(run)()
+        self.assertEqual([r["count"] for r in results["results"]], [0, 1])
+
+    def test_apply_deltas(self):
+        results = {
+            "vote_id": 1,
+            "results": [
+                {"option": "dogs", "count": 3},
+                {"option": "cats", "count": 1},
+            ],
+            "total": 4,
+        }
+        self.assertEqual(
+            apply_deltas(results, Counter({0: -1, 1: 2})),
+            {
+                "vote_id": 1,
+                "results": [
+                    {"option": "dogs", "count": 2},
+                    {"option": "cats", "count": 3},
+                ],
+                "total": 5,
+            },
+        )
+
+
+class TestVoteNotifications(TransactionTestCase):
+    """Notifications are only sent on commit, so votes are really written"""
+
+    def setUp(self):
+        reset_caches()
+        self.vote = Votes.objects.create(
+            title="Dogs vs Cats",
+            description="testing vote",
+            first_option="dogs",
+            second_option="cats",
+        )
+        self.voter_ids = [
+            Emails.objects.create(
+                email=f"voter{i}@email.com", is_active=True
+            ).id
+            for i in range(3)
+        ]
+        self.conn = psycopg2.connect(**connection.get_connection_params())
+        self.conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with self.conn.cursor() as cursor:
+            cursor.execute("LISTEN vote_channel")
+
+    def tearDown(self):
+        self.conn.close()
+        set_notify_trigger_mode("row")
+
+    def notifications(self):
+        payloads = []
+        while select.select([self.conn], [], [], 0.2)[0]:
+            self.conn.poll()
+            while self.conn.notifies:
+                payload = json.loads(self.conn.notifies.pop(0).payload)
+                del payload["seq"]
+                payloads.append(payload)
+        return payloads
+
+    def test_row_mode_is_installed_by_migrations(self):
+        self.assertEqual(get_notify_trigger_mode(), "row")
+
+    def test_row_notifications(self):
+        Voters.objects.upsert(
+            [(voter_id, self.vote.id, 0) for voter_id in self.voter_ids]
+        )
+        Voters.objects.upsert([(self.voter_ids[0], self.vote.id, 1)])
+        Voters.objects.filter(voter_id=self.voter_ids[1]).delete()
+
+        vote_id = self.vote.id
+        self.assertEqual(
+            self.notifications(),
+            [{"vote_id": vote_id, "choice": 0, "old_choice": None}] * 3
+            + [
+                {"vote_id": vote_id, "choice": 1, "old_choice": 0},
+                {"vote_id": vote_id, "choice": None, "old_choice": 0},
+            ],
+        )
+
+    def test_statement_notifications(self):
+        call_command("set_vote_notify_mode", "statement", stdout=StringIO())
+        self.assertEqual(get_notify_trigger_mode(), "statement")
+
+        Voters.objects.upsert(
+            [(voter_id, self.vote.id, 0) for voter_id in self.voter_ids[:2]]
+        )
+        # one new vote and one changed vote
+        Voters.objects.upsert(
+            [
+                (self.voter_ids[0], self.vote.id, 1),
+                (self.voter_ids[2], self.vote.id, 1),
+            ]
+        )
+        Voters.objects.filter(vote=self.vote).delete()
+
+        vote_id = self.vote.id
+        self.assertEqual(
+            self.notifications(),
+            [
+                {"vote_id": vote_id, "deltas": {"0": 2}},
+                {"vote_id": vote_id, "deltas": {"0": -1, "1": 1}},
+                {"vote_id": vote_id, "deltas": {"1": 1}},
+                {"vote_id": vote_id, "deltas": {"0": -1, "1": -2}},
+            ],
+        )
+
+    def test_set_vote_notify_mode_command(self):
+        out = StringIO()
+        call_command("set_vote_notify_mode", "statement", stdout=out)
+        call_command("set_vote_notify_mode", "row", stdout=out)
+        self.assertEqual(get_notify_trigger_mode(), "row")
+        self.assertIn("from row to statement", out.getvalue())
+        self.assertIn("from statement to row", out.getvalue())
+
+
+class TestTallyConcurrency(TransactionTestCase):
+    """Voters switching in opposite directions at the same time"""
+
+    def setUp(self):
+        self.vote = Votes.objects.create(
+            title="Dogs vs Cats",
+            description="testing vote",
+            first_option="dogs",
+            second_option="cats",
+        )
+        self.voter_ids = [
+            Emails.objects.create(
+                email=f"voter{i}@email.com", is_active=True
+            ).id
+            for i in range(16)
+        ]
+        Voters.objects.upsert(
+            [
+                (voter_id, self.vote.id, i % 2)
+                for i, voter_id in enumerate(self.voter_ids)
+            ]
+        )
+
+    def test_concurrent_switches_do_not_deadlock(self):
+        errors = []
+        barrier = threading.Barrier(len(self.voter_ids))
+
+        def switch(i, voter_id):
+            try:
+                barrier.wait()
+                for n in range(1, 31):
+                    Voters.objects.upsert(
+                        [(voter_id, self.vote.id, (i + n) % 2)]
+                    )
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=switch, args=(i, voter_id))
+            for i, voter_id in enumerate(self.voter_ids)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        counts = Counter(
+            Voters.objects.filter(vote=self.vote).values_list(
+                "choice", flat=True
+            )
+        )
+        self.assertEqual(
+            dict(self.vote.tallies.values_list("choice", "count")),
+            {0: counts[0], 1: counts[1]},
+        )
+
+    def test_cascade_delete_of_vote(self):
+        # ballots outside of a partition are deleted with the tallies
+        detach_partition(self.vote.id)
+        Voters.objects.upsert([(self.voter_ids[0], self.vote.id, 0)])
+        vote_id = self.vote.id
+
+        self.vote.delete()
+
+        self.assertFalse(VoteTally.objects.filter(vote_id=vote_id).exists())
+
+
+class TestVoteEvents(TransactionTestCase):
+    """Events are only read from finished transactions, so votes are really
+    written"""
+
+    def setUp(self):
+        reset_caches()
+        self.vote = Votes.objects.create(
+            title="Dogs vs Cats",
+            description="testing vote",
+            first_option="dogs",
+            second_option="cats",
+        )
+        self.other_vote = Votes.objects.create(
+            title="other", description="", first_option="a", second_option="b"
+        )
+        self.voter_ids = [
+            Emails.objects.create(
+                email=f"voter{i}@email.com", is_active=True
+            ).id
+            for i in range(2)
+        ]
+
+    def changes(self, events):
+        return [(e.vote_id, e.old_choice, e.choice) for e in events]
+
+    def test_events_are_written_for_every_change(self):
+        first, second = self.voter_ids
+        Voters.objects.upsert([(first, self.vote.id, 0)])
+        Voters.objects.upsert([(first, self.vote.id, 1)])
+        Voters.objects.upsert([(first, self.vote.id, 1)])
+        Voters.objects.upsert([(second, self.other_vote.id, 0)])
+        Voters.objects.filter(voter_id=first).delete()
+
+        self.assertEqual(
+            self.changes(read_events()),
+            [
+                (self.vote.id, None, 0),
+                (self.vote.id, 0, 1),
+                (self.other_vote.id, None, 0),
+                (self.vote.id, 1, None),
+            ],
+        )
+        self.assertEqual(
+            self.changes(read_events(vote_ids=[self.other_vote.id])),
+            [(self.other_vote.id, None, 0)],
+        )
+        self.assertEqual(len(read_events(limit=2)), 2)
+
+    def test_events_of_votes_with_big_ids(self):
+        vote = Votes.objects.create(
+            id=2**31, title="big", description="", first_option="a"
+        )
+        Voters.objects.upsert([(self.voter_ids[0], vote.id, 0)])
+
+        self.assertEqual(
+            self.changes(read_events(vote_ids=[vote.id])), [(vote.id, None, 0)]
+        )
+
+    def test_events_of_running_transactions_are_held_back(self):
+        first, second = self.voter_ids
+        conn = psycopg2.connect(**connection.get_connection_params())
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO votes_voters (voter_id, vote_id, choice) "
+                    "VALUES (%s, %s, 0)",
+                    [first, self.vote.id],
+                )
+            # committed after the transaction above started
+            Voters.objects.upsert([(second, self.vote.id, 1)])
+            self.assertEqual(read_events(), [])
+            conn.commit()
+        finally:
+            conn.close()
+
+        # the position of the later transaction is never read first
+        self.assertEqual(
+            self.changes(read_events()),
+            [(self.vote.id, None, 0), (self.vote.id, None, 1)],
+        )
+
+    def test_consumer_offsets(self):
+        first, second = self.voter_ids
+        Voters.objects.upsert([(first, self.vote.id, 0)])
+
+        events = consume_events("analytics")
+        self.assertEqual(len(events), 1)
+        # nothing is skipped until the offset is committed
+        self.assertEqual(consume_events("analytics"), events)
+        commit_offset("analytics", events[-1].position)
+        self.assertEqual(get_offset("analytics"), events[-1].position)
+        self.assertEqual(consume_events("analytics"), [])
+
+        Voters.objects.upsert([(second, self.vote.id, 1)])
+        self.assertEqual(
+            self.changes(consume_events("analytics")),
+            [(self.vote.id, None, 1)],
+        )
+        self.assertEqual(len(consume_events("replay")), 2)
+
+    def test_prune_events(self):
+        first, second = self.voter_ids
+        Voters.objects.upsert([(first, self.vote.id, 0)])
+        Voters.objects.upsert([(second, self.vote.id, 0)])
+        first_event, second_event = read_events()
+
+        # with no consumer only old events are deleted
+        self.assertEqual(prune_events(), 0)
+        VoteEvent.objects.filter(id=first_event.id).update(
+            created_at=timezone.now() - timedelta(days=30)
+        )
+        call_command("prune_vote_events", "--days", "7", stdout=StringIO())
+        self.assertEqual(read_events(), [second_event])
+
+        commit_offset("analytics", second_event.position)
+        commit_offset("replay", START)
+        self.assertEqual(prune_events(), 0)
+        commit_offset("replay", second_event.position)
+        self.assertEqual(prune_events(), 1)
+        self.assertEqual(read_events(), [])
+
+
+@override_settings(ASYNC_API=True)
+class TestAsyncVotes(TransactionTestCase):
+    # the async views use their own connections, which only see committed
+    # rows
+
+    def setUp(self):
+        reset_caches()
+        self.vote_url = reverse("vote")
+        self.email_obj = Emails.objects.create(
+            email="test_active@email.com", is_active=True
+        )
+        self.vote = Votes.objects.create(
+            title="Dogs vs Cats",
+            description="testing vote",
+            first_option="dogs",
+            second_option="cats",
+        )
+
+    def request(self, method, path, data=None, headers=()):
+        """Send one request to the ASGI application
+
+        Returns:
+            Tuple[int, dict, Any]: status, headers and json body
+        """
+        messages = []
+        body = json.dumps(data).encode() if data is not None else b""
+
+        async def run():
+            async def receive():
+                return {"type": "http.request", "body": body}
+
+            async def send(message):
+                messages.append(message)
+
+            scope = {
+                "type": "http",
+                "method": method,
+                "path": path,
+                "query_string": b"",
+                "headers": [
+                    (b"host", b"testserver"),
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    *[(k.encode(), v.encode()) for k, v in headers],
+                ],
+                "client": ("127.0.0.1", 1234),
+                "server": ("testserver", 80),
+            }
+            try:
+                await asyncio.wait_for(application(scope, receive, send), 5)
+            finally:
+                await close_connections()
+
+        async_to_sync(run)()
+        start, *bodies = messages
+        response_headers = {
+            name.decode().lower(): value.decode()
+            for name, value in start["headers"]
+        }
+        content = b"".join(message.get("body", b"") for message in bodies)
+        return start["status"], response_headers, json.loads(content)
+
+    def put_vote(self, data, headers=()):
+        with mock.patch(
+            "django.core.handlers.asgi.ASGIHandler.__call__"
+        ) as django_application:
+            response = self.request("PUT", self.vote_url, data, headers)
+        # served without django
+        self.assertFalse(django_application.called)
+        return response
+
+    def test_vote(self):
+        data = {
+            "email": "test_active@email.com",
+            "user_choice": "cats",
+            "vote_id": self.vote.id,
+        }
+        status, _, body = self.put_vote(data)
+        self.assertEqual(status, 200)
+        self.assertEqual(body, {"detail": "successful", "user_choice": "cats"})
+        self.assertEqual(Voters.objects.get(voter=self.email_obj).choice, 1)
+
+        # the same as the django view
+        data["user_choice"] = "dogs"
+        with override_settings(ASYNC_API=False):
+            sync_status, _, sync_body = self.request("PUT", self.vote_url, data)
+        self.assertEqual(sync_status, 200)
+        self.assertEqual(Voters.objects.get(voter=self.email_obj).choice, 0)
+        self.assertEqual(
+            self.put_vote(data)[2], {**sync_body, "user_choice": "dogs"}
+        )
+
+    def test_vote_with_big_ids(self):
+        vote = Votes.objects.create(
+            id=2**31 + 7, title="big", description="", first_option="a"
+        )
+        for vote_id, expected in ((vote.id, 200), (2**31 + 5, 404)):
+            data = {
+                "email": "test_active@email.com",
+                "user_choice": "a",
+                "vote_id": vote_id,
+            }
+            status, _, body = self.put_vote(data)
+            with override_settings(ASYNC_API=False):
+                sync_status, _, sync_body = self.request(
+                    "PUT", self.vote_url, data
+                )
+            self.assertEqual((status, body), (sync_status, sync_body))
+            self.assertEqual(status, expected)
+
+    def test_vote_metrics(self):
+        clear_metrics()
+        status, _, _ = self.put_vote(
+            {
+                "email": "test_active@email.com",
+                "user_choice": "cats",
+                "vote_id": self.vote.id,
+            }
+        )
+        self.assertEqual(status, 200)
+
+        samples = parse_metrics(render())
+        labels = '{view="votes.aio.VotesAsyncView",method="PUT"}'
+        self.assertEqual(samples[f"request_duration_seconds_count{labels}"], 1)
+        # asyncpg and redis.asyncio
+        self.assertGreaterEqual(samples[f"request_db_queries_sum{labels}"], 1)
+        self.assertGreaterEqual(
+            samples[f"request_redis_round_trips_sum{labels}"], 1
+        )
+
+    def test_vote_with_voter_token(self):
+        token = issue_voter_token(self.email_obj.id)
+        status, _, _ = self.put_vote(
+            {"user_choice": "dogs", "vote_id": self.vote.id},
+            headers=[("authorization", f"Bearer {token}")],
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual(Voters.objects.get(voter=self.email_obj).choice, 0)
+
+        status, headers, _ = self.put_vote(
+            {"user_choice": "dogs", "vote_id": self.vote.id},
+            headers=[("authorization", f"Bearer {token}x")],
+        )
+        self.assertEqual(status, 401)
+        self.assertEqual(headers["www-authenticate"], "Bearer")
+
+    @mock.patch("users.models.revoke_voter_tokens", side_effect=RedisError)
+    def test_vote_with_voter_token_revoked_redis_missed(self, revoke):
+        token = issue_voter_token(self.email_obj.id)
+        data = {"user_choice": "dogs", "vote_id": self.vote.id}
+        headers = [("authorization", f"Bearer {token}")]
+        self.email_obj.is_active = False
+        self.email_obj.save()
+
+        status, _, body = self.put_vote(data, headers=headers)
+        self.assertEqual((status, body), (401, {"detail": "token revoked"}))
+        self.assertFalse(Voters.objects.exists())
+        # read from the database and cached
+        self.assertIn(
+            get_redis().ttl(f"voter:revoked:{self.email_obj.id}"),
+            range(1, settings.VOTER_TOKEN_REVOCATION_CACHE_TTL + 1),
+        )
+
+    @override_settings(DATABASE_REPLICAS=["replica0"])
+    def test_vote_reads_from_primary_next(self):
+        data = {"email": "test_active@email.com", "vote_id": self.vote.id}
+        status, headers, _ = self.put_vote({**data, "user_choice": "cats"})
+        self.assertEqual(status, 200)
+        self.assertTrue(
+            headers["set-cookie"].startswith(f"{PRIMARY_COOKIE}=1;")
+        )
+
+        status, headers, _ = self.put_vote({**data, "user_choice": "fox"})
+        self.assertEqual(status, 400)
+        self.assertNotIn("set-cookie", headers)
+
+    @override_settings(VOTES_INGESTION_MODE="buffered")
+    def test_vote_buffered(self):
+        get_redis().delete(STREAM_KEY)
+        status, _, body = self.put_vote(
+            {
+                "email": "test_active@email.com",
+                "user_choice": "cats",
+                "vote_id": self.vote.id,
+            }
+        )
+        self.assertEqual(status, 202)
+        self.assertEqual(body["detail"], "accepted")
+        self.assertEqual(get_redis().xlen(STREAM_KEY), 1)
+        self.assertFalse(Voters.objects.exists())
+
+    def test_vote_errors(self):
+        Emails.objects.create(email="inactive@email.com", is_active=False)
+        cases = [
+            ({}, 400),
+            ({"email": "test_active@email.com", "vote_id": self.vote.id}, 400),
+            ({"email": "nobody@email.com", "user_choice": "cats"}, 404),
+            ({"email": "inactive@email.com", "user_choice": "cats"}, 403),
+            ({"email": "test_active@email.com", "user_choice": "fox"}, 400),
+            (
+                {
+                    "email": "test_active@email.com",
+                    "user_choice": "cats",
+                    "vote_id": self.vote.id + 1,
+                },
+                404,
+            ),
+        ]
+        for data, expected_status in cases:
+            if data:
+                data = {"vote_id": self.vote.id, **data}
+            status, _, body = self.put_vote(data)
+            with override_settings(ASYNC_API=False):
+                reset_caches()
+                sync_status, _, sync_body = self.request(
+                    "PUT", self.vote_url, data
+                )
+            self.assertEqual((status, body), (sync_status, sync_body))
+            self.assertEqual(status, expected_status)
+        self.assertFalse(Voters.objects.exists())
+
+    @mock.patch.object(
+        RedisScopedRateThrottle, "THROTTLE_RATES", {"vote": "1/min"}
+    )
+    def test_vote_is_throttled(self):
+        self.assertEqual(self.put_vote({})[0], 400)
+        status, headers, _ = self.put_vote({})
+        self.assertEqual(status, 429)
+        self.assertIn("retry-after", headers)
+
+    def test_other_methods_are_served_by_django(self):
+        status, _, body = self.request("GET", self.vote_url)
+        self.assertEqual(status, 200)
+        self.assertEqual(len(body["results"]), 1)
+
+
+class TestConnectionPool(SimpleTestCase):
+    def setUp(self):
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.close()
+
+    def pool(self, **kwargs) -> ConnectionPool:
+        params = connection.get_connection_params()
+        pool = ConnectionPool(lambda: psycopg2.connect(**params), **kwargs)
+        self.pools.append(pool)
+        return pool
+
+    def test_connection_is_reused(self):
+        pool = self.pool(max_size=2)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        self.assertIs(pool.getconn(), conn)
+        self.assertEqual(pool.stats()["connects"], 1)
+        self.assertEqual(pool.stats()["checkouts"], 2)
+        self.assertEqual(pool.stats()["in_use"], 1)
+
+    def test_full_pool_times_out(self):
+        pool = self.pool(max_size=1, timeout=0.05)
+        pool.getconn()
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+        stats = pool.stats()
+        self.assertEqual(stats["waits"], 1)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertEqual(stats["size"], 1)
+
+    def test_waiting_caller_gets_returned_connection(self):
+        pool = self.pool(max_size=1, timeout=5)
+        conn = pool.getconn()
+        threading.Timer(0.05, pool.putconn, [conn]).start()
+        self.assertIs(pool.getconn(), conn)
+        self.assertEqual(pool.stats()["waits"], 1)
+        self.assertGreater(pool.stats()["wait_seconds"], 0)
+
+    def test_broken_connection_is_replaced(self):
+        pool = self.pool(max_size=1)
+        conn = pool.getconn()
+        pid = conn.get_backend_pid()
+        pool.putconn(conn)
+        with psycopg2.connect(**connection.get_connection_params()) as admin:
+            with admin.cursor() as cursor:
+                cursor.execute("SELECT pg_terminate_backend(%s)", [pid])
+
+        new_conn = pool.getconn()
+        self.assertIsNot(new_conn, conn)
+        self.assertNotEqual(new_conn.get_backend_pid(), pid)
+        self.assertEqual(pool.stats()["discards"], 1)
+
+    def test_transaction_is_rolled_back_on_return(self):
+        pool = self.pool(max_size=1)
+        conn = pool.getconn()
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        pool.putconn(conn)
+        self.assertEqual(
+            conn.info.transaction_status,
+            psycopg2.extensions.TRANSACTION_STATUS_IDLE,
+        )
+        self.assertTrue(conn.autocommit)
+
+    def test_expired_connections_are_closed(self):
+        pool = self.pool(max_size=2, max_lifetime=0)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats()["size"], 0)
+
+        pool = self.pool(min_size=1, max_size=2, max_idle=0)
+        first, second = pool.getconn(), pool.getconn()
+        pool.putconn(first)
+        pool.putconn(second)
+        # the idle connection beyond min_size is closed, not the last one
+        self.assertTrue(first.closed)
+        self.assertFalse(second.closed)
+        self.assertEqual(pool.stats()["idle"], 1)
+
+    def test_inherited_connections_are_left_alone(self):
+        pool = self.pool(max_size=1)
+        conn = pool.getconn()
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        with mock.patch("os.getpid", return_value=pool.pid + 1):
+            pool.putconn(conn)
+            pool.close()
+        # not even rolled back, the socket belongs to the parent
+        self.assertFalse(conn.closed)
+        self.assertEqual(
+            conn.info.transaction_status,
+            psycopg2.extensions.TRANSACTION_STATUS_INTRANS,
+        )
+        conn.close()
+
+
+class TestPooledConnections(TransactionTestCase):
+    def backend_pid(self) -> int:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_backend_pid()")
+            return cursor.fetchone()[0]
+
+    def test_connection_is_reused_across_requests(self):
+        connection.close()
+        pid = self.backend_pid()
+        connection.close()
+        self.assertIsNone(connection.connection)
+        self.assertEqual(self.backend_pid(), pid)
+
+    def test_connection_closed_in_transaction_is_not_reused(self):
+        connection.close()
+        with transaction.atomic():
+            pid = self.backend_pid()
+            connection.close()
+        self.assertNotEqual(self.backend_pid(), pid)
+
+    def test_pool_stats_command(self):
+        get_redis().delete(POOL_STATS_KEY)
+        connection.close()
+        self.backend_pid()
+        with override_settings(DB_POOL_STATS_INTERVAL=0):
+            connection.close()
+
+        out = StringIO()
+        call_command("db_pool_stats", stdout=out)
+        self.assertIn(f":{os.getpid()}:default: 0/", out.getvalue())
+        self.assertIn("1 processes", out.getvalue())
+
+        get_redis().hset(
+            POOL_STATS_KEY, "gone:1:default", json.dumps({"at": 0})
+        )
+        call_command("db_pool_stats", stdout=StringIO())
+        self.assertFalse(get_redis().hexists(POOL_STATS_KEY, "gone:1:default"))
+
+
+class TestReplicaRouting(TransactionTestCase):
+    # the replica is a second connection to the test database, it only sees
+    # committed rows
+
+    def setUp(self):
+        reset_caches()
+        replica_health.clear()
+        connections.databases["replica0"] = {
+            **connections["default"].settings_dict
+        }
+        replicas = override_settings(DATABASE_REPLICAS=["replica0"])
+        replicas.enable()
+        self.addCleanup(replicas.disable)
+
+        self.email_obj = Emails.objects.create(
+            email="test_active@email.com", is_active=True
+        )
+        self.vote = Votes.objects.create(
+            title="Dogs vs Cats",
+            description="testing vote",
+            first_option="dogs",
+            second_option="cats",
+        )
+        self.results_url = reverse(
+            "vote-results", kwargs={"vote_id": self.vote.id}
+        )
+
+    def tearDown(self):
+        replica_health.clear()
+        connections["replica0"].close()
+        close_pools("replica0")
+        del connections.databases["replica0"]
+        delattr(connections._connections, "replica0")
+
+    def replica_queries(self, method, *args, **kwargs):
+        """Send a request and list the tables it read from the replica
+
+        Returns:
+            Tuple[HttpResponse, List[str]]: response and queries
+        """
+        with CaptureQueriesContext(connections["replica0"]) as queries:
+            response = getattr(self.client, method)(*args, **kwargs)
+        return response, [query["sql"] for query in queries]
+
+    def put_vote(self, **extra):
+        return self.client.put(
+            reverse("vote"),
+            data=json.dumps(
+                {
+                    "email": self.email_obj.email,
+                    "user_choice": "dogs",
+                    "vote_id": self.vote.id,
+                }
+            ),
+            content_type="application/json",
+            **extra,
+        )
+
+    def test_safe_requests_read_from_replica(self):
+        response, queries = self.replica_queries("get", self.results_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(any("votes_votetally" in sql for sql in queries))
+        # the options are cached, they are always read from the primary
+        self.assertFalse(any('"votes_votes"' in sql for sql in queries))
+
+    def test_writer_reads_from_primary(self):
+        response = self.put_vote()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(PRIMARY_COOKIE, response.cookies)
+        self.assertEqual(
+            response.cookies[PRIMARY_COOKIE]["max-age"],
+            settings.DB_REPLICA_STICKY_SECONDS,
+        )
+
+        response, queries = self.replica_queries("get", self.results_url)
+        self.assertEqual(response.json()["total"], 1)
+        self.assertEqual(queries, [])
+
+        self.client.cookies.pop(PRIMARY_COOKIE)
+        response, queries = self.replica_queries("get", self.results_url)
+        self.assertNotEqual(queries, [])
+
+    def test_cross_origin_writer_gets_the_cookie(self):
+        response = self.put_vote(HTTP_ORIGIN="http://localhost:3000")
+        self.assertIn(PRIMARY_COOKIE, response.cookies)
+        self.assertEqual(
+            response["access-control-allow-origin"], "http://localhost:3000"
+        )
+        self.assertEqual(response["access-control-allow-credentials"], "true")
+
+    def test_failed_write_is_not_sticky(self):
+        response = self.client.put(
+            reverse("vote"), data={}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn(PRIMARY_COOKIE, response.cookies)
+
+    def test_catalog_cache_is_filled_from_primary(self):
+        response, queries = self.replica_queries("get", reverse("vote"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, [])
+
+    @override_settings(DB_REPLICA_MAX_LAG=-1)
+    def test_lagging_replica_is_not_used(self):
+        response, queries = self.replica_queries("get", self.results_url)
+        self.assertEqual(response.status_code, 200)
+        # only the lag check
+        self.assertEqual(len(queries), 1)
+        self.assertIn("pg_last_wal_replay_lsn", queries[0])
+
+    @mock.patch("config.db.routers.REPLICA_LAG_SQL", "SELECT NULL")
+    def test_disconnected_replica_is_not_used(self):
+        response, queries = self.replica_queries("get", self.results_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, ["SELECT NULL"])
+
+    @override_settings(DB_REPLICA_CHECK_INTERVAL=60)
+    def test_lag_is_checked_once_per_interval(self):
+        with mock.patch.object(
+            replica_health, "check", return_value=True
+        ) as check:
+            for _ in range(3):
+                self.client.get(self.results_url)
+        self.assertEqual(check.call_count, 1)
+
+    def test_unreachable_replica_is_not_used(self):
+        connections.databases["replica0"]["PORT"] = "1"
+        with self.assertLogs("config.db.routers", "WARNING"):
+            response = self.client.get(self.results_url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_router(self):
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(Votes), "default")
+        with use_replicas():
+            self.assertEqual(router.db_for_read(Votes), "replica0")
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(Votes), "default")
+            self.assertEqual(router.db_for_write(Votes), "default")
+            # read your own writes until the end of the block
+            self.assertEqual(router.db_for_read(Votes), "default")
+        self.assertTrue(router.allow_migrate("default", "votes"))
+        self.assertFalse(router.allow_migrate("replica0", "votes"))
+
+
+class TestPartitions(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.voter_ids = [
+            Emails.objects.create(
+                email=f"voter{i}@email.com", is_active=True
+            ).id
+            for i in range(4)
+        ]
+
+    def setUp(self):
+        self.vote = self.create_vote()
+
+    def create_vote(self):
+        return Votes.objects.create(
+            title="Dogs vs Cats",
+            description="testing vote",
+            first_option="dogs",
+            second_option="cats",
+        )
+
+    def cast_votes(self, vote):
+        Voters.objects.upsert(
+            [(voter_id, vote.id, voter_id % 2) for voter_id in self.voter_ids]
+        )
+
+    def rows(self, table):
+        """Rows of `table`, None if it does not exist"""
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)", [table])
+            if cursor.fetchone()[0] is None:
+                return None
+            cursor.execute(f"SELECT count(*) FROM {table}")
+            return cursor.fetchone()[0]
+
+    def tallies(self, vote):
+        return dict(vote.tallies.values_list("choice", "count"))
+
+    def test_votes_are_written_to_their_partition(self):
+        self.cast_votes(self.vote)
+
+        self.assertEqual(self.rows(partition_name(self.vote.id)), 4)
+        self.assertEqual(self.rows(DEFAULT_PARTITION), 0)
+        self.assertEqual(self.tallies(self.vote), {0: 2, 1: 2})
+        self.assertFalse(create_partition(self.vote.id))
+
+    @override_settings(VOTERS_HASH_PARTITIONS=2)
+    def test_votes_are_split_by_voter(self):
+        vote = self.create_vote()
+        self.cast_votes(vote)
+
+        name = partition_name(vote.id)
+        self.assertEqual(self.rows(f"{name}_0") + self.rows(f"{name}_1"), 4)
+        self.assertEqual(self.rows(name), 4)
+        self.assertEqual(
+            Voters.objects.filter(vote=vote, voter_id=self.voter_ids[1])
+            .get()
+            .choice,
+            self.voter_ids[1] % 2,
+        )
+
+    def test_delete_drops_partition(self):
+        other_vote = self.create_vote()
+        self.cast_votes(self.vote)
+        self.cast_votes(other_vote)
+        events = VoteEvent.objects.count()
+        vote_id = self.vote.id
+
+        self.vote.delete()
+
+        self.assertIsNone(self.rows(partition_name(vote_id)))
+        self.assertFalse(Voters.objects.filter(vote_id=vote_id).exists())
+        self.assertFalse(VoteTally.objects.filter(vote_id=vote_id).exists())
+        # the ballots were not deleted one by one
+        self.assertEqual(VoteEvent.objects.count(), events)
+        self.assertEqual(self.tallies(other_vote), {0: 2, 1: 2})
+
+    def test_queryset_delete_drops_partitions(self):
+        other_vote = self.create_vote()
+        self.cast_votes(self.vote)
+
+        Votes.objects.filter(id__in=[self.vote.id, other_vote.id]).delete()
+
+        self.assertIsNone(self.rows(partition_name(self.vote.id)))
+        self.assertIsNone(self.rows(partition_name(other_vote.id)))
+        self.assertFalse(Voters.objects.exists())
+
+    def test_archive_vote_command(self):
+        self.cast_votes(self.vote)
+
+        out = StringIO()
+        call_command("archive_vote", self.vote.id, stdout=out)
+
+        self.assertIn(archive_name(self.vote.id), out.getvalue())
+        self.assertFalse(Votes.objects.filter(id=self.vote.id).exists())
+        self.assertFalse(Voters.objects.exists())
+        self.assertEqual(self.rows(archive_name(self.vote.id)), 4)
+
+    def test_archive_vote_without_partition(self):
+        detach_partition(self.vote.id)
+
+        with self.assertRaises(CommandError):
+            call_command("archive_vote", self.vote.id, stdout=StringIO())
+        self.assertTrue(Votes.objects.filter(id=self.vote.id).exists())
+
+    def test_partition_votes_command(self):
+        # e.g. a vote created by the code before partitioning
+        detach_partition(self.vote.id)
+        self.cast_votes(self.vote)
+        self.assertEqual(self.rows(DEFAULT_PARTITION), 4)
+        self.assertEqual(votes_in_default(), [self.vote.id])
+        events = VoteEvent.objects.count()
+
+        out = StringIO()
+        call_command("partition_votes", stdout=out)
+
+        self.assertIn("Moved 4 ballots of 1 votes.", out.getvalue())
+        self.assertEqual(self.rows(DEFAULT_PARTITION), 0)
+        self.assertEqual(self.rows(partition_name(self.vote.id)), 4)
+        self.assertEqual(self.tallies(self.vote), {0: 2, 1: 2})
+        self.assertEqual(VoteEvent.objects.count(), events)
+        self.assertEqual(Voters.objects.filter(vote=self.vote).count(), 4)
+
+        # the triggers of the default partition are back
+        other_vote = self.create_vote()
+        detach_partition(other_vote.id)
+        self.cast_votes(other_vote)
+        self.assertEqual(self.tallies(other_vote), {0: 2, 1: 2})
+
+
+@override_settings(
+    VOTERS_PARTITION_LOCK_TIMEOUT=0.05, VOTERS_PARTITION_LOCK_ATTEMPTS=3
+)
+class TestPartitionLocks(TransactionTestCase):
+    def setUp(self):
+        self.vote = Votes.objects.create(
+            title="Dogs vs Cats",
+            description="testing vote",
+            first_option="dogs",
+            second_option="cats",
+        )
+        # a long read of the ballots, holding a lock on `votes_voters`
+        self.reader = psycopg2.connect(**connection.get_connection_params())
+        with self.reader.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM votes_voters")
+
+    def tearDown(self):
+        self.reader.close()
+
+    def is_partition(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT to_regclass(%s)", [partition_name(self.vote.id)]
+            )
+            return cursor.fetchone()[0] is not None
+
+    def test_detach_partition_gives_up_waiting_for_locks(self):
+        started = time.monotonic()
+        with self.assertRaises(OperationalError):
+            detach_partition(self.vote.id)
+
+        # 3 attempts and 2 pauses, instead of waiting for the read
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertTrue(self.is_partition())
+
+    def test_detach_partition_retries_once_locks_are_free(self):
+        finish_read = threading.Timer(0.1, self.reader.rollback)
+        finish_read.start()
+        self.addCleanup(finish_read.join)
+
+        self.assertTrue(detach_partition(self.vote.id))
+        self.assertFalse(self.is_partition())
+
+    def test_lock_timeout_is_restored(self):
+        self.reader.rollback()
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("SHOW lock_timeout")
+            (lock_timeout,) = cursor.fetchone()
+            self.assertTrue(detach_partition(self.vote.id))
+            cursor.execute("SHOW lock_timeout")
+            self.assertEqual(cursor.fetchone(), (lock_timeout,))
+
+
+class TestMetrics(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.email_obj = Emails.objects.create(
+            email="test_active@email.com", is_active=True
+        )
+        cls.vote = Votes.objects.create(
+            title="Dogs vs Cats",
+            description="testing vote",
+            first_option="dogs",
+            second_option="cats",
+        )
+
+    def setUp(self):
+        reset_caches()
+        clear_metrics()
+
+    def test_queries_and_redis_round_trips_are_counted(self):
+        client = get_redis()
+        with measure() as metrics:
+            list(Votes.objects.all())
+            Votes.objects.count()
+            client.get("metrics:test")
+            pipe = client.pipeline(transaction=False)
+            pipe.get("metrics:test")
+            pipe.get("metrics:test")
+            pipe.execute()
+
+        self.assertEqual(metrics.db_queries, 2)
+        self.assertEqual(metrics.redis_round_trips, 2)
+        self.assertGreater(metrics.db_seconds, 0)
+        self.assertGreater(metrics.redis_seconds, 0)
+        self.assertGreaterEqual(
+            metrics.duration, metrics.db_seconds + metrics.redis_seconds
+        )
+
+        # nothing is recorded outside of `measure()`
+        Votes.objects.count()
+        self.assertEqual(metrics.db_queries, 2)
+
+    def test_celery_publishes_are_counted(self):
+        with measure() as metrics:
+            celery_app.send_task("metrics.test", queue="metrics-test")
+        for key in get_redis().scan_iter("*metrics-test*"):
+            get_redis().delete(key)
+
+        self.assertEqual(metrics.celery_publishes, 1)
+        self.assertGreater(metrics.celery_seconds, 0)
+
+    def test_requests_are_recorded_by_view(self):
+        for _ in range(2):
+            response = self.client.put(
+                reverse("vote"),
+                data=json.dumps(
+                    {
+                        "email": self.email_obj.email,
+                        "user_choice": "dogs",
+                        "vote_id": self.vote.id,
+                    }
+                ),
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        samples = parse_metrics(response.content.decode())
+        labels = '{view="votes.api.VotesView",method="PUT"}'
+        self.assertEqual(samples[f"request_duration_seconds_count{labels}"], 2)
+        self.assertEqual(
+            samples[
+                'request_duration_seconds_bucket{view="votes.api.VotesView",'
+                'method="PUT",le="+Inf"}'
+            ],
+            2,
+        )
+        self.assertGreater(samples[f"request_duration_seconds_sum{labels}"], 0)
+        self.assertGreaterEqual(samples[f"request_db_queries_sum{labels}"], 2)
+        self.assertGreaterEqual(
+            samples[f"request_redis_round_trips_sum{labels}"], 2
+        )
+        # no task was published
+        self.assertNotIn(
+            f"request_celery_publish_seconds_count{labels}", samples
+        )
+
+    def test_metrics_add_up_across_processes(self):
+        metrics = RequestMetrics()
+        metrics.db_queries = 3
+        get_redis().hincrby(
+            METRICS_KEY,
+            "\t".join(
+                ("request_db_queries", "votes.api.VotesView", "GET", "3")
+            ),
+            5,
+        )
+        collector.observe("votes.api.VotesView", "GET", metrics)
+
+        samples = parse_metrics(render())
+        labels = 'view="votes.api.VotesView",method="GET"'
+        self.assertEqual(
+            samples[f'request_db_queries_bucket{{{labels},le="2"}}'], 0
+        )
+        self.assertEqual(
+            samples[f'request_db_queries_bucket{{{labels},le="3"}}'], 6
+        )
+        self.assertEqual(samples[f"request_db_queries_count{{{labels}}}"], 6)
+        self.assertEqual(samples[f"request_db_queries_sum{{{labels}}}"], 3)
+
+    def test_pool_stats_are_exposed(self):
+        get_redis().hset(
+            POOL_STATS_KEY,
+            "host:1:default",
+            json.dumps(
+                {
+                    "max_size": 10,
+                    "in_use": 2,
+                    "idle": 1,
+                    "waiting": 0,
+                    "checkouts": 7,
+                    "waits": 1,
+                    "wait_seconds": 0.5,
+                    "timeouts": 0,
+                    "at": time.time(),
+                }
+            ),
+        )
+        try:
+            samples = parse_metrics(render())
+        finally:
+            get_redis().hdel(POOL_STATS_KEY, "host:1:default")
+        self.assertEqual(samples['db_pool_in_use{process="host:1:default"}'], 2)
+        self.assertEqual(
+            samples['db_pool_checkouts_total{process="host:1:default"}'], 7
+        )
+
+    def test_metrics_are_internal(self):
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR="10.1.2.3")
+        self.assertEqual(response.status_code, 403)
+
+        with override_settings(METRICS_ALLOWED_NETWORKS=["10.0.0.0/8"]):
+            response = self.client.get(
+                reverse("metrics"), REMOTE_ADDR="10.1.2.3"
+            )
+        self.assertEqual(response.status_code, 200)
+
+
+class TestModels(TestCase):
+    def setUp(self):
+        self.vote = Votes.objects.create(
+            title="some title for a vote",
+            description="some description",
+            first_option="option a",
+            second_option="option b",
+        )
+        self.email_obj = Emails.objects.create(
+            email="test@email.com", is_active=True
+        )
+
+    def test_vote_is_assigned_slug_on_creation(self):
+        self.assertEqual(self.vote.slug, slugify("some title for a vote"))
+
+    def test_vote_model_str(self):
+        self.assertEqual(
+            str(self.vote),
+            f"{self.vote.title}({self.vote.first_option}, {self.vote.second_option})",
+        )
+
+    def test_voter_model_str(self):
+        voter_obj = Voters.objects.create(
+            vote=self.vote, voter=self.email_obj, user_choice="option a"
+        )
+        self.assertEqual(
+            str(voter_obj),
+            f"{self.email_obj.email} ({voter_obj.user_choice})",
+        )
+
+    def test_voter_models_unique_constraint(self):
+        email_obj = Emails.objects.create(
+            email="test1@email.com", is_active=True
+        )
+
+        Voters.objects.create(
+            vote=self.vote, voter=email_obj, user_choice="option a"
+        )
+
+        with self.assertRaises(IntegrityError):
+            Voters.objects.create(
+                vote=self.vote, voter=email_obj, user_choice="option b"
+            )
+
+    def test_voters_upsert(self):
+        other_vote = Votes.objects.create(
+            title="other", description="", first_option="a", second_option="b"
+        )
+
+        changed = Voters.objects.upsert(
+            [
+                (self.email_obj.id, self.vote.id, 0),
+                (self.email_obj.id, other_vote.id, 0),
+            ]
+        )
+        self.assertEqual(changed, 2)
+
+        changed = Voters.objects.upsert(
+            [
+                (self.email_obj.id, self.vote.id, 1),
+                (self.email_obj.id, other_vote.id, 0),
+            ]
+        )
+        self.assertEqual(changed, 1)
+        self.assertEqual(
+            dict(
+                Voters.objects.filter(voter=self.email_obj).values_list(
+                    "vote_id", "choice"
+                )
+            ),
+            {self.vote.id: 1, other_vote.id: 0},
+        )
+
+    def test_voter_models_choice_is_option_index(self):
+        voter_obj = Voters.objects.create(
+            vote=self.vote, voter=self.email_obj, user_choice="option b"
+        )
+        voter_obj.refresh_from_db()
+
+        self.assertEqual(voter_obj.choice, 1)
+        self.assertEqual(voter_obj.user_choice, "option b")
+
+    def test_voter_models_invalid_user_choice(self):
+        with self.assertRaises(ValueError):
+            Voters(vote=self.vote, voter=self.email_obj, user_choice="cats")
@@ -1,7 +1,13 @@
 from django.urls import path
 
-from .api import VotesView
+from .api import VoteResultsView, VotesBatchView, VotesView
 
 urlpatterns = [
     path("vote/", VotesView.as_view(), name="vote"),
+    path("vote/batch/", VotesBatchView.as_view(), name="vote-batch"),
+    path(
+        "vote/<int:vote_id>/results/",
+        VoteResultsView.as_view(),
+        name="vote-results",
+    ),
 ]
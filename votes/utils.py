@@ -0,0 +1,281 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+from config.db.routers import use_replicas
+from django.conf import settings
+from django.db import connection, transaction
+from redis import RedisError
+
+from .cache import get_catalog_version
+from .models import Votes, VoteTally
+
+REBUILD_TALLIES_SQL = """
+INSERT INTO votes_votetally (vote_id, choice, count)
+SELECT vote_id, choice, count(*)
+FROM votes_voters
+{where}
+GROUP BY vote_id, choice
+"""
+
+
+def rebuild_tallies(vote_ids: Optional[Iterable[int]] = None) -> int:
+    """Recompute `VoteTally` rows from `Voters`
+
+    Writes to `votes_voters` are blocked while the counters are rebuilt so
+    that no vote is lost or counted twice, reads are not affected.
+
+    Args:
+        vote_ids (Iterable[int], optional): only rebuild these votes.
+        Defaults to every vote.
+
+    Returns:
+        int: number of tally rows written
+    """
+    tallies = VoteTally.objects.all()
+    where, params = "", []
+    if vote_ids is not None:
+        vote_ids = list(vote_ids)
+        tallies = tallies.filter(vote_id__in=vote_ids)
+        where, params = "WHERE vote_id = ANY(%s)", [vote_ids]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("LOCK TABLE votes_voters IN SHARE MODE")
+        tallies.delete()
+        cursor.execute(REBUILD_TALLIES_SQL.format(where=where), params)
+        return cursor.rowcount
+
+
+NOTIFY_TRIGGER_NAMES = [
+    "vote_notify_trigger",
+    "vote_notify_insert_trigger",
+    "vote_notify_update_trigger",
+    "vote_notify_delete_trigger",
+]
+
+NOTIFY_TRIGGERS_SQL = {
+    "row": """
+CREATE TRIGGER vote_notify_trigger
+AFTER INSERT OR UPDATE OR DELETE ON votes_voters
+FOR EACH ROW EXECUTE PROCEDURE vote_notify_func();
+""",
+    # a trigger with transition tables can only handle one kind of event
+    "statement": """
+CREATE TRIGGER vote_notify_insert_trigger
+AFTER INSERT ON votes_voters
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE vote_notify_statement_func();
+
+CREATE TRIGGER vote_notify_update_trigger
+AFTER UPDATE ON votes_voters
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE vote_notify_statement_func();
+
+CREATE TRIGGER vote_notify_delete_trigger
+AFTER DELETE ON votes_voters
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE vote_notify_statement_func();
+""",
+}
+
+NOTIFY_TRIGGER_MODES = list(NOTIFY_TRIGGERS_SQL)
+
+
+def get_notify_trigger_mode() -> Optional[str]:
+    """Find which triggers publish vote changes on `vote_channel`
+
+    Returns:
+        Optional[str]: `row`, `statement` or None if none is installed
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT tgname FROM pg_trigger "
+            "WHERE tgrelid = 'votes_voters'::regclass AND tgname = ANY(%s)",
+            [NOTIFY_TRIGGER_NAMES],
+        )
+        names = {name for name, in cursor.fetchall()}
+    if "vote_notify_trigger" in names:
+        return "row"
+    if names:
+        return "statement"
+    return None
+
+
+def set_notify_trigger_mode(mode: str):
+    """Replace the triggers publishing vote changes on `vote_channel`
+
+    In `row` mode every written row sends one notification, in `statement`
+    mode every statement sends one notification per vote it changed with the
+    change in number of voters of each option.
+
+    Args:
+        mode (str): one of `NOTIFY_TRIGGER_MODES`
+    """
+    drop = "".join(
+        f"DROP TRIGGER IF EXISTS {name} ON votes_voters;"
+        for name in NOTIFY_TRIGGER_NAMES
+    )
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(drop + NOTIFY_TRIGGERS_SQL[mode])
+
+
+class VoteOptionsCache:
+    """Per-process LRU cache of vote id -> allowed options
+
+    Entries expire after `ttl` seconds and the whole cache is dropped when
+    the catalog version in Redis changes (it is bumped whenever a vote is
+    saved or deleted), so every worker process notices edited votes on its
+    next lookup. Votes that do not exist are cached as well.
+
+    Args:
+        maxsize (int): maximum number of cached votes
+        ttl (float): seconds an entry is valid for
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+
+    def get(self, vote_id: int) -> Optional[List[str]]:
+        """Get the options of a vote
+
+        Args:
+            vote_id (int): id of the vote
+
+        Returns:
+            Optional[List[str]]: options of the vote or None if the vote
+            does not exist
+        """
+        return self.get_many([vote_id])[vote_id]
+
+    def get_many(
+        self, vote_ids: Iterable[int]
+    ) -> Dict[int, Optional[List[str]]]:
+        """Get the options of several votes, loading the missing ones from
+        the database with one query
+
+        Args:
+            vote_ids (Iterable[int]): ids of the votes
+
+        Returns:
+            Dict[int, Optional[List[str]]]: options of each vote, None for
+            votes that do not exist
+        """
+        vote_ids = set(vote_ids)
+        try:
+            version = get_catalog_version()
+        except RedisError:
+            # without the version stale entries can not be detected
+            return self._load(vote_ids)
+
+        now = time.monotonic()
+        found = self.cached(version, vote_ids, now)
+        missing = vote_ids - found.keys()
+        if missing:
+            # a lagging replica would cache new votes as missing
+            with use_replicas(False):
+                loaded = self._load(missing)
+            found.update(loaded)
+            self.update(version, loaded, now)
+        return found
+
+    def cached(
+        self, version: int, vote_ids: Iterable[int], now: float
+    ) -> Dict[int, Optional[List[str]]]:
+        """Get the options of the votes that are cached and did not expire
+
+        Args:
+            version (int): current catalog version, the cache is dropped if
+            it changed
+            vote_ids (Iterable[int]): ids of the votes
+            now (float): `time.monotonic()` of the lookup
+
+        Returns:
+            Dict[int, Optional[List[str]]]: options of each cached vote
+        """
+        found = {}
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+
+            for vote_id in vote_ids:
+                entry = self._entries.get(vote_id)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(vote_id)
+                    found[vote_id] = entry[1]
+        return found
+
+    def update(
+        self,
+        version: int,
+        options: Dict[int, Optional[List[str]]],
+        now: float,
+    ):
+        """Cache options loaded from the database, unless the catalog
+        version changed in the meantime
+
+        Args:
+            version (int): catalog version the options were loaded under
+            options (Dict[int, Optional[List[str]]]): options of each vote
+            now (float): `time.monotonic()` of the lookup
+        """
+        with self._lock:
+            if version != self._version:
+                return
+            for vote_id, vote_options in options.items():
+                self._entries[vote_id] = (now + self.ttl, vote_options)
+                self._entries.move_to_end(vote_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _load(self, vote_ids: set) -> Dict[int, Optional[List[str]]]:
+        options = dict.fromkeys(vote_ids)
+        for vote_id, first_option, second_option in Votes.objects.filter(
+            id__in=vote_ids
+        ).values_list("id", "first_option", "second_option"):
+            options[vote_id] = [first_option, second_option]
+        return options
+
+
+vote_options_cache = VoteOptionsCache(
+    maxsize=settings.VOTE_OPTIONS_CACHE_SIZE,
+    ttl=settings.VOTE_OPTIONS_CACHE_TTL,
+)
+
+
+def get_vote_results(vote_id: int) -> Optional[dict]:
+    """Read the number of voters for each option of a vote from `VoteTally`
+
+    Args:
+        vote_id (int): id of the vote
+
+    Returns:
+        Optional[dict]: `{"vote_id", "results", "total"}` or None if the
+        vote does not exist
+    """
+    options = vote_options_cache.get(vote_id)
+    if options is None:
+        return None
+
+    counts = dict(
+        VoteTally.objects.filter(vote_id=vote_id).values_list("choice", "count")
+    )
+    results = [
+        {"option": option, "count": counts.get(index, 0)}
+        for index, option in enumerate(options)
+    ]
+    return {
+        "vote_id": vote_id,
+        "results": results,
+        "total": sum(result["count"] for result in results),
+    }